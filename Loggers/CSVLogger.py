@@ -11,10 +11,11 @@ class CSVLogger(Logger):
             writer = csv.writer(file, delimiter=";")
             writer.writerow(list(dict_keys))
 
-    def log(self, log_dict):
+    def log(self, log_dict, repeat=1):
+        # repeat: the number of seconds the values hold for, one row per second
         with open(self.output_file, mode='a', newline='') as file:
             writer = csv.writer(file, delimiter=";")
-            writer.writerow([log_dict[key] for key in self.dict_keys])
+            writer.writerows([[log_dict[key] for key in self.dict_keys]] * repeat)
 
     def get_df(self):
         return pd.read_csv(self.output_file, delimiter=";")
\ No newline at end of file
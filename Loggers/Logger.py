@@ -6,7 +6,7 @@ class Logger:
         self.output_file = os.path.join(output_file_path, output_file_name + ".csv")
         self.dict_keys = dict_keys
 
-    def log(self, state_dict):
+    def log(self, state_dict, repeat=1):
         pass
 
     def get_df(self):
@@ -3,7 +3,7 @@ import os
 from stable_baselines3 import DQN, PPO, A2C
 from Policies.static_step_handle_functions import StepHandleFunction
 from SUMO.SUMOAdpater import SUMOAdapter
-from env.PTLenv import PTLEnv
+from env.PTLenv import PTLEnv, OBS_MODES
 
 
 class RLAgent(StepHandleFunction):
@@ -11,9 +11,11 @@ class RLAgent(StepHandleFunction):
                  av_rate: float = 0.1,
                  act_rate: int = 10,
                  agent_type: str = "DQN",
-                 policy_type: str = "MultiInputPolicy", ):
+                 policy_type: str = None,
+                 obs_mode: str = "dict"):
         super().__init__()
         assert agent_type in ["DQN", "PPO", "A2C"]
+        assert obs_mode in OBS_MODES
         self.agent_type = agent_type
         self.RL = True
         self.act_rate = act_rate
@@ -21,6 +23,10 @@ class RLAgent(StepHandleFunction):
         self.min_num_pass = 6   # NEVER CHANGE
         self.endToEnd = False
         self.agent = None
+        # the flat observation vector feeds an MLP directly, the dict one needs the per-key extractor
+        self.obs_mode = obs_mode
+        if policy_type is None:
+            policy_type = "MlpPolicy" if obs_mode == "flat" else "MultiInputPolicy"
         self.policy_type = policy_type
         self.av_rate = av_rate
 
@@ -32,7 +38,8 @@ class RLAgent(StepHandleFunction):
         env.step(self.agent.predict(env.state, deterministic=True)[0])
 
     def __str__(self):
-        return f"{self.agent_type}_{self.act_rate}"
+        suffix = "_flat" if self.obs_mode == "flat" else ""
+        return f"{self.agent_type}_{self.act_rate}{suffix}"
 
     def save(self, path):
-        self.agent.save(os.path.join(path, f"{self.agent_type}_{self.act_rate}"))
+        self.agent.save(os.path.join(path, self.__str__()))
@@ -80,6 +80,13 @@ class OneVariableControl_threshold(StepHandleFunction):
         env.allow_vehicles(veh_types=self.veh_kinds, min_num_pass=self.current_min_num_pass)
         # print(f"Current min num pass: {self.current_min_num_pass}, timestep: {env.timestep}")
 
+    def next_wakeup(self, env: SUMOAdapter):
+        # the feature is only read on decisions, in between the policy only has to keep admitting vehicles
+        next_decision = (env.timestep // self.decision_rate + 1) * self.decision_rate
+        if env.admission_step is None:
+            return next_decision
+        return min(next_decision, env.timestep + env.admission_step)
+
     def __str__(self):
         return f"OneVariableControl_threshold_{self.control_variable}_{self.param_threshold}_{self.decision_rate}"
 
@@ -1,6 +1,4 @@
-import traci
 from SUMO.SUMOAdpater import SUMOAdapter
-from SUMO.netfile_utils import get_PTL_lanes
 
 
 class StepHandleFunction:
@@ -12,6 +10,8 @@ class StepHandleFunction:
         self.arrival_split = False
         self.av_rate = 0.0
         self.RL = False
+        self.static = False  # fully expressed by the route file and ptl_allowed, can run without TraCI
+        self.ptl_allowed = None  # the vehicle classes after_init_sumo allows on the PTL lanes, [] for none
 
     def handle_step(self, env: SUMOAdapter):
         pass
@@ -20,6 +20,10 @@ class StepHandleFunction:
         # run this function after sumo is initialized
         pass
 
+    def next_wakeup(self, env: SUMOAdapter):
+        # the timestep handle_step has to run at next, None if it never has to run again
+        return env.timestep + 1
+
     def __str__(self):
         pass
 
@@ -27,11 +31,16 @@ class StepHandleFunction:
 class NoBody(StepHandleFunction):
     def __init__(self, ):
         super().__init__()
+        self.static = True
+        self.ptl_allowed = []
 
     def after_init_sumo(self, env: SUMOAdapter):
-        PTL_lane_ids = get_PTL_lanes(env.network_file)
+        PTL_lane_ids = env.network.ptl_lane_ids
         for lane in PTL_lane_ids:
-            traci.lane.setAllowed(lane, [])
+            env.traci.lane.setAllowed(lane, self.ptl_allowed)
+
+    def next_wakeup(self, env: SUMOAdapter):
+        return None
 
     def __str__(self):
         return "NoBody"
@@ -40,11 +49,16 @@ class NoBody(StepHandleFunction):
 class Nothing(StepHandleFunction):
     def __init__(self, ):
         super().__init__()
+        self.static = True
+        self.ptl_allowed = ["bus"]
 
     def after_init_sumo(self, env: SUMOAdapter):
-        PTL_lane_ids = get_PTL_lanes(env.network_file)
+        PTL_lane_ids = env.network.ptl_lane_ids
         for lane in PTL_lane_ids:
-            traci.lane.setAllowed(lane, "bus")
+            env.traci.lane.setAllowed(lane, self.ptl_allowed)
+
+    def next_wakeup(self, env: SUMOAdapter):
+        return None
 
     def __str__(self):
         return "Nothing"
@@ -56,6 +70,11 @@ class Plus(StepHandleFunction):
         super().__init__()
         self.min_num_pass = min_num_pass
         self.veh_kinds = ["AV", "HD"]
+        self.static = True
+
+    def next_wakeup(self, env: SUMOAdapter):
+        # the permissions are set in the route file
+        return None
 
     def __str__(self):
         return f"Plus_{self.min_num_pass}"
@@ -1,132 +1,585 @@
 import traci
+import traci.constants as tc
 import numpy as np
 import os
+import warnings
 from xml.etree import ElementTree as ET
 from Demands.demand_profiles import *
 from SUMO.netfile_utils import *
 from SUMO.demand_utils import *
+from SUMO.admission import AdmissionTable, VTypePermissions
+from SUMO.vtype_registry import VTypeRegistry
+from results.result_store import store_folder
+from SUMO.session import acquire_session, release_session, SESSION_MAX_RUNS
+from SUMO.completion_utils import get_sumo_version, object_params, params_hash, run_fingerprint, \
+    RUNTIME_ATTRIBUTES, write_completion_marker, read_completion_marker
+import json
 import shutil
+import copy
+import contextlib
+import re
+import subprocess
+import itertools
+import threading
 
 from Demands.DemandToy import DemandToy
 
+try:
+    import libsumo
+except ImportError:
+    libsumo = None
+
+ENGINES = ["traci", "libsumo"]
+PERMISSION_MODES = ["vehicle", "vtype"]
+ROUTE_CACHE_VERSION = 2
+ROUTE_CACHE_FOLDER = "routes"
+
+# several simulations can run in the threads of one worker, each one on its own labelled TraCI connection.
+# traci.start is not thread safe and the route files are generated from the global numpy random state
+_CONNECTION_LABELS = itertools.count()
+_START_LOCK = threading.Lock()
+_FILES_LOCK = threading.Lock()
+
+# variables subscribed for the vehicles the accessors read, refreshed by SUMO on every step until they arrive
+VEHICLE_VARS = (tc.VAR_SPEED, tc.VAR_VEHICLECLASS, tc.VAR_TYPE)
+# the departed and arrived streams are only subscribed for the per vehicle admission
+SIMULATION_VARS = (tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS, tc.VAR_MIN_EXPECTED_VEHICLES)
+# a junction context subscription in this range holds every vehicle of the network, see _read_all_vehicles
+NETWORK_RANGE = 1e9
+
+SUMO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+# the keys and paths of a simulation from its parameters, the sweep reads them without building the adapters (see
+# utils.task_spec.TaskSpec)
+
+def select_engine(engine, gui=False):
+    assert engine in ENGINES, f"Unknown engine {engine}, has to be one of {ENGINES}"
+    if engine == "libsumo" and (gui or libsumo is None):
+        reason = "libsumo is not installed" if libsumo is None else "libsumo can not run with GUI"
+        warnings.warn(f"{reason}, falling back to traci")
+        return "traci"
+    return engine
+
+
+def get_sumo_entrypoint(gui=False):
+    if 'SUMO_HOME' in os.environ:
+        sumo_path = os.environ['SUMO_HOME']
+        # check operational system - if it is windows, use sumo.exe if linux/macos, use sumo
+        if os.name == 'nt':
+            sumo_binary = os.path.join(sumo_path, 'bin', 'sumo-gui.exe') if gui else \
+                os.path.join(sumo_path, 'bin', 'sumo.exe')
+        else:
+            sumo_binary = os.path.join(sumo_path, 'bin', 'sumo-gui') if gui else \
+                os.path.join(sumo_path, 'bin', 'sumo')
+    else:
+        raise Exception("please declare environment variable 'SUMO_HOME'")
+    return sumo_binary
+
+
+def experiment_folder(net_file, demand_profile, seed, output_folder="outputs"):
+    return os.path.join(SUMO_FOLDER, output_folder, net_file.split(".")[0], demand_profile.__str__(),
+                        str(demand_profile.av_rate), str(seed))
+
+
+def completion_marker(folder, policy):
+    return os.path.join(folder, policy.__str__() + ".done")
+
+
+def simulation_fingerprint(net_hash, demand, seed, policy, engine, permission_mode, batch, gui=False):
+    """
+    Key of the simulation of policy: net file content, demand parameters, seed, policy parameters, SUMO version
+    and the way it is run (permission mode, batch, TraCI or libsumo)
+    :param demand: the demand as simulated, its vehicle amounts set (see SUMOAdapter.simulated_demand)
+    """
+    return run_fingerprint(net=net_hash, demand=object_params(demand), av_rate=demand.av_rate, seed=seed,
+                           policy=object_params(policy, skip=RUNTIME_ATTRIBUTES),
+                           sumo=get_sumo_version(get_sumo_entrypoint(gui)), permission_mode=permission_mode,
+                           batch=batch, engine=engine)
+
 
 class SUMOAdapter:
     def __init__(self, demand_profile: Demand, seed: int,
                  route_temp: str = "route_template.rou.xml", net_file: str = "network.net.xml",
                  cfg_temp: str = "config_template.sumocfg", add_temp: str = "additional_template.add.xml",
-                 template_folder="SUMOconfig", output_folder="outputs", gui=False):
-        curdir = os.path.dirname(os.path.abspath(__file__))
-        self.template_folder = os.path.join(curdir, template_folder)
+                 template_folder="SUMOconfig", output_folder="outputs", gui=False, engine="traci",
+                 permission_mode="vehicle", batch=False, copy_net=True, reuse_session=False,
+                 session_max_runs=SESSION_MAX_RUNS):
+        self.template_folder = os.path.join(SUMO_FOLDER, template_folder)
         self.seed = seed
         self.av_rate = demand_profile.av_rate
         self.network_file = os.path.join(self.template_folder, net_file)
         self.toy = "toy" in self.network_file
-        # Parsing the net file:
-        self.lane_num = get_first_edge_lanenum(self.network_file)
-        self.ramps_num = get_num_ramps(self.network_file)
+        # Parsing the net file (once per process, see NetworkIndex):
+        self.network = get_network_index(self.network_file)
+        self.lane_num = self.network.first_edge_lanenum
+        self.ramps_num = self.network.num_ramps
         self.route_template = os.path.join(self.template_folder, route_temp)
         self.config_template = os.path.join(self.template_folder, cfg_temp)
         self.additional_template = os.path.join(self.template_folder, add_temp)
         self.gui = gui
+        self.engine = select_engine(engine, gui)
+        assert permission_mode in PERMISSION_MODES, f"Unknown permission mode {permission_mode}"
+        self.permission_mode = permission_mode
+        # static policies run as a plain sumo subprocess, see run_batch
+        self.batch = batch and not gui
+        # keep SUMO alive between the simulations of the worker, see SUMOSession
+        self.reuse_session = reuse_session and not gui
+        self.session_max_runs = session_max_runs
+        self._session = None
+        self.vtype_classes = {}
+        self.vtype_registry = VTypeRegistry()
+        self.demand_end = 0  # the end of the last flow of the route file
         self.demand_profile = demand_profile
         net_name = net_file.split(".")[0]
 
         self.config_folder = os.path.join(self.template_folder, net_name)
         os.makedirs(self.config_folder, exist_ok=True)
-        self.output_folder = os.path.join(curdir, output_folder, net_name, demand_profile.__str__(),
-                                          str(self.av_rate),
-                                          str(seed))
+        self.output_folder = experiment_folder(net_file, demand_profile, seed, output_folder)
         os.makedirs(self.output_folder, exist_ok=True)
         self.timestep = 0
-        # put a copy of the network file in the output folder
-        shutil.copyfile(self.network_file, os.path.join(curdir, output_folder, net_name, net_file))
+        self._connection = None
+        self._reset_snapshot()
+        if copy_net:
+            # a sweep copies it once, see copy_network
+            self.copy_network(net_file, template_folder, output_folder)
+
+    @staticmethod
+    def copy_network(net_file, template_folder="SUMOconfig", output_folder="outputs"):
+        # put a copy of the network file in the output folder, the results parser reads the PTL lanes from it
+        curdir = os.path.dirname(os.path.abspath(__file__))
+        net_output_folder = os.path.join(curdir, output_folder, net_file.split(".")[0])
+        os.makedirs(net_output_folder, exist_ok=True)
+        shutil.copyfile(os.path.join(curdir, template_folder, net_file), os.path.join(net_output_folder, net_file))
+
+    @property
+    def traci(self):
+        # the handle every TraCI call goes through, this simulation's labelled connection or the in-process libsumo
+        if self.engine == "libsumo":
+            return libsumo
+        return self._connection if self._connection is not None else traci
 
     def allow_vehicles(self, edge: str = None, veh_types=None, min_num_pass=0):
         if veh_types is None:
             veh_types = ["AV", "HD"]
 
-        left_edge = get_first_edge_id(self.network_file)
-        veh_ids = traci.vehicle.getIDList() if edge == "all" else \
-            traci.edge.getLastStepVehicleIDs(left_edge) if edge is None \
-                else traci.edge.getLastStepVehicleIDs(edge)
+        if edge is None:
+            # admission on the first edge is incremental, see _admit_departed and _switch_vtypes
+            if self.permission_mode == "vtype":
+                self._switch_vtypes(veh_types, min_num_pass)
+            else:
+                self._admit_departed(veh_types, min_num_pass)
+            return
 
+        registry = self.vtype_registry
+        kind_codes = registry.kind_codes(veh_types)
+        veh_ids = self._get_vehicle_ids() if edge == "all" else self._get_edge_vehicles(edge)
         for veh_id in veh_ids:
-            if traci.vehicle.getVehicleClass(veh_id) in ["bus", "private"]:
+            if self._get_vehicle_var(veh_id, tc.VAR_VEHICLECLASS) in ["bus", "private"]:
+                continue
+            code = registry.code(self._get_vehicle_var(veh_id, tc.VAR_TYPE))
+            if registry.bus[code]:
                 continue
-            veh_type = traci.vehicle.getTypeID(veh_id)
-            num_pass = int(veh_type.split("_")[1][0])
-            veh_type = veh_type.split("_")[0]
-            if veh_type.startswith("Bus"):
+            if registry.kind[code] not in kind_codes:
                 continue
-            if veh_type not in veh_types:
+            if registry.num_pass[code] >= min_num_pass:
+                self._set_private(veh_id)
+
+    def _set_private(self, veh_id):
+        self.traci.vehicle.setVehicleClass(veh_id, "private")
+        self.traci.vehicle.updateBestLanes(veh_id)
+        if veh_id in self._vehicles:
+            self._vehicles[veh_id][tc.VAR_VEHICLECLASS] = "private"
+
+    def _admit_departed(self, veh_types, min_num_pass):
+        # Only the vehicles that departed since the last call are examined, and the waiting ones only when
+        # min_num_pass moves down. Same result as scanning the first edge every call: vehicles enter the first
+        # edge only by departing on it, and an eligible vehicle is admitted the first time it is seen there.
+        first_edge = self.network.first_edge_id
+        table = self._admission
+        if table is None or table.veh_types != list(veh_types):
+            table = self._admission = AdmissionTable(veh_types, first_edge, min_num_pass, self.vtype_registry)
+            table.departed = list(self._get_edge_vehicles(first_edge))
+            # from now on the vehicles are examined as they depart, see _update_snapshot
+            self.traci.simulation.subscribe(SIMULATION_VARS)
+        on_first_edge = set(self._get_edge_vehicles(first_edge))
+
+        for veh_id in table.set_min_num_pass(min_num_pass):
+            if veh_id in on_first_edge:
+                self._set_private(veh_id)
+                table.admit(veh_id)
+
+        for veh_id in table.departed:
+            if veh_id not in on_first_edge:  # departed on a ramp
                 continue
-            if num_pass >= min_num_pass:
-                traci.vehicle.setVehicleClass(veh_id, "private")
-                traci.vehicle.updateBestLanes(veh_id)
+            # a vehicle departs in the vClass of its vType, its vType is read once
+            veh_type = self.traci.vehicle.getTypeID(veh_id)
+            if table.examine(veh_id, self.vtype_classes[veh_type], veh_type, first_edge):
+                self._set_private(veh_id)
+                table.admit(veh_id)
+        table.departed = []
+
+    def _switch_vtypes(self, veh_types, min_num_pass):
+        permissions = self._admission
+        if permissions is None:
+            permissions = self._admission = VTypePermissions(self.vtype_classes, self.network.first_edge_id,
+                                                             self.vtype_registry)
+        first_edge = permissions.first_edge
+        # nothing is kept per vehicle, the vehicles departing on ramps have frozen vTypes (see append_frozen_vtypes)
+        # and the ones on the first edge follow their vType: only the switches matter
+        switches = permissions.switches(veh_types, min_num_pass)
+        if not switches:
+            return
+        # only vehicles on the first edge follow their vType into the PTL, all the others keep their vClass
+        vehicles = self._read_all_vehicles((tc.VAR_TYPE, tc.VAR_ROAD_ID))
+        admitted = []
+        # the whole round is sent to SUMO as one message
+        with self._command_batch():
+            for veh_id, values in vehicles.items():
+                type_id = values[tc.VAR_TYPE]
+                if type_id not in switches:
+                    continue
+                if switches[type_id] == "private" and values[tc.VAR_ROAD_ID] == first_edge:
+                    admitted.append(veh_id)
+                else:
+                    self._freeze_vtype(veh_id, type_id, permissions.classes[type_id])
+            for type_id, veh_class in switches.items():
+                self.traci.vehicletype.setVehicleClass(type_id, veh_class)
+                permissions.classes[type_id] = veh_class
+            for veh_id in admitted:
+                self.traci.vehicle.updateBestLanes(veh_id)
+                if veh_id in self._vehicles:
+                    self._vehicles[veh_id][tc.VAR_VEHICLECLASS] = "private"
+
+    @contextlib.contextmanager
+    def _command_batch(self):
+        """
+        Send the commands of the block to SUMO in a single TraCI message when the block ends, instead of one round
+        trip per command. traci has no public API for it: _sendCmd appends every command to the message of the
+        connection and sends it right away, the block holds the sending back. Only commands whose answer is not
+        read (the setters) can run in the block. libsumo runs its commands in process, they need no batching
+        """
+        connection = self._connection
+        if self.engine == "libsumo" or connection is None:
+            yield
+            return
+        connection._sendExact = lambda: None
+        try:
+            yield
+        finally:
+            del connection._sendExact  # back to Connection._sendExact
+        if connection._queue:
+            connection._sendExact()
+
+    def _freeze_vtype(self, veh_id, type_id, veh_class):
+        frozen_type_id = f"{type_id}@{veh_class}"
+        self.traci.vehicle.setType(veh_id, frozen_type_id)
+        if veh_id in self._vehicles:
+            self._vehicles[veh_id][tc.VAR_TYPE] = frozen_type_id
 
     def get_state_dict(self, variable=None):
         state_dict = {}
-        PTL_lane_ids = get_PTL_lanes(self.network_file)
+        PTL_lane_ids = self.network.ptl_lane_ids
 
         # handle num_vehs variables
         if variable == "num_vehs":
-            return len(traci.vehicle.getIDList())
+            return len(self._get_vehicle_ids())
         elif variable == "num_vehs_ptl":
             return len([veh_id for lane in PTL_lane_ids for veh_id in
-                        traci.lane.getLastStepVehicleIDs(lane)])
+                        self._get_lane_vehicles(lane)])
+        elif variable == "ptl_speed":
+            # only the PTL vehicles are read
+            veh_ids_in_PTL = [veh_id for lane in PTL_lane_ids for veh_id in self._get_lane_vehicles(lane)]
+            return np.mean([self._get_vehicle_var(vehID, tc.VAR_SPEED) for vehID in veh_ids_in_PTL]) \
+                if len(veh_ids_in_PTL) > 0 else 26
         else:
-            state_dict["num_vehs"] = len(traci.vehicle.getIDList())
+            state_dict["num_vehs"] = len(self._get_vehicle_ids())
             state_dict["veh_ids_in_PTL"] = [veh_id for lane in PTL_lane_ids for veh_id in
-                                            traci.lane.getLastStepVehicleIDs(lane)]
+                                            self._get_lane_vehicles(lane)]
             state_dict["num_vehs_ptl"] = len(state_dict["veh_ids_in_PTL"])
 
         # handle speed varaibles
         if variable == "speed":
-            return np.mean([traci.vehicle.getSpeed(vehID) for vehID in traci.vehicle.getIDList()]) \
+            return np.mean([self._get_vehicle_var(vehID, tc.VAR_SPEED) for vehID in self._get_vehicle_ids()]) \
                 if state_dict["num_vehs"] > 0 else 26
-        elif variable == "ptl_speed":
-            return np.mean(
-                [traci.vehicle.getSpeed(vehID) for vehID in state_dict["veh_ids_in_PTL"]]) \
-                if state_dict["num_vehs_ptl"] > 0 else 26
         else:
             # get mean vehicles speed
-            state_dict["speed"] = np.mean([traci.vehicle.getSpeed(vehID) for vehID in traci.vehicle.getIDList()]) \
+            state_dict["speed"] = np.mean(
+                [self._get_vehicle_var(vehID, tc.VAR_SPEED) for vehID in self._get_vehicle_ids()]) \
                 if state_dict["num_vehs"] > 0 else 26
             state_dict["ptl_speed"] = np.mean(
-                [traci.vehicle.getSpeed(vehID) for vehID in state_dict["veh_ids_in_PTL"]]) \
+                [self._get_vehicle_var(vehID, tc.VAR_SPEED) for vehID in state_dict["veh_ids_in_PTL"]]) \
                 if state_dict["num_vehs_ptl"] > 0 else 26
 
         return state_dict
 
     def step(self):
-        traci.simulationStep(self.timestep)
+        self.traci.simulationStep(self.timestep)
         self.timestep += 1
+        self._update_snapshot()
+
+    @property
+    def admission_step(self):
+        # the longest advance between allow_vehicles calls that keeps the first edge admission exact, None for any.
+        # Per vehicle admission has to see every vehicle while it is on the first edge, per vType admission only
+        # acts on threshold changes (the ramp flows draw frozen vTypes).
+        if self.permission_mode == "vtype":
+            return None
+        return 1
+
+    def advance_target(self, wakeup=None):
+        """
+        The timestep to advance to before the policy runs again
+        :param wakeup: the timestep the policy asked to run at next, None if it never has to run again
+        :return: the target timestep, never past the last step a per second loop would reach - SUMO counts the
+         active flows in the expected vehicles, so the simulation can not finish before the demand ends
+        """
+        horizon = max(self.timestep + 1, self.demand_end)
+        if wakeup is None:
+            return horizon
+        return max(self.timestep + 1, min(wakeup, horizon))
+
+    def step_until(self, target):
+        # advance to timestep target with a single simulationStep
+        if target <= self.timestep + 1:
+            self.step()
+            return
+        # step() keeps SUMO one second behind timestep (simulationStep(0) and simulationStep(1) both stop at 1)
+        self.traci.simulationStep(target - 1)
+        self.timestep = target
+        self._update_snapshot()
 
     def isFinish(self):
-        return traci.simulation.getMinExpectedNumber() <= 0
+        if self._min_expected is None:
+            return self.traci.simulation.getMinExpectedNumber() <= 0
+        return self._min_expected <= 0
+
+    def _subscribe(self):
+        # the expected vehicles are always needed (isFinish), the rest is subscribed the first time an accessor
+        # reads it: the lanes and edges it asks for (e.g. the PTL lanes of ptl_speed, the state lanes of PTLenv) and
+        # the vehicles it reads a variable of. SUMO collects the departed and arrived ids over a whole multi-second
+        # advance, so they are only subscribed for the per vehicle admission (see _admit_departed)
+        self.traci.simulation.subscribe((tc.VAR_MIN_EXPECTED_VEHICLES,))
+        self._update_snapshot()
+
+    def _reset_snapshot(self):
+        self._vehicles, self._lanes, self._edges = {}, {}, {}
+        self._veh_ids = None
+        self._min_expected = None
+        self._admission = None
+
+    def _update_snapshot(self):
+        # read the batched subscription results of the last step, no round trips
+        sim_results = self.traci.simulation.getSubscriptionResults()
+        self._min_expected = sim_results[tc.VAR_MIN_EXPECTED_VEHICLES]
+        self._veh_ids = None
+        departed = sim_results.get(tc.VAR_DEPARTED_VEHICLES_IDS)
+        # libsumo and the reused sessions may still deliver the streams subscribed by an earlier simulation
+        if departed is not None and isinstance(self._admission, AdmissionTable):
+            arrived = sim_results[tc.VAR_ARRIVED_VEHICLES_IDS]
+            if arrived:
+                # after a multi-second advance the streams cover the whole advance, skip vehicles already gone
+                arrived_set = set(arrived)
+                departed = [veh_id for veh_id in departed if veh_id not in arrived_set]
+            self._admission.departed.extend(departed)
+            for veh_id in arrived:
+                self._admission.remove(veh_id)
+        # SUMO drops the subscriptions of the vehicles that arrived
+        self._vehicles = self.traci.vehicle.getAllSubscriptionResults()
+        self._lanes = self.traci.lane.getAllSubscriptionResults()
+        self._edges = self.traci.edge.getAllSubscriptionResults()
+
+    def _get_vehicle_ids(self):
+        # the order of getIDList is kept (speeds are averaged in this order), fetched at most once per step
+        if self._veh_ids is None:
+            self._veh_ids = self.traci.vehicle.getIDList()
+        return self._veh_ids
+
+    def _get_vehicle_var(self, veh_id, var):
+        values = self._vehicles.get(veh_id)
+        if values is None:
+            # read it on the next steps too: subscribe the vehicle, the answer holds its current values
+            self.traci.vehicle.subscribe(veh_id, VEHICLE_VARS)
+            values = self._vehicles[veh_id] = self.traci.vehicle.getSubscriptionResults(veh_id)
+        return values[var]
+
+    def _get_lane_vehicles(self, lane_id):
+        if lane_id not in self._lanes:
+            self.traci.lane.subscribe(lane_id, (tc.LAST_STEP_VEHICLE_ID_LIST,))
+            self._lanes[lane_id] = self.traci.lane.getSubscriptionResults(lane_id)
+        return self._lanes[lane_id][tc.LAST_STEP_VEHICLE_ID_LIST]
+
+    def _get_edge_vehicles(self, edge_id):
+        if edge_id not in self._edges:
+            self.traci.edge.subscribe(edge_id, (tc.LAST_STEP_VEHICLE_ID_LIST,))
+            self._edges[edge_id] = self.traci.edge.getSubscriptionResults(edge_id)
+        return self._edges[edge_id][tc.LAST_STEP_VEHICLE_ID_LIST]
+
+    def _read_all_vehicles(self, variables):
+        # variables of every vehicle in the network in two round trips, for the rare rounds that need them all:
+        # a context subscription around a junction that is dropped once read, so SUMO sends it only this step
+        junction = self.network.first_junction
+        self.traci.junction.subscribeContext(junction, tc.CMD_GET_VEHICLE_VARIABLE, NETWORK_RANGE, variables)
+        results = dict(self.traci.junction.getContextSubscriptionResults(junction) or {})
+        self.traci.junction.unsubscribeContext(junction, tc.CMD_GET_VEHICLE_VARIABLE, NETWORK_RANGE)
+        return results
 
     def close(self):
-        traci.close()
+        self._reset_snapshot()
+        if self._session is not None:
+            # ends the simulation and writes its outputs, SUMO waits for the next one
+            session, self._session = self._session, None
+            self._connection = None
+            release_session(session)
+            return
+        self.traci.close()
+        self._connection = None
 
     def init_simulation(self, policy):
         self.timestep = 0
+        self.demand_end = 0
         self.policy_name = policy.__str__()
         exp_config_folder = os.path.join(self.config_folder, self.demand_profile.__str__(), str(self.seed),
                                          self.policy_name)
         os.makedirs(exp_config_folder, exist_ok=True)
-        self.route_file = os.path.join(exp_config_folder, f"av_{self.av_rate}.rou.xml")
         self.config_file = os.path.join(exp_config_folder, f"av_{self.av_rate}.sumocfg")
         self.additional_file = os.path.join(exp_config_folder, f"av_{self.av_rate}.add.xml")
 
-        self.demand_profile.set_veh_amount(self.av_rate)
-
+        with _FILES_LOCK:
+            self.demand_profile.set_veh_amount(self.av_rate)
+            self._get_route_file(policy)
+        self.sumo_network_file = self.network_file
+        if self.runs_batch(policy) and policy.ptl_allowed is not None:
+            # bake the PTL permissions after_init_sumo sets over TraCI into a copy of the net
+            self.sumo_network_file = self._create_ptl_permissions_net(policy.ptl_allowed)
+        # the vType metadata by integer code, for the runtime lookups and the results parser
+        self.vtype_registry = VTypeRegistry(self.vtype_classes)
+        self.vtype_registry.write(os.path.join(self.output_folder, f"{self.policy_name}_vtypes.json"))
+        self._create_additional_file()
+        self._create_config_file()
+        if self.runs_batch(policy):
+            return
+        self._init_sumo()
+        self._subscribe()
+
+    def prepare_scenario(self, policy):
+        """
+        Generate the route file of the experiment into the route cache ahead of the simulation, init_simulation then
+        only writes the per-run config files (see utils/scenario_pipeline.py)
+        """
+        with _FILES_LOCK:
+            self.demand_profile.set_veh_amount(self.av_rate)
+            self._get_route_file(policy)
+
+    def runs_batch(self, policy):
+        return self.batch and policy.static
+
+    def run_batch(self):
+        """
+        Run the simulation prepared by init_simulation with sumo as a subprocess, without a TraCI connection
+        :return: the number of steps the TraCI loop would have run, one per CSV row
+        """
+        # the duration log holds the time SUMO ended at
+        sumo_cmd = [self._get_sumo_entrypoint(), "-c", self.config_file, "--no-step-log", "--duration-log.statistics"]
+        result = subprocess.run(sumo_cmd, capture_output=True, text=True, check=True)
+        end_time = re.search(r"Simulation ended at time: (\d+(?:\.\d+)?)", result.stdout)
+        assert end_time is not None, f"Could not find the end of the simulation in the output of {sumo_cmd}"
+        # the TraCI loop stops one step after SUMO ends (step() keeps SUMO one second behind timestep)
+        self.timestep = int(float(end_time.group(1))) + 1
+        return self.timestep
+
+    def output_files(self, policy):
+        policy_name = policy.__str__()
+        return [os.path.join(self.output_folder, policy_name + suffix)
+                for suffix in ["_tripinfo.xml", "_lanes.xml", "_vtypes.json", ".csv"]]
+
+    def simulated_demand(self):
+        # PassDemand fills its vehicle amounts in init_simulation, a copy of the demand as the simulation sees it
+        demand = copy.deepcopy(self.demand_profile)
+        demand.set_veh_amount(self.av_rate)
+        return demand
+
+    def fingerprint(self, policy):
+        # see simulation_fingerprint
+        return simulation_fingerprint(self.network.net_hash, self.simulated_demand(), self.seed, policy, self.engine,
+                                      self.permission_mode, self.batch, self.gui)
+
+    def _completion_marker(self, policy):
+        return completion_marker(self.output_folder, policy)
+
+    def is_complete(self, policy):
+        return read_completion_marker(self._completion_marker(policy), self.fingerprint(policy))
+
+    def mark_complete(self, policy, fingerprint):
+        # after close(), when SUMO has written the outputs
+        write_completion_marker(self._completion_marker(policy), fingerprint, self.output_files(policy))
+
+    def clear_completion(self, policy):
+        # a rerun overwrites the outputs, the marker and the results parsed from the previous ones are stale
+        exp_file = os.path.join(self.output_folder, policy.__str__())
+        for path in [self._completion_marker(policy), exp_file + "_ResultsParser.pkl"]:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(store_folder(exp_file), ignore_errors=True)
+
+    def _create_ptl_permissions_net(self, allowed):
+        allowed_name = "_".join(allowed) if allowed else "none"
+        net_name = os.path.basename(self.network_file).split(".")[0]
+        # keyed by the net content, so an edited net file never runs with a stale copy
+        ptl_net_file = os.path.join(self.config_folder,
+                                    f"{net_name}_PTL_{allowed_name}_{self.network.net_hash[:10]}.net.xml")
+        if not os.path.exists(ptl_net_file):
+            create_ptl_permissions_net(self.network_file, self.network.ptl_lane_ids, allowed, ptl_net_file)
+        return ptl_net_file
+
+    def _get_route_file(self, policy):
+        """
+        Set the route file of the experiment. Experiments with the same route inputs share one read-only route file
+        under SUMOconfig/<net>/routes/, generated by the first of them along with a sidecar holding the vType
+        classes and the end of the demand. The seed and output paths of a run are only in its config files
+        """
+        route_template = self._toy_route_template() if self.toy else self.route_template
+        key = params_hash(version=ROUTE_CACHE_VERSION, template=get_file_hash(route_template),
+                          net=self.network.net_hash, demand=object_params(self.demand_profile), av_rate=self.av_rate,
+                          # the toy route files draw nothing at random, the flow probabilities of the others do
+                          seed=None if self.toy else self.seed,
+                          veh_kinds=policy.veh_kinds, min_num_pass=policy.min_num_pass,
+                          endToEnd=None if self.toy else policy.endToEnd,
+                          arrival_split=policy.arrival_split if self.toy else None,
+                          permission_mode=self.permission_mode)
+        cache_folder = os.path.join(self.config_folder, ROUTE_CACHE_FOLDER)
+        os.makedirs(cache_folder, exist_ok=True)
+        self.route_file = os.path.join(cache_folder, f"{key}.rou.xml")
+        sidecar = os.path.join(cache_folder, f"{key}.json")
+
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                cached = json.load(f)
+            self.vtype_classes, self.demand_end = cached["vtype_classes"], cached["demand_end"]
+            if not self.toy:
+                # leave the global random state as the generation does, the RL resets draw their seeds from it
+                self._ramp_probabilities()
+            return
+
+        # generate to temporary files and rename, the sidecar last: the cache entry is complete once it exists
+        route_file = self.route_file
+        tmp_suffix = f".{os.getpid()}_{threading.get_ident()}.tmp"
+        self.route_file = route_file + tmp_suffix
         if self.toy:
             self._create_toy_rou_file(policy.min_num_pass, policy.veh_kinds, policy.arrival_split)
         else:
             self._create_route_file(policy.veh_kinds, policy.min_num_pass, policy.endToEnd)
-        self._create_additional_file()
-        self._create_config_file()
-        self._init_sumo()
+        os.replace(self.route_file, route_file)
+        self.route_file = route_file
+        with open(sidecar + tmp_suffix, "w") as f:
+            json.dump({"vtype_classes": self.vtype_classes, "demand_end": self.demand_end}, f)
+        os.replace(sidecar + tmp_suffix, sidecar)
+
+    def _ramp_probabilities(self):
+        np.random.seed(self.seed)
+        in_probs = np.random.uniform(0, 0.2, self.ramps_num)
+        out_probs = np.random.uniform(0, 0.2, self.ramps_num)
+        return in_probs, out_probs
 
     def _create_additional_file(self, period=60):
         tree = ET.parse(self.additional_template)
@@ -141,10 +594,13 @@ class SUMOAdapter:
 
         tree.write(self.additional_file)
 
-    def _append_flow(self, root, hour, in_j, out_j, prob, type_dist="vehicleDist", depart_lane=None, poisson=False, name=None):
+    def _append_flow(self, root, hour, in_j, out_j, prob, type_dist="vehicleDist", depart_lane=None, poisson=False, name=None,
+                     ramp=False):
 
         flow_id = f'flow{name}_{type_dist}_{hour}_{in_j}_{out_j}' if depart_lane is None else f'flow{name}_{type_dist}_{hour}_{in_j}_{out_j}_{depart_lane}'
-        flow = ET.Element('flow', id=flow_id, type=type_dist,
+        # with vType permissions the ramp flows draw vTypes frozen in their vClass, under the same flow ids
+        vtype_dist = RAMP_DIST if ramp and self.permission_mode == "vtype" and type_dist == "vehicleDist" else type_dist
+        flow = ET.Element('flow', id=flow_id, type=vtype_dist,
                           begin=str((hour - 6) * self.demand_profile.hour_len),
                           fromJunction=in_j, toJunction=out_j, end=str((hour - 5) * self.demand_profile.hour_len),
                           departSpeed=self.demand_profile.enter_speed)
@@ -156,21 +612,23 @@ class SUMOAdapter:
             flow.set('departLane', str(depart_lane))
         flow.tail = '\n\t'
         root.append(flow)
+        self.demand_end = max(self.demand_end, (hour - 5) * self.demand_profile.hour_len)
 
     def _create_route_file(self, veh_kinds=None, min_num_pass=None, endToEnd=False):
         tree = ET.parse(self.route_template)
         root = tree.getroot()
 
-        create_vType_dist(root, veh_kinds, min_num_pass, self.av_rate, self.demand_profile, endToEnd)
+        self.vtype_classes = create_vType_dist(root, veh_kinds, min_num_pass, self.av_rate, self.demand_profile,
+                                               endToEnd)
+        if self.permission_mode == "vtype":
+            append_frozen_vtypes(root, self.vtype_classes)
 
-        in_junc = get_first_junction(self.network_file)
-        out_juncs = get_last_junctions(self.network_file)
+        in_junc = self.network.first_junction
+        out_juncs = list(self.network.last_junctions)
         in_ramps = [f'i{i}' for i in range(1, self.ramps_num + 1)]
         out_ramps = [f'o{i}' for i in range(1, self.ramps_num + 1)]
 
-        np.random.seed(self.seed)
-        in_probs = np.random.uniform(0, 0.2, self.ramps_num)
-        out_probs = np.random.uniform(0, 0.2, self.ramps_num)
+        in_probs, out_probs = self._ramp_probabilities()
 
         out_juncs *= (len(self.demand_profile.veh_amount) - len(out_juncs) + 1 )
         for hour, hour_demand in self.demand_profile.veh_amount[0].items():
@@ -191,14 +649,15 @@ class SUMOAdapter:
                         left_in -= out_prob
                         flow_prob = total_arrival_prob * prob
                         if total_arrival_prob * self.demand_profile.hour_len > 1:
-                            self._append_flow(root, hour, in_ramp, out_ramp, flow_prob, poisson=True)
+                            self._append_flow(root, hour, in_ramp, out_ramp, flow_prob, poisson=True, ramp=True)
                             if total_arrival_prob * bus_veh_prop > 0:
                                 self._append_flow(root, hour, in_ramp, out_ramp, flow_prob * bus_veh_prop,
                                                   type_dist="busDist")
                         else:
                             print(f'hour {hour} in_ramp {in_ramp} out_ramp {out_ramp} prob {flow_prob}')
                     # In ramps to Out junction
-                    self._append_flow(root, hour, in_ramp, out_junc, total_arrival_prob * in_prob * left_in, poisson=True)
+                    self._append_flow(root, hour, in_ramp, out_junc, total_arrival_prob * in_prob * left_in, poisson=True,
+                                      ramp=True)
                     if total_arrival_prob * in_prob * left_in * bus_veh_prop > 0:
                         self._append_flow(root, hour, in_ramp, out_junc,
                                           total_arrival_prob * in_prob * left_in * bus_veh_prop,
@@ -233,6 +692,7 @@ class SUMOAdapter:
 
     def _create_toy_vType_dist(self, root, ptl_dist, non_ptl_dist):
         # Set vTypeDistribution to contain the probabilities of each vehicle type and the number of passengers
+        vtype_classes = {}
         for vTypeDist in root.findall('vTypeDistribution'):
             vTypeDist.text += '\t'
             if vTypeDist.attrib['id'].startswith('PTLDist'):
@@ -246,6 +706,7 @@ class SUMOAdapter:
                     elem = ET.Element('vType', id=veh_type, color='blue', probability=str(prob), vClass=veh_class)
                     elem.tail = '\n\t\t'
                     vTypeDist.append(elem)
+                    vtype_classes[veh_type] = veh_class
             elif vTypeDist.attrib['id'].startswith('NOPTLDist'):
                 if sum(non_ptl_dist.values()) == 0:
                     root.remove(vTypeDist)
@@ -257,6 +718,7 @@ class SUMOAdapter:
                     elem = ET.Element('vType', id=veh_type, color='red', probability=str(prob), vClass=veh_class)
                     elem.tail = '\n\t\t'
                     vTypeDist.append(elem)
+                    vtype_classes[veh_type] = veh_class
 
             elif vTypeDist.attrib['id'] == 'busDist':
                 for k, v in self.demand_profile.prob_pass_bus.items():
@@ -265,17 +727,21 @@ class SUMOAdapter:
                     elem = ET.Element('vType', id=f'Bus_{k}', probability=str(v), vClass='bus')
                     elem.tail = '\n\t\t'
                     vTypeDist.append(elem)
+                    vtype_classes[f'Bus_{k}'] = 'bus'
+        return vtype_classes
+
+    def _toy_route_template(self):
+        # the toy template lives next to the route template
+        return os.path.join(os.path.dirname(self.route_template), "toy_" + os.path.basename(self.route_template))
 
     def _create_toy_rou_file(self, min_num_pass=None, veh_kinds=None, arrival_split=False):
-        self.route_template = self.route_template.replace("route_template", "toy_route_template")
-        tree = ET.parse(self.route_template)
+        tree = ET.parse(self._toy_route_template())
         root = tree.getroot()
 
         # get the ptl and non-ptl lanes
-        in_lanes = get_first_edge_lanes(self.network_file)
-        in_lanes_indices = [l.getIndex() for l in in_lanes]
-        in_ptl_lane_indices = [l.getIndex() for l in in_lanes if is_PTL_Lane(l)]
-        not_ptl_lanes_indices = [l.getIndex() for l in in_lanes if not is_PTL_Lane(l)]
+        in_lanes = self.network.first_edge_lane_indices
+        in_ptl_lane_indices = self.network.first_edge_ptl_lane_indices
+        not_ptl_lanes_indices = [l for l in in_lanes if l not in in_ptl_lane_indices]
 
         if min_num_pass is None:
             min_num_pass = 6
@@ -300,10 +766,12 @@ class SUMOAdapter:
         ptl_dist = normalize_dict(ptl_dist)
         non_ptl_dist = normalize_dict(non_ptl_dist)
 
-        self._create_toy_vType_dist(root, ptl_dist, non_ptl_dist)
+        self.vtype_classes = self._create_toy_vType_dist(root, ptl_dist, non_ptl_dist)
+        if self.permission_mode == "vtype":
+            append_frozen_vtypes(root, self.vtype_classes)
 
-        in_junc = get_first_junction(self.network_file)
-        out_junc = get_last_junctions(self.network_file)
+        in_junc = self.network.first_junction
+        out_junc = self.network.last_junctions[0]  # toy networks have a single exit
 
         for hour, hour_demand in self.demand_profile.veh_amount.items():
             if hour_demand == 0:
@@ -349,7 +817,7 @@ class SUMOAdapter:
 
         # set net file
         net_file_pointer = root.find("input").find('net-file')
-        net_file_pointer.set('value', self.network_file)
+        net_file_pointer.set('value', self.sumo_network_file)
 
         # set additional file
         additional_file_pointer = root.find("input").find('additional-files')
@@ -367,34 +835,40 @@ class SUMOAdapter:
         tree.write(self.config_file)
 
     def _init_sumo(self):
-        sumo_binary = self._get_sumo_entrypoint()
+        # libsumo runs in this process, it only needs the options
+        sumo_binary = self._get_sumo_entrypoint() if self.engine == "traci" else "sumo"
         sumo_cmd = [sumo_binary, "-c", self.config_file]
         print(sumo_cmd)
-        traci.start(sumo_cmd)
+        if self.reuse_session:
+            self._session = acquire_session(self.engine, self.session_max_runs)
+            self._connection = self._session.open(sumo_cmd, self._start_sumo)
+        else:
+            self._connection = self._start_sumo(sumo_cmd)
+
+    def _start_sumo(self, sumo_cmd):
+        """
+        :return: the TraCI handle of the new simulation
+        """
+        if self.engine == "libsumo":
+            libsumo.start(sumo_cmd)
+            return libsumo
+        label = f"sim_{os.getpid()}_{next(_CONNECTION_LABELS)}"
+        with _START_LOCK:
+            traci.start(sumo_cmd, label=label, doSwitch=False)
+        return traci.getConnection(label)
 
     def _get_sumo_entrypoint(self):
-        if 'SUMO_HOME' in os.environ:
-            sumo_path = os.environ['SUMO_HOME']
-            # check operational system - if it is windows, use sumo.exe if linux/macos, use sumo
-            if os.name == 'nt':
-                sumo_binary = os.path.join(sumo_path, 'bin', 'sumo-gui.exe') if self.gui else \
-                    os.path.join(sumo_path, 'bin', 'sumo.exe')
-            else:
-                sumo_binary = os.path.join(sumo_path, 'bin', 'sumo-gui') if self.gui else \
-                    os.path.join(sumo_path, 'bin', 'sumo')
-        else:
-            raise Exception("please declare environment variable 'SUMO_HOME'")
-        return sumo_binary
+        return get_sumo_entrypoint(self.gui)
 
     def get_num_vehs(self, edge_ID=None, lane_ID=None):
         # return a tuple of (HD,AV,ALLOWED) num of vehicles
         if edge_ID:
-            veh_ids = traci.edge.getLastStepVehicleIDs(edge_ID)
+            veh_ids = self._get_edge_vehicles(edge_ID)
         else:
-            veh_ids = traci.lane.getLastStepVehicleIDs(lane_ID)
+            veh_ids = self._get_lane_vehicles(lane_ID)
         num_hd, num_av, num_allowed = 0, 0, 0
         for veh_id in veh_ids:
-            veh_class = traci.vehicle.getVehicleClass(veh_id)
+            veh_class = self._get_vehicle_var(veh_id, tc.VAR_VEHICLECLASS)
             if veh_class in ["bus", "private"]:
                 num_allowed += 1
             elif veh_class == "evehicle":
@@ -404,11 +878,10 @@ class SUMOAdapter:
         return num_hd, num_av, num_allowed
 
     def get_num_pass(self, edgeID=None, laneID=None):
-        veh_ids = traci.edge.getLastStepVehicleIDs(edgeID) if edgeID else traci.lane.getLastStepVehicleIDs(laneID)
-        num_pass = 0
-        for veh_id in veh_ids:
-            num_pass += int(traci.vehicle.getTypeID(veh_id).split("_")[1][0])
-        return num_pass
+        veh_ids = self._get_edge_vehicles(edgeID) if edgeID else self._get_lane_vehicles(laneID)
+        code = self.vtype_registry.code
+        num_pass = self.vtype_registry.num_pass
+        return sum(num_pass[code(self._get_vehicle_var(veh_id, tc.VAR_TYPE))] for veh_id in veh_ids)
 
 
 if __name__ == '__main__':
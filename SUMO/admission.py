@@ -0,0 +1,87 @@
+class AdmissionTable:
+    """
+    Per-vehicle admission state for the PTL, fed by the departed and arrived vehicle streams.
+    Vehicles are examined once when they depart on the first edge; the ones that are not eligible yet wait in
+    buckets by number of passengers and are only examined again when min_num_pass moves down to their bucket.
+    """
+
+    def __init__(self, veh_types, first_edge, min_num_pass, vtype_registry):
+        self.veh_types = list(veh_types)
+        self.first_edge = first_edge
+        self.min_num_pass = min_num_pass
+        self.vtype_registry = vtype_registry
+        self.kind_codes = vtype_registry.kind_codes(veh_types)
+        self.vehicles = {}  # veh_id -> (vType code, num_pass, admitted)
+        self.waiting = {}  # num_pass -> set of veh_ids on the first edge that were not admitted
+        self.departed = []  # vehicles departed since the last admission round
+
+    def examine(self, veh_id, veh_class, veh_type, road_id):
+        """
+        Register a new vehicle
+        :return: True if the vehicle has to be admitted to the PTL now
+        """
+        if veh_class in ["bus", "private"] or road_id != self.first_edge:
+            return False
+        registry = self.vtype_registry
+        code = registry.code(veh_type)
+        if registry.bus[code] or registry.kind[code] not in self.kind_codes:
+            return False
+        num_pass = registry.num_pass[code]
+        self.vehicles[veh_id] = (code, num_pass, False)
+        if num_pass >= self.min_num_pass:
+            return True
+        self.waiting.setdefault(num_pass, set()).add(veh_id)
+        return False
+
+    def admit(self, veh_id):
+        code, num_pass, _ = self.vehicles[veh_id]
+        self.vehicles[veh_id] = (code, num_pass, True)
+
+    def set_min_num_pass(self, min_num_pass):
+        """
+        Move the threshold, waiting vehicles that became eligible leave their buckets
+        :return: the vehicles that became eligible, they may have left the first edge since they departed
+        """
+        newly_eligible = []
+        for num_pass in range(min_num_pass, self.min_num_pass):
+            newly_eligible.extend(self.waiting.pop(num_pass, ()))
+        self.min_num_pass = min_num_pass
+        return newly_eligible
+
+    def remove(self, veh_id):
+        state = self.vehicles.pop(veh_id, None)
+        if state is not None:
+            self.waiting.get(state[1], set()).discard(veh_id)
+
+
+class VTypePermissions:
+    """
+    PTL permissions switched per vType instead of per vehicle, SUMO makes no per-vehicle vType clones.
+    A threshold change costs one vehicletype.setVehicleClass per vType that crosses it, plus per-vehicle calls to keep
+    the first edge admission semantics: the vehicles of those vTypes that must not follow the switch (the ones that
+    left the first edge since their vType was last switched, and the admitted ones when the threshold goes up) are
+    moved to the twin of their vType frozen in their current vClass (see append_frozen_vtypes), and the admitted
+    vehicles on the first edge get an updateBestLanes. Every vehicle is frozen at most once, so the calls of a
+    change grow with the vehicles of the switched vTypes that entered the network since their last switch.
+    """
+
+    def __init__(self, vtype_classes, first_edge, vtype_registry):
+        self.first_edge = first_edge
+        self.vtype_registry = vtype_registry
+        self.base_classes = {type_id: veh_class for type_id, veh_class in vtype_classes.items()
+                             if veh_class not in ["private", "bus"]}
+        self.classes = dict(self.base_classes)  # the current vClass of every switchable vType
+
+    def switches(self, veh_types, min_num_pass):
+        # the vTypes whose vClass has to change for this threshold, and their new vClass
+        registry = self.vtype_registry
+        kind_codes = registry.kind_codes(veh_types)
+        switches = {}
+        for type_id in self.base_classes:
+            code = registry.code(type_id)
+            if registry.kind[code] not in kind_codes:
+                continue
+            veh_class = "private" if registry.num_pass[code] >= min_num_pass else self.base_classes[type_id]
+            if self.classes[type_id] != veh_class:
+                switches[type_id] = veh_class
+        return switches
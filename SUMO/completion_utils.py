@@ -0,0 +1,83 @@
+"""
+Completion markers of the simulations, so an interrupted sweep can be resumed (main.py --resume).
+A run is keyed by a fingerprint of everything its outputs depend on: the net file content, the demand parameters,
+the seed, the policy parameters, the SUMO version and the way SUMO is run (permission mode, batch, engine). The
+marker is written next to the outputs once SUMO is closed, a run killed before that has no marker and is redone.
+"""
+import hashlib
+import json
+import os
+import subprocess
+from functools import lru_cache
+
+import numpy as np
+
+COMPLETION_MARKER_VERSION = 1
+
+# policy attributes that change while the simulation runs or hold the trained model, not parameters
+RUNTIME_ATTRIBUTES = ("agent", "current_min_num_pass", "running_sum")
+
+
+@lru_cache(maxsize=None)
+def get_sumo_version(sumo_binary):
+    # once per process, the first line of sumo --version is "Eclipse SUMO sumo Version <version>"
+    result = subprocess.run([sumo_binary, "--version"], capture_output=True, text=True, check=True)
+    return result.stdout.splitlines()[0].split("Version")[-1].strip()
+
+
+def object_params(obj, skip=()):
+    # the class and attributes of a demand or policy instance
+    params = {k: v for k, v in vars(obj).items() if k not in skip}
+    params["class"] = type(obj).__name__
+    return params
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    # never the repr (it holds the object address) nor the type name (two values would share a key)
+    raise TypeError(f"Can not hash a parameter of type {type(value).__name__}, it has to be serialized explicitly")
+
+
+def params_hash(**key):
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=_to_json).encode()).hexdigest()
+
+
+def run_fingerprint(**key):
+    return params_hash(version=COMPLETION_MARKER_VERSION, **key)
+
+
+def write_completion_marker(marker_file, fingerprint, output_files):
+    """
+    Record a completed run, written to a temporary file and renamed so a killed worker never leaves half a marker
+    :param output_files: the outputs of the run, their sizes are checked by read_completion_marker
+    """
+    marker = {"fingerprint": fingerprint,
+              "outputs": {os.path.basename(f): os.path.getsize(f) for f in output_files if os.path.exists(f)}}
+    tmp_file = f"{marker_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(marker, f)
+    os.replace(tmp_file, marker_file)
+
+
+def read_completion_marker(marker_file, fingerprint):
+    """
+    :return: True if the marker belongs to this fingerprint and the outputs it lists are still the complete ones
+    """
+    try:
+        with open(marker_file) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if marker.get("fingerprint") != fingerprint:
+        return False
+    folder = os.path.dirname(marker_file)
+    for name, size in marker["outputs"].items():
+        path = os.path.join(folder, name)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+    return True
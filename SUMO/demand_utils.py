@@ -1,5 +1,12 @@
 from xml.etree import ElementTree as ET
+
+
 def create_vType_dist(root, veh_kinds, min_num_pass, av_rate, demand_profile, endToEnd=False):
+    """
+    Fill the vTypeDistributions of the route template
+    :return: a dict of the written vType ids and their vClass
+    """
+    vtype_classes = {}
     if veh_kinds is None:
         veh_kinds = []
     if min_num_pass is None:
@@ -19,6 +26,7 @@ def create_vType_dist(root, veh_kinds, min_num_pass, av_rate, demand_profile, en
                 elem = ET.Element('vType', id=type_id, color='red', probability=str(prob), vClass=veh_class)
                 elem.tail = '\n\t\t'
                 vTypeDist.append(elem)
+                vtype_classes[type_id] = veh_class
             for k, v in demand_profile.prob_pass_av.items():
                 prob = round(av_prob * v, 5)
                 if prob == 0:
@@ -33,6 +41,7 @@ def create_vType_dist(root, veh_kinds, min_num_pass, av_rate, demand_profile, en
                 elem = ET.Element('vType', id=type_id, color='blue', probability=str(prob), vClass=veh_class)
                 elem.tail = '\n\t\t'
                 vTypeDist.append(elem)
+                vtype_classes[type_id] = veh_class
 
         elif vTypeDist.attrib['id'] == 'busDist':
             for k, v in demand_profile.prob_pass_bus.items():
@@ -40,4 +49,40 @@ def create_vType_dist(root, veh_kinds, min_num_pass, av_rate, demand_profile, en
                     continue
                 elem = ET.Element('vType', id=f'Bus_{k}', probability=str(v), vClass='bus')
                 elem.tail = '\n\t\t'
-                vTypeDist.append(elem)
\ No newline at end of file
+                vTypeDist.append(elem)
+                vtype_classes[f'Bus_{k}'] = 'bus'
+    return vtype_classes
+
+
+RAMP_DIST = "vehicleDist_ramps"
+
+
+def append_frozen_vtypes(root, vtype_classes):
+    """
+    Declare for every vType that can enter the PTL a twin per vClass it can have (<id>@private, <id>@<vClass>),
+    used to freeze the vClass of single vehicles when the vClass of their vType is switched, and the distribution
+    of the ramp flows (RAMP_DIST): the vTypes of vehicleDist frozen in their vClass, with the same probabilities so
+    the flows draw the same vehicles.
+    The '@' suffix is stripped by the results parser like the ones of the vType clones made by SUMO.
+    """
+    index = max(i for i, elem in enumerate(root) if elem.tag == 'vTypeDistribution') + 1
+    for type_id, veh_class in vtype_classes.items():
+        if veh_class in ["private", "bus"]:
+            continue
+        color = 'blue' if type_id.startswith("AV") else 'red'
+        for twin_class in ["private", veh_class]:
+            elem = ET.Element('vType', id=f"{type_id}@{twin_class}", color=color, vClass=twin_class)
+            elem.tail = '\n\n\t'
+            root.insert(index, elem)
+            index += 1
+    # vehicles departing on a ramp are never admitted to the PTL, they do not follow the switches of their vType
+    vehicle_dist = root.find("vTypeDistribution[@id='vehicleDist']")
+    if vehicle_dist is None or len(vehicle_dist) == 0:
+        return
+    type_ids = [elem.get('id') for elem in vehicle_dist]
+    type_ids = [type_id if vtype_classes[type_id] in ["private", "bus"] else f"{type_id}@{vtype_classes[type_id]}"
+                for type_id in type_ids]
+    elem = ET.Element('vTypeDistribution', id=RAMP_DIST, vTypes=" ".join(type_ids),
+                      probabilities=" ".join(elem.get('probability') for elem in vehicle_dist))
+    elem.tail = '\n\n\t'
+    root.insert(index, elem)
\ No newline at end of file
@@ -1,59 +1,164 @@
+import hashlib
+import os
+import pickle
+import threading
+from functools import lru_cache
+from xml.etree import ElementTree as ET
+
 import sumolib
 
+NETWORK_INDEX_VERSION = 1
+# one folder next to the source nets for every copy of them, a sidecar beside the copy in the outputs tree would be
+# taken for a demand by the results parser
+NETWORK_INDEX_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SUMOconfig", ".netindex")
+
+# per process memo of the network indexes, keyed by (path, mtime, size) of the net file
+_NETWORK_INDEXES = {}
+
+
+@lru_cache(maxsize=None)
+def read_net(network_file):
+    # parse the net file once per process, only needed by helpers that return sumolib objects
+    return sumolib.net.readNet(network_file)
+
+
+def get_file_hash(file_path):
+    sha = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class NetworkIndex:
+    """
+    Everything the simulation, the env and the results parser need from a net file.
+    Holds only ids and numbers, so it can be pickled to a sidecar keyed by the net file content hash
+    and loaded by pool workers without parsing the XML.
+    """
+
+    def __init__(self, network_file, net_hash=None):
+        self.net_hash = net_hash if net_hash else get_file_hash(network_file)
+        net = sumolib.net.readNet(network_file)
+
+        # junctions, sorted from left to right
+        junctions = net.getNodes()
+        self.first_junction = sorted(junctions, key=lambda x: x.getShape()[0][0])[0].getID()
+        max_x = max([j.getShape()[0][0] for j in junctions])
+        self.last_junctions = sorted([j.getID() for j in junctions if abs(j.getShape()[0][0] - max_x) <= 10])
+
+        # edges, sorted from left to right
+        edges = sorted(net.getEdges(), key=lambda x: x.getShape()[0][0])
+        self.edge_ids = [e.getID() for e in edges]
+        self.first_edge_id = self.edge_ids[0]
+        self.last_edge_id = self.edge_ids[-1]
+        self.edge_lanes = {e.getID(): [l.getID() for l in e.getLanes()] for e in edges}
+        self.num_ramps = len([e for e in edges if e.getID().startswith('Ei')])
+
+        # lanes
+        lanes_list = [l for e in net.getEdges() for l in e.getLanes()]  # keep the net file order
+        self.ptl_lane_ids = [l.getID() for l in lanes_list if is_PTL_Lane(l)]
+        self.lane_max_vehicles = {l.getID(): get_lane_max_vehicles(l) for l in lanes_list}
+        first_edge_lanes = edges[0].getLanes()
+        self.first_edge_lane_indices = [l.getIndex() for l in first_edge_lanes]
+        self.first_edge_ptl_lane_indices = [l.getIndex() for l in first_edge_lanes if is_PTL_Lane(l)]
+
+    @property
+    def first_edge_lanenum(self):
+        return len(self.edge_lanes[self.first_edge_id])
+
+    @property
+    def state_lane_ids(self):
+        # all the lanes before the last edge, ordered from left to right
+        return [lane for edge in self.edge_ids if edge != self.last_edge_id for lane in self.edge_lanes[edge]]
+
+    @property
+    def target_lane_ids(self):
+        return list(self.edge_lanes[self.last_edge_id])
+
+    @staticmethod
+    def sidecar_path(network_file, net_hash):
+        net_name = os.path.basename(network_file).split(".")[0]
+        return os.path.join(NETWORK_INDEX_FOLDER, f"{net_name}_{net_hash}.pkl")
+
+    @classmethod
+    def load(cls, network_file):
+        """
+        Load the index of a net file from its sidecar, building (and saving) it if it does not exist yet
+        :param network_file: path to the .net.xml file
+        :return: a NetworkIndex object
+        """
+        net_hash = get_file_hash(network_file)
+        sidecar = cls.sidecar_path(network_file, net_hash)
+        if os.path.exists(sidecar):
+            try:
+                with open(sidecar, "rb") as f:
+                    version, index = pickle.load(f)
+                if version == NETWORK_INDEX_VERSION:
+                    return index
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                pass  # corrupted sidecar, rebuild it
+        index = cls(network_file, net_hash)
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        # write to a temp file and rename, so concurrent workers never read a partial sidecar
+        tmp_path = f"{sidecar}.{os.getpid()}_{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((NETWORK_INDEX_VERSION, index), f)
+        os.replace(tmp_path, sidecar)
+        return index
+
+
+def get_network_index(network_file):
+    # memoized per process, rebuilt only if the net file changed
+    stat = os.stat(network_file)
+    key = (os.path.abspath(network_file), stat.st_mtime_ns, stat.st_size)
+    if key not in _NETWORK_INDEXES:
+        _NETWORK_INDEXES[key] = NetworkIndex.load(network_file)
+    return _NETWORK_INDEXES[key]
+
 
 def get_first_junction(network_file):
-    # retrive using sumolib the leftmost junction
-    net = sumolib.net.readNet(network_file)
-    junctions = net.getNodes()
-    junctions = sorted(junctions, key=lambda x: x.getShape()[0][0])
-    return junctions[0].getID()
+    # retrive the leftmost junction
+    return get_network_index(network_file).first_junction
 
 
 def get_last_junctions(network_file):
-    # retrive using sumolib the rightmost junction
-    net = sumolib.net.readNet(network_file)
-    junctions = net.getNodes()
-    max_x = max([j.getShape()[0][0] for j in junctions])
-    last_junctions = [j for j in junctions if abs(j.getShape()[0][0] - max_x) <= 10]
-    return sorted([j.getID() for j in last_junctions])
+    # retrive the rightmost junctions
+    return list(get_network_index(network_file).last_junctions)
 
 
 def get_edges(network_file):
-    # retrive using sumolib the leftmost edge and return its number of lanes
-    net = sumolib.net.readNet(network_file)
-    edges = net.getEdges()
-    edges = sorted(edges, key=lambda x: x.getShape()[0][0])
-    return edges
+    # retrive using sumolib the edges sorted from left to right
+    net = read_net(network_file)
+    return [net.getEdge(edge_id) for edge_id in get_network_index(network_file).edge_ids]
 
 
 def get_first_edge(network_file):
-    return get_edges(network_file)[0]
+    return read_net(network_file).getEdge(get_first_edge_id(network_file))
 
 
 def get_last_edge(network_file):
-    return get_edges(network_file)[-1]
+    return read_net(network_file).getEdge(get_network_index(network_file).last_edge_id)
 
 
 def get_first_edge_id(network_file):
-    # retrive using sumolib the leftmost edge and return its number of lanes
-    return get_first_edge(network_file).getID()
+    # retrive the leftmost edge id
+    return get_network_index(network_file).first_edge_id
 
 
 def get_first_edge_lanes(network_file):
-    # retrive using sumolib the leftmost edge and return its number of lanes
+    # retrive using sumolib the lanes of the leftmost edge
     return get_first_edge(network_file).getLanes()
 
 
 def get_first_edge_lanenum(network_file):
-    # retrive using sumolib the leftmost edge and return its number of lanes
-    return len(get_first_edge_lanes(network_file))
+    # retrive the number of lanes of the leftmost edge
+    return get_network_index(network_file).first_edge_lanenum
 
 
 def get_num_ramps(network_file):
-    # retrive using sumolib the number of ramps - ramps are junctions starting with 'i'
-    net = sumolib.net.readNet(network_file)
-    edges = net.getEdges()
-    return len([e for e in edges if e.getID().startswith('Ei')])
+    # retrive the number of ramps - ramps are junctions starting with 'i'
+    return get_network_index(network_file).num_ramps
 
 
 def is_PTL_Lane(lane):
@@ -61,11 +166,29 @@ def is_PTL_Lane(lane):
 
 
 def get_PTL_lanes(network_file):
-    # retrive using sumolib the number of ramps - ramps are junctions starting with 'i'
-    net = sumolib.net.readNet(network_file)
-    edges = net.getEdges()
-    lanes_list = [l for e in edges for l in e.getLanes()]
-    return [l.getID() for l in lanes_list if is_PTL_Lane(l)]
+    # retrive the ids of the PTL lanes
+    return list(get_network_index(network_file).ptl_lane_ids)
+
+
+def create_ptl_permissions_net(network_file, ptl_lane_ids, allowed, output_file):
+    """
+    Write a copy of the net file with the permissions of the PTL lanes replaced, like lane.setAllowed does over TraCI
+    :param allowed: list of vehicle classes, an empty list allows none of them
+    """
+    tree = ET.parse(network_file)
+    for lane in tree.getroot().iter("lane"):
+        if lane.get("id") not in ptl_lane_ids:
+            continue
+        lane.attrib.pop("allow", None)
+        lane.attrib.pop("disallow", None)
+        if allowed:
+            lane.set("allow", " ".join(allowed))
+        else:
+            lane.set("disallow", "all")
+    # write to a temp file and rename, concurrent workers may create the same net
+    tmp_path = f"{output_file}.{os.getpid()}_{threading.get_ident()}.tmp"
+    tree.write(tmp_path)
+    os.replace(tmp_path, output_file)
 
 
 def get_lane_max_vehicles(lane):
@@ -79,7 +202,7 @@ def get_num_lanes(edge):
 if __name__ == '__main__':
     network_file = "SUMOconfig/network_simple_right.net.xml"
     print(get_first_junction(network_file))
-    print(get_last_junction(network_file))
+    print(get_last_junctions(network_file))
     print(get_first_edge_lanenum(network_file))
     print(get_num_ramps(network_file))
     print(get_PTL_lanes(network_file))
@@ -0,0 +1,112 @@
+import atexit
+import os
+import tempfile
+import threading
+
+SESSION_MAX_RUNS = 50
+
+# a one-edge net the sessions idle on between the simulations
+IDLE_NET = """<net version="1.9" junctionCornerDetail="5" limitTurnSpeed="5.50">
+    <location netOffset="0.00,0.00" convBoundary="0.00,0.00,100.00,0.00" origBoundary="0.00,0.00,100.00,0.00" projParameter="!"/>
+    <edge id="idle" from="a" to="b" priority="-1">
+        <lane id="idle_0" index="0" speed="13.89" length="100.00" shape="0.00,-1.60 100.00,-1.60"/>
+    </edge>
+    <junction id="a" type="dead_end" x="0.00" y="0.00" incLanes="" intLanes="" shape="0.00,0.00 0.00,-3.20"/>
+    <junction id="b" type="dead_end" x="100.00" y="0.00" incLanes="idle_0" intLanes="" shape="100.00,-3.20 100.00,0.00"/>
+</net>
+"""
+
+# the idle sessions of the process, any thread of a worker can take one
+_IDLE_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+_ALL_SESSIONS = []
+
+
+def get_idle_net_file():
+    idle_net_file = os.path.join(tempfile.gettempdir(), "ptl_session_idle.net.xml")
+    if not os.path.exists(idle_net_file):
+        tmp_file = f"{idle_net_file}.{os.getpid()}_{threading.get_ident()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(IDLE_NET)
+        os.replace(tmp_file, idle_net_file)
+    return idle_net_file
+
+
+class SUMOSession:
+    """
+    A SUMO process kept alive between the simulations of a worker: the next experiment is loaded into it with load()
+    instead of starting a new process. Between experiments the session idles on a one-edge net, switching to it ends
+    the previous simulation and writes its outputs.
+    Restarted after max_runs simulations, or when the health check (a version round trip) fails.
+    """
+
+    def __init__(self, engine, max_runs=SESSION_MAX_RUNS):
+        self.engine = engine
+        self.max_runs = max_runs
+        self.connection = None
+        self.runs = 0
+
+    def open(self, sumo_cmd, start):
+        """
+        :param start: starts a new SUMO process for sumo_cmd and returns its TraCI handle
+        :return: the TraCI handle of the session, running sumo_cmd
+        """
+        if self.connection is not None and (self.runs >= self.max_runs or not self._healthy()):
+            self.stop()
+        if self.connection is None:
+            self.connection = start(sumo_cmd)
+            self.runs = 0
+        else:
+            self.connection.load(sumo_cmd[1:])
+        self.runs += 1
+        return self.connection
+
+    def _healthy(self):
+        try:
+            self.connection.getVersion()
+            return True
+        except Exception:
+            return False
+
+    def park(self):
+        # SUMO answers the load before it closes the previous simulation, its outputs are complete once it answers
+        # the next command
+        try:
+            self.connection.load(["-n", get_idle_net_file(), "--no-step-log"])
+            self.connection.getVersion()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass  # already gone
+        self.connection = None
+
+
+def acquire_session(engine, max_runs=SESSION_MAX_RUNS):
+    with _SESSIONS_LOCK:
+        idle = _IDLE_SESSIONS.setdefault(engine, [])
+        if idle:
+            return idle.pop()
+        session = SUMOSession(engine, max_runs)
+        _ALL_SESSIONS.append(session)
+        return session
+
+
+def release_session(session):
+    """
+    End the simulation of the session and make it available to the next one
+    """
+    session.park()
+    with _SESSIONS_LOCK:
+        _IDLE_SESSIONS[session.engine].append(session)
+
+
+@atexit.register
+def _stop_sessions():
+    for session in _ALL_SESSIONS:
+        if session.connection is not None:
+            session.stop()
@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+
+KINDS = ["HD", "AV", "Bus"]
+
+
+def parse_type_id(type_id):
+    # vType ids are <kind>_<num_pass>[_endToEnd][@<clone suffix>], e.g. AV_3, HD_1_endToEnd, Bus_7
+    parts = type_id.split("@")[0].split("_")
+    return parts[0], int(parts[1]), parts[-1] == "endToEnd"
+
+
+class VTypeRegistry:
+    """
+    Integer codes for the vType ids of a route file, written next to the simulation outputs.
+    Each code indexes the kind (KINDS index), number of passengers, bus and endToEnd lists, so the hot paths
+    look the vType metadata up by code instead of splitting the id strings.
+    Clones of a vType (<id>@<suffix>, made by SUMO or declared by append_frozen_vtypes) share its code.
+    """
+
+    def __init__(self, type_ids=()):
+        self.type_ids = []
+        self.labels = []  # <kind>_<num_pass>, the vType name used in the results
+        self.kind = []
+        self.num_pass = []
+        self.bus = []
+        self.end_to_end = []
+        self._codes = {}
+        for type_id in type_ids:
+            self.code(type_id)
+
+    def code(self, type_id):
+        code = self._codes.get(type_id)
+        if code is None:
+            if "@" in type_id:
+                code = self.code(type_id.split("@")[0])
+            else:
+                code = self._add(type_id)
+            self._codes[type_id] = code
+        return code
+
+    def _add(self, type_id):
+        kind, num_pass, end_to_end = parse_type_id(type_id)
+        self.type_ids.append(type_id)
+        self.labels.append(f"{kind}_{num_pass}")
+        self.kind.append(KINDS.index(kind) if kind in KINDS else -1)
+        self.num_pass.append(num_pass)
+        self.bus.append(kind.startswith("Bus"))
+        self.end_to_end.append(end_to_end)
+        return len(self.type_ids) - 1
+
+    def kind_codes(self, kinds):
+        return {KINDS.index(kind) for kind in kinds if kind in KINDS}
+
+    def decode(self, type_ids):
+        """
+        Codes of an array of vType ids, only the unique ids are looked up
+        :return: numpy array of codes, index the columns (e.g. np.asarray(registry.num_pass)) with it
+        """
+        unique_ids, inverse = np.unique(np.asarray(type_ids, dtype=object).astype(str), return_inverse=True)
+        return np.array([self.code(type_id) for type_id in unique_ids], dtype=np.int64)[inverse]
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump({"kinds": KINDS, "type_ids": self.type_ids, "kind": self.kind, "num_pass": self.num_pass,
+                       "bus": self.bus, "endToEnd": self.end_to_end}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)["type_ids"])
@@ -0,0 +1,77 @@
+"""
+Count the Python<->SUMO transitions (TraCI round trips) of a whole simulation when the policy runs every second
+against the event-driven runtime (main.simulate advancing to the policy next wake-up), and check that both
+write the same tripinfo.
+The threshold controller only wakes on its decisions with vType permissions. Per vehicle permissions have to see
+every vehicle on the first edge, so it still steps every second there, like OneVariableControl (a running sum of
+the PTL speed taken every second).
+Run from the repository root:
+    python -m benchmarks.controller_transitions --net_file Ayalon_Casestudy5 --demand DailyCaseStudy
+"""
+import argparse
+import hashlib
+import os
+import time
+
+from traci.connection import Connection
+
+import main
+from Demands.demand_parameters import create_demand_definitions
+from Policies.dynamic_step_handle_functions import OneVariableControl_threshold
+from Policies.static_step_handle_functions import StaticNumPass
+from SUMO.SUMOAdpater import SUMOAdapter
+
+ROUND_TRIPS = [0]
+_send_exact = Connection._sendExact
+
+
+def _counting_send_exact(self):
+    ROUND_TRIPS[0] += 1
+    return _send_exact(self)
+
+
+def tripinfo_hash(sumo, policy):
+    with open(os.path.join(sumo.output_folder, f"{policy}_tripinfo.xml"), "rb") as f:
+        data = f.read()
+    return hashlib.md5(data[data.index(b"-->"):]).hexdigest()  # skip the header with the date
+
+
+def run(demand, args, make_policy, permission_mode, every_second):
+    policy = make_policy()
+    if every_second:
+        policy.next_wakeup = lambda env: env.timestep + 1
+    sumo = SUMOAdapter(demand, args.seed, net_file=args.net_file + ".net.xml", permission_mode=permission_mode)
+    ROUND_TRIPS[0] = 0
+    start = time.time()
+    main.simulate((sumo, policy, False), logger=None)
+    return ROUND_TRIPS[0], time.time() - start, tripinfo_hash(sumo, policy)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="SUMO transitions, per second loop vs event-driven runtime")
+    parser.add_argument("--net_file", type=str, default="Ayalon_Casestudy5")
+    parser.add_argument("--demand", type=str, default="DailyCaseStudy")
+    parser.add_argument("--av_rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    demand_definition = create_demand_definitions(av_rate_range=[args.av_rate])[args.demand]
+    demand = demand_definition["class"](**demand_definition["params"][0])
+    policies = {
+        "StaticNumPass_3": lambda: StaticNumPass(min_num_pass=3, av_rate=args.av_rate),
+        "OneVariableControl_threshold_60": lambda: OneVariableControl_threshold(args.av_rate, "ptl_speed", 20, 60,
+                                                                                True),
+    }
+    Connection._sendExact = _counting_send_exact
+    for name, make_policy in policies.items():
+        for permission_mode in ["vehicle", "vtype"]:
+            every_trips, every_time, every_hash = run(demand, args, make_policy, permission_mode, True)
+            event_trips, event_time, event_hash = run(demand, args, make_policy, permission_mode, False)
+            assert every_hash == event_hash, f"{name} ({permission_mode}) differs between the two runtimes"
+            print(f"{name} ({permission_mode} permissions): {every_trips} -> {event_trips} round trips, "
+                  f"{every_time:.1f}s -> {event_time:.1f}s")
+    Connection._sendExact = _send_exact
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,50 @@
+"""
+Compare the simulation speed (steps per second) of the traci socket engine and the in-process libsumo engine.
+Run from the repository root:
+    python -m benchmarks.engine_steps_per_second --steps 3600
+"""
+import argparse
+import time
+
+from Demands.demand_parameters import create_demand_definitions
+from Policies.dynamic_step_handle_functions import OneVariableControl_threshold
+from SUMO.SUMOAdpater import SUMOAdapter, ENGINES
+
+SCENARIOS = [("network_toy", "DemandToy"), ("Ayalon_Casestudy5", "DailyCaseStudy")]
+
+
+def steps_per_second(net_file, demand, engine, seed, steps):
+    sumo = SUMOAdapter(demand, seed, net_file=net_file + ".net.xml", engine=engine)
+    policy = OneVariableControl_threshold(av_rate=demand.av_rate, variable="ptl_speed", param_threshold=20,
+                                          decision_rate=60, inverse=True)
+    sumo.init_simulation(policy)
+    policy.after_init_sumo(sumo)
+    start = time.perf_counter()
+    while not sumo.isFinish() and sumo.timestep < steps:
+        policy.handle_step(sumo)
+        sumo.step()
+    elapsed = time.perf_counter() - start
+    sumo.close()
+    return sumo.timestep / elapsed, sumo.engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Steps per second of the SUMO engines")
+    parser.add_argument("--av_rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--steps", type=int, default=3600)
+    args = parser.parse_args()
+
+    demand_definitions = create_demand_definitions(av_rate_range=[args.av_rate])
+    results = []
+    for net_file, demand_name in SCENARIOS:
+        demand = demand_definitions[demand_name]["class"](**demand_definitions[demand_name]["params"][0])
+        for engine in ENGINES:
+            sps, used_engine = steps_per_second(net_file, demand, engine, args.seed, args.steps)
+            results.append((net_file, used_engine, sps))
+    for net_file, engine, sps in results:
+        print(f"{net_file:<20} {engine:<8} {sps:10.1f} steps/s")
+
+
+if __name__ == '__main__':
+    main()
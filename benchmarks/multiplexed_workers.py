@@ -0,0 +1,60 @@
+"""
+Compare the aggregate simulation speed (steps per second over all simulations) of one simulation per worker process
+against workers that interleave several simulations over labelled TraCI connections (main.simulate_many).
+Run from the repository root, on a box with many cores:
+    python -m benchmarks.multiplexed_workers --num_processes 32 --sims_per_worker 1 2 4 --num_sims 128
+"""
+import argparse
+import time
+from multiprocessing.pool import Pool
+
+import main
+from Demands.demand_parameters import create_demand_definitions
+from Policies.dynamic_step_handle_functions import OneVariableControl_threshold
+from SUMO.SUMOAdpater import SUMOAdapter
+from utils.task_spec import TaskSpec
+
+
+def run_group(tasks):
+    # the task group of a sweep worker, returns the number of steps it simulated
+    errors = main.simulate_many(tasks)
+    failed = [error for error in errors if error]
+    if failed:
+        raise RuntimeError(failed[0]["traceback"])
+    # the adapters were built in this worker, on the tasks it received
+    return sum(task.sumo.timestep for task in tasks)
+
+
+def aggregate_steps_per_second(tasks, num_processes, sims_per_worker):
+    groups = [tasks[i:i + sims_per_worker] for i in range(0, len(tasks), sims_per_worker)]
+    start = time.perf_counter()
+    with Pool(num_processes) as pool:
+        steps = sum(pool.imap_unordered(run_group, groups))
+    return steps / (time.perf_counter() - start)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Aggregate steps per second, process per simulation vs interleaved")
+    parser.add_argument("--net_file", type=str, default="network_toy")
+    parser.add_argument("--demand", type=str, default="DemandToy")
+    parser.add_argument("--av_rate", type=float, default=0.5)
+    parser.add_argument("--num_processes", type=int, default=None)
+    parser.add_argument("--sims_per_worker", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num_sims", type=int, default=16)
+    args = parser.parse_args()
+
+    demand_definition = create_demand_definitions(av_rate_range=[args.av_rate])[args.demand]
+    net_file = args.net_file + ".net.xml"
+    SUMOAdapter.copy_network(net_file)
+    policy_params = {"av_rate": args.av_rate, "variable": "ptl_speed", "param_threshold": 20, "decision_rate": 60,
+                     "inverse": True}
+    for sims_per_worker in args.sims_per_worker:
+        tasks = [TaskSpec(demand_definition["class"], demand_definition["params"][0], seed,
+                          OneVariableControl_threshold, policy_params, net_file)
+                 for seed in range(args.num_sims)]
+        sps = aggregate_steps_per_second(tasks, args.num_processes, sims_per_worker)
+        print(f"{sims_per_worker} simulations per worker: {sps:10.1f} steps/s")
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,84 @@
+"""
+Compare the PTLEnv observation modes: env steps per second with random actions, and the learner throughput
+(timesteps per second of agent.learn) of the dict observations with MultiInputPolicy against the flat
+observation vector with MlpPolicy. Also checks that both modes observe the same numbers.
+Run from the repository root:
+    python -m benchmarks.ptl_env_throughput --net_file Ayalon_Casestudy5 --demand DailyCaseStudy --steps 2000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from Demands.demand_parameters import create_demand_definitions
+from Policies.RL_step_handle_function import RLAgent
+from SUMO.SUMOAdpater import SUMOAdapter
+from env.PTLenv import PTLEnv, OBS_MODES
+
+
+def make_env(args, demand, obs_mode):
+    sumo = SUMOAdapter(demand, args.seed, net_file=args.net_file + ".net.xml", engine=args.engine)
+    env = PTLEnv(sumo, train=False, obs_mode=obs_mode)
+    policy = RLAgent(av_rate=demand.av_rate, act_rate=args.act_rate, agent_type=args.agent_type, obs_mode=obs_mode)
+    policy.after_init_sumo(env)
+    return env, policy
+
+
+def flatten(env, state):
+    # the dict observation in the layout of the flat one
+    if env.obs_mode == "flat":
+        return state.copy()
+    lanes = [state[f"{lane}_{kind}"][0] for lane in env.state_lanes for kind in ["HD", "AV", "ALLOWED"]]
+    return np.array(lanes + [state["current_min_num_pass"] / 6, state["time_since_change"][0]], dtype=np.float32)
+
+
+def env_steps(args, demand, obs_mode):
+    env, _ = make_env(args, demand, obs_mode)
+    actions = np.random.default_rng(args.seed).integers(0, 3, args.steps)
+    observations = [flatten(env, env.reset()[0])]
+    start = time.perf_counter()
+    for action in actions:
+        state, _, done, _, _ = env.step(action)
+        observations.append(flatten(env, state))
+        if done:
+            break
+    elapsed = time.perf_counter() - start
+    env.close()
+    return (len(observations) - 1) / elapsed, np.array(observations)
+
+
+def learner_steps(args, demand, obs_mode):
+    env, policy = make_env(args, demand, obs_mode)
+    env.reset()
+    start = time.perf_counter()
+    policy.agent.learn(total_timesteps=args.learn_steps)
+    elapsed = time.perf_counter() - start
+    env.close()
+    return args.learn_steps / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PTLEnv throughput, dict vs flat observations")
+    parser.add_argument("--net_file", type=str, default="network_toy")
+    parser.add_argument("--demand", type=str, default="DemandToy")
+    parser.add_argument("--av_rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--engine", type=str, default="libsumo")
+    parser.add_argument("--act_rate", type=int, default=1)
+    parser.add_argument("--agent_type", type=str, default="PPO")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--learn_steps", type=int, default=2048)  # one PPO rollout
+    args = parser.parse_args()
+
+    demand_definition = create_demand_definitions(av_rate_range=[args.av_rate])[args.demand]
+    demand = demand_definition["class"](**demand_definition["params"][0])
+    observations = {}
+    for obs_mode in OBS_MODES:
+        sps, observations[obs_mode] = env_steps(args, demand, obs_mode)
+        learn_sps = learner_steps(args, demand, obs_mode)
+        print(f"{obs_mode:<5} env {sps:8.1f} steps/s, {args.agent_type} learner {learn_sps:8.1f} timesteps/s")
+    assert np.allclose(observations["dict"], observations["flat"], atol=1e-6), "The observation modes differ"
+
+
+if __name__ == '__main__':
+    main()
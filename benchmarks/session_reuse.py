@@ -0,0 +1,54 @@
+"""
+Compare the per-experiment overhead of starting a new SUMO process for every simulation with loading the simulations
+into a reused one (--reuse_session). Every run initializes the simulation, steps it a few times and closes it, so the
+time is dominated by the SUMO start (or load) and the shutdown.
+Run from the repository root:
+    python -m benchmarks.session_reuse --runs 20
+"""
+import argparse
+import time
+
+from Demands.demand_parameters import create_demand_definitions
+from Policies.static_step_handle_functions import Nothing
+from SUMO.SUMOAdpater import SUMOAdapter, ENGINES
+
+SCENARIOS = [("network_toy", "DemandToy"), ("Ayalon_Casestudy5", "DailyCaseStudy")]
+
+
+def seconds_per_run(net_file, demand, engine, reuse_session, seed, runs, steps):
+    elapsed = 0
+    for _ in range(runs):
+        sumo = SUMOAdapter(demand, seed, net_file=net_file + ".net.xml", engine=engine, reuse_session=reuse_session)
+        policy = Nothing()
+        start = time.perf_counter()
+        sumo.init_simulation(policy)
+        for _ in range(steps):
+            sumo.step()
+        sumo.close()
+        elapsed += time.perf_counter() - start
+    return elapsed / runs, sumo.engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-experiment overhead of new and reused SUMO processes")
+    parser.add_argument("--av_rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    demand_definitions = create_demand_definitions(av_rate_range=[args.av_rate])
+    results = []
+    for net_file, demand_name in SCENARIOS:
+        demand = demand_definitions[demand_name]["class"](**demand_definitions[demand_name]["params"][0])
+        for engine in ENGINES:
+            for reuse_session in [False, True]:
+                seconds, used_engine = seconds_per_run(net_file, demand, engine, reuse_session, args.seed, args.runs,
+                                                       args.steps)
+                results.append((net_file, used_engine, "reused" if reuse_session else "new", seconds))
+    for net_file, engine, process, seconds in results:
+        print(f"{net_file:<20} {engine:<8} {process:<7} {seconds * 1000:10.1f} ms/run")
+
+
+if __name__ == '__main__':
+    main()
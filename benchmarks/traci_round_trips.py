@@ -0,0 +1,92 @@
+"""
+Count the TraCI round trips per simulation step of the SUMOAdapter accessors (subscription snapshot)
+against the per-vehicle queries they replaced, and check that both return the same numbers.
+Run from the repository root:
+    python -m benchmarks.traci_round_trips --net_file Ayalon_Casestudy5 --demand DailyCaseStudy --steps 3600
+"""
+import argparse
+
+import numpy as np
+from traci.connection import Connection
+
+from Demands.demand_parameters import create_demand_definitions
+from Policies.static_step_handle_functions import StaticNumPass
+from SUMO.SUMOAdpater import SUMOAdapter
+
+ROUND_TRIPS = [0]
+_send_exact = Connection._sendExact
+
+
+def _counting_send_exact(self):
+    ROUND_TRIPS[0] += 1
+    return _send_exact(self)
+
+
+def legacy_state(sumo):
+    # the accessors as they were before the subscriptions: one query per vehicle
+    traci = sumo.traci
+    veh_ids = traci.vehicle.getIDList()
+    ptl_veh_ids = [veh_id for lane in sumo.network.ptl_lane_ids for veh_id in traci.lane.getLastStepVehicleIDs(lane)]
+    state = [len(veh_ids), len(ptl_veh_ids),
+             np.mean([traci.vehicle.getSpeed(v) for v in veh_ids]) if veh_ids else 26,
+             np.mean([traci.vehicle.getSpeed(v) for v in ptl_veh_ids]) if ptl_veh_ids else 26]
+    for lane in sumo.network.lane_max_vehicles:
+        lane_veh_ids = traci.lane.getLastStepVehicleIDs(lane)
+        classes = [traci.vehicle.getVehicleClass(v) for v in lane_veh_ids]
+        state.append((sum(c not in ["bus", "private", "evehicle"] for c in classes),
+                      sum(c == "evehicle" for c in classes),
+                      sum(c in ["bus", "private"] for c in classes)))
+        state.append(sum(int(traci.vehicle.getTypeID(v).split("_")[1][0]) for v in lane_veh_ids))
+    return state
+
+
+def snapshot_state(sumo):
+    state_dict = sumo.get_state_dict()
+    state = [state_dict["num_vehs"], state_dict["num_vehs_ptl"], state_dict["speed"], state_dict["ptl_speed"]]
+    for lane in sumo.network.lane_max_vehicles:
+        state.append(sumo.get_num_vehs(lane_ID=lane))
+        state.append(sumo.get_num_pass(laneID=lane))
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TraCI round trips per step, snapshot vs per-vehicle queries")
+    parser.add_argument("--net_file", type=str, default="Ayalon_Casestudy5")
+    parser.add_argument("--demand", type=str, default="DailyCaseStudy")
+    parser.add_argument("--av_rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--steps", type=int, default=3600)
+    args = parser.parse_args()
+
+    demand_definition = create_demand_definitions(av_rate_range=[args.av_rate])[args.demand]
+    demand = demand_definition["class"](**demand_definition["params"][0])
+    sumo = SUMOAdapter(demand, args.seed, net_file=args.net_file + ".net.xml")
+    sumo.init_simulation(StaticNumPass(min_num_pass=3, av_rate=args.av_rate))
+    Connection._sendExact = _counting_send_exact
+
+    step_trips, legacy_trips, snapshot_trips = 0, 0, 0
+    while not sumo.isFinish() and sumo.timestep < args.steps:
+        ROUND_TRIPS[0] = 0
+        sumo.step()
+        step_trips += ROUND_TRIPS[0]
+
+        ROUND_TRIPS[0] = 0
+        legacy = legacy_state(sumo)
+        legacy_trips += ROUND_TRIPS[0]
+
+        ROUND_TRIPS[0] = 0
+        snapshot = snapshot_state(sumo)
+        snapshot_trips += ROUND_TRIPS[0]
+        assert legacy == snapshot, f"Snapshot differs from the per-vehicle queries at step {sumo.timestep}"
+
+    Connection._sendExact = _send_exact
+    sumo.close()
+    steps = max(sumo.timestep, 1)
+    print(f"{steps} steps of {demand} on {args.net_file}")
+    print(f"round trips per step, per-vehicle queries: {legacy_trips / steps:.1f}")
+    print(f"round trips per step, subscriptions:       {(step_trips + snapshot_trips) / steps:.1f} "
+          f"({step_trips / steps:.1f} in step(), {snapshot_trips / steps:.1f} in the accessors)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Compare the streaming tripinfo parser of ResultsParser (into its results store) with the DOM parser it replaced on a
+synthetic tripinfo output, in time and peak memory (each parser runs in its own process), and check that both return
+the same DataFrame.
+Run from the repository root:
+    python -m benchmarks.tripinfo_parser --trips 500000
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from results.parse_exp_results import ResultsParser
+from SUMO.vtype_registry import VTypeRegistry
+
+TRIPINFO_LINE = ('    <tripinfo id="flow_{i}" depart="{depart:.2f}" departLane="E6_0" departPos="5.10" '
+                 'departSpeed="2.94" departDelay="{depart_delay:.2f}" arrival="{arrival:.2f}" arrivalLane="E7_0" '
+                 'arrivalPos="496.00" arrivalSpeed="22.50" duration="{duration:.2f}" routeLength="994.90" '
+                 'waitingTime="0.00" waitingCount="0" stopTime="0.00" timeLoss="{time_loss:.2f}" rerouteNo="1" '
+                 'devices="tripinfo_flow_{i} routing_flow_{i}" vType="{vtype}" speedFactor="0.93" vaporized=""/>\n')
+VTYPES = ["HD_1", "HD_2", "AV_1", "AV_3", "HD_1_endToEnd", "Bus_30", "AV_2@flow_0"]
+
+
+def write_tripinfo(path, trips, seed=42):
+    rng = np.random.default_rng(seed)
+    depart = np.sort(rng.uniform(0, 3600 * 12, trips))
+    duration = rng.uniform(30, 600, trips)
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tripinfos>\n')
+        for i in range(trips):
+            f.write(TRIPINFO_LINE.format(i=i, depart=depart[i], depart_delay=rng.uniform(0, 60),
+                                         arrival=depart[i] + duration[i], duration=duration[i],
+                                         time_loss=rng.uniform(0, 120), vtype=VTYPES[i % len(VTYPES)]))
+        f.write('</tripinfos>\n')
+
+
+def legacy_tripinfo(tripinfo_file):
+    # the DOM parser ResultsParser used before the streaming reader
+    root = ET.parse(tripinfo_file).getroot()
+    dict = {"duration": [], "departDelay": [], "routeLength": [], "vType": [], "timeLoss": [], "id": []}
+    for tripinfo in root.findall('tripinfo'):
+        for key in dict.keys():
+            dict[key].append(tripinfo.get(key))
+    df = pd.DataFrame(dict)
+    df["departDelay"] = df.departDelay.astype(float)
+    df["totalDelay"] = df.departDelay.astype(float) + df.timeLoss.astype(float)
+    vtype_registry = VTypeRegistry()
+    codes = vtype_registry.decode(df["vType"].values)
+    df["numPass"] = np.asarray(vtype_registry.num_pass, dtype=int)[codes]
+    df["vType"] = np.asarray(vtype_registry.labels, dtype=object)[codes]
+    df["duration"] = df["duration"].astype(float)
+    df["passDelay"] = df["totalDelay"] * df["numPass"]
+    df["passDuration"] = df["duration"] * df["numPass"]
+    df["timeLoss"] = df["timeLoss"].astype(float)
+    return df[["id", "vType", "numPass", "duration", "totalDelay", "passDelay", "passDuration", "timeLoss",
+               "departDelay"]]
+
+
+def streaming_tripinfo(tripinfo_file):
+    # converts the trips into the results store and reads the frame back from it
+    exp_file = tripinfo_file[:-len("_tripinfo.xml")]
+    return ResultsParser(exp_file, PTL_lanes=[]).tripinfo_df
+
+
+def measure(parse, tripinfo_file):
+    start = time.perf_counter()
+    df = parse(tripinfo_file)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    return df, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time and peak memory of the tripinfo parsers")
+    parser.add_argument("--trips", type=int, default=500000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # laid out like the outputs, <demand>/<av rate>/<seed>/<policy>
+        tripinfo_file = os.path.join(folder, "Bench", "0.5", "1", "Nothing_tripinfo.xml")
+        os.makedirs(os.path.dirname(tripinfo_file))
+        write_tripinfo(tripinfo_file, args.trips)
+        size = os.path.getsize(tripinfo_file) / 2 ** 20
+        results = {}
+        for name, parse in [("dom", legacy_tripinfo), ("streaming", streaming_tripinfo)]:
+            # a fresh process per parser, the peak memory of one does not hide the other
+            with Pool(1, maxtasksperchild=1) as pool:
+                results[name] = pool.apply(measure, (parse, tripinfo_file))
+    pd.testing.assert_frame_equal(results["dom"][0], results["streaming"][0])
+    print(f"{args.trips} trips, {size:.0f} MB, same DataFrame")
+    for name, (_, elapsed, peak) in results.items():
+        print(f"{name:<10} {elapsed:8.2f} s {peak:10.0f} MB peak")
+
+
+if __name__ == '__main__':
+    main()
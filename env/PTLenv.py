@@ -9,19 +9,34 @@ from SUMO.netfile_utils import *
 from Policies.static_step_handle_functions import StaticNumPass
 
 NUM_ACTIONS = 3
+OBS_MODES = ["dict", "flat"]
 
 
 class PTLEnv(gym.Env):
-    def __init__(self, sumo: SUMOAdapter, train: bool = True):
+    def __init__(self, sumo: SUMOAdapter, train: bool = True, obs_mode: str = "dict"):
+        assert obs_mode in OBS_MODES, f"Unknown observation mode {obs_mode}, has to be one of {OBS_MODES}"
         self.sumo = sumo
+        self.obs_mode = obs_mode
         self.state_lanes = None
         self.target_lanes = None
-        self.observation_space = self._set_observations()
-        self.observation_space.spaces = OrderedDict(sorted(self.observation_space.spaces.items()))
+        self.lane_max_vehicles = None
+        if obs_mode == "flat":
+            self.observation_space = self._set_flat_observations()
+        else:
+            self.observation_space = self._set_observations()
+            self.observation_space.spaces = OrderedDict(sorted(self.observation_space.spaces.items()))
+        # constant over the simulation, computed once
+        self.lane_capacities = np.array([self.lane_max_vehicles[lane] for lane in self.state_lanes], dtype=np.float32)
+        self.reward_normaliser = sum([self.lane_max_vehicles[lane] * 5 for lane in self.target_lanes])
         self.action_space = gym.spaces.Discrete(NUM_ACTIONS)
         self.action_mapping = [-1, 0, 1]  # 0: -1, 1:0, 2:+1
 
-        self.state = self.observation_space.sample()
+        if obs_mode == "flat":
+            # one preallocated vector: HD, AV, ALLOWED share of every state lane, min_num_pass / 6, time since change
+            self.state = np.zeros(self.observation_space.shape, dtype=np.float32)
+            self.lane_shares = self.state[:3 * len(self.state_lanes)].reshape(len(self.state_lanes), 3)
+        else:
+            self.state = self.observation_space.sample()
         self.current_min_num_pass = 1
         self.act_rate = 0
         self.policy = None
@@ -35,17 +50,21 @@ class PTLEnv(gym.Env):
             self.sumo.allow_vehicles(veh_types=["AV"], min_num_pass=self.current_min_num_pass)
             self.sumo.step()
             for lane in self.target_lanes:
-                reward += self.sumo.get_num_pass(laneID=lane.getID())
+                reward += self.sumo.get_num_pass(laneID=lane)
 
-        reward /= self.act_rate*sum([get_lane_max_vehicles(lane) * 5 for lane in self.target_lanes])
+        reward /= self.act_rate*self.reward_normaliser
+
+        if self.obs_mode == "flat":
+            self._update_flat_state(action)
+            return self.state, reward, self.sumo.isFinish(), False, {}
 
         # update state from SUMO
         for lane in self.state_lanes:
-            max_vehicles = get_lane_max_vehicles(lane)
-            HD, AV, ALLOWED = self.sumo.get_num_vehs(lane_ID=lane.getID())
-            self.state[f"{lane.getID()}_HD"] = np.array([HD / max_vehicles])
-            self.state[f"{lane.getID()}_AV"] = np.array([AV / max_vehicles])
-            self.state[f"{lane.getID()}_ALLOWED"] = np.array([ALLOWED / max_vehicles])
+            max_vehicles = self.lane_max_vehicles[lane]
+            HD, AV, ALLOWED = self.sumo.get_num_vehs(lane_ID=lane)
+            self.state[f"{lane}_HD"] = np.array([HD / max_vehicles])
+            self.state[f"{lane}_AV"] = np.array([AV / max_vehicles])
+            self.state[f"{lane}_ALLOWED"] = np.array([ALLOWED / max_vehicles])
         self.state["current_min_num_pass"] = self.current_min_num_pass
         self.state["time_since_change"] += self.act_rate / 15000
         if action != 1:
@@ -55,6 +74,12 @@ class PTLEnv(gym.Env):
 
         return self.state, reward, done, False, {}
 
+    def _update_flat_state(self, action):
+        self.lane_shares[:] = [self.sumo.get_num_vehs(lane_ID=lane) for lane in self.state_lanes]
+        self.lane_shares /= self.lane_capacities[:, None]
+        self.state[-2] = self.current_min_num_pass / 6
+        self.state[-1] = self.state[-1] + self.act_rate / 15000 if action == 1 else self.act_rate / 15000
+
     def reset(self, seed: int = None):
         # check if a SUMO instance is already running
         self.act_rate = self.policy.act_rate
@@ -65,9 +90,13 @@ class PTLEnv(gym.Env):
 
         # reset the state
         self.current_min_num_pass = 6  # NEVER CHANGE !!!
-        for k in self.state.keys():
-            self.state[k] = np.array([0.0])
-        self.state["current_min_num_pass"] = self.current_min_num_pass
+        if self.obs_mode == "flat":
+            self.state[:] = 0
+            self.state[-2] = self.current_min_num_pass / 6
+        else:
+            for k in self.state.keys():
+                self.state[k] = np.array([0.0])
+            self.state["current_min_num_pass"] = self.current_min_num_pass
 
         # init SUMO
         if self.train:
@@ -77,6 +106,11 @@ class PTLEnv(gym.Env):
 
         return self.state, {}
 
+    @property
+    def traci(self):
+        # the TraCI handle of the running simulation, for policies acting on the env
+        return self.sumo.traci
+
     def render(self):
         pass
 
@@ -84,15 +118,14 @@ class PTLEnv(gym.Env):
         self.sumo.close()
 
     def _set_observations(self):
-        edges = get_edges(self.sumo.network_file)
-        edges = [edge for edge in edges if edge.getID() != get_last_edge(self.sumo.network_file).getID()]
-        self.state_lanes = [lane for edge in edges for lane in edge.getLanes()]
-        self.target_lanes = [lane for lane in get_last_edge(self.sumo.network_file).getLanes()]
+        network = self.sumo.network
+        self.state_lanes = network.state_lane_ids
+        self.target_lanes = network.target_lane_ids
+        self.lane_max_vehicles = network.lane_max_vehicles
 
         # Construct an OrderedDict for observation spaces
         obs_dict = OrderedDict()
-        for lane in self.state_lanes:
-            lane_id = lane.getID()
+        for lane_id in self.state_lanes:
             obs_dict[f"{lane_id}_HD"] = gym.spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
             obs_dict[f"{lane_id}_AV"] = gym.spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
             obs_dict[f"{lane_id}_ALLOWED"] = gym.spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
@@ -104,6 +137,17 @@ class PTLEnv(gym.Env):
         # Ensure Dict is created with an OrderedDict
         return gym.spaces.Dict(obs_dict)
 
+    def _set_flat_observations(self):
+        network = self.sumo.network
+        self.state_lanes = network.state_lane_ids
+        self.target_lanes = network.target_lane_ids
+        self.lane_max_vehicles = network.lane_max_vehicles
+
+        # lane shares and min_num_pass / 6 are in [0, 1], the time since change is not bounded
+        high = np.ones(3 * len(self.state_lanes) + 2, dtype=np.float32)
+        high[-1] = np.inf
+        return gym.spaces.Box(low=0, high=high, dtype=np.float32)
+
 
     def save_policy(self):
         path = os.path.join("agents", self.sumo.demand_profile.__str__())
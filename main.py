@@ -1,36 +1,61 @@
 import os
-import pickle
-from multiprocessing.pool import Pool
+import itertools
+import contextlib
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
-import numpy as np
 
-from SUMO.SUMOAdpater import SUMOAdapter
+from SUMO.SUMOAdpater import SUMOAdapter, get_sumo_entrypoint
+from SUMO.completion_utils import get_sumo_version
 from utils.argparse_utils import get_args
-from Policies.policy_parameters import create_policy_definitions
-from Demands.demand_parameters import create_demand_definitions
-from results.parse_all_results import parse_all_results
+from utils.sweep_spec import load_sweep_spec, spec_from_args, iter_sweep, iter_demands, parse_shard
+from results.parse_all_results import parse_all_results, live_aggregator
 import warnings
 from env.PTLenv import PTLEnv
 from Loggers.CSVLogger import CSVLogger
+from utils.task_spec import TaskSpec
+from utils.scenario_pipeline import ScenarioPipeline
+from utils.work_queue import WorkQueue, new_worker_id, POLL_INTERVAL
+from utils.scheduling_utils import RuntimeModel, load_run_history, record_run, longest_first, chunks, \
+    schedule_report
+from utils.task_runner import TaskRunner, error_info
 
 warnings.filterwarnings("ignore", message="API change now handles step as floating point seconds")
 
 
 def simulate(args, logger=CSVLogger):
     sumo, policy, train = args
+    # evaluation runs are recorded as complete once SUMO is closed (see --resume), with their run time
+    fingerprint = sumo.fingerprint(policy) if not train else None
+    sumo.clear_completion(policy)
+    start = time.perf_counter()
+    run_simulation(sumo, policy, train, logger)
+    if not train:
+        sumo.mark_complete(policy, fingerprint)
+        record_run(sumo, policy, time.perf_counter() - start)
+
+
+def run_simulation(sumo, policy, train, logger):
     sumo.init_simulation(policy)  # initialize simulation
 
     # initialize logger:
     if logger:
         logger = logger(sumo.output_folder, policy.__str__(), ["min_num_pass",])
+    if sumo.runs_batch(policy):
+        # static policies run without TraCI, the logged value never changes
+        steps = sumo.run_batch()
+        if logger:
+            logger.log({"min_num_pass": policy.min_num_pass}, repeat=steps)
+        return
     if policy.RL:
         if train:
-            env = PTLEnv(sumo)
+            env = PTLEnv(sumo, obs_mode=policy.obs_mode)
             policy.after_init_sumo(env)
             policy.agent.learn(total_timesteps=10**6 // policy.act_rate)
             env.save_policy()
         else:
-            env = PTLEnv(sumo, train=False)
+            env = PTLEnv(sumo, train=False, obs_mode=policy.obs_mode)
             policy.after_init_sumo(env)
             agent_path = os.path.join("agents", env.sumo.demand_profile.__str__(), policy.__str__() + ".zip")
             policy.agent = policy.agent.load(agent_path)
@@ -47,51 +72,173 @@ def simulate(args, logger=CSVLogger):
         # run simulation
         while not sumo.isFinish():
             policy.handle_step(sumo)
+            # advance to the next time the policy has to act in a single SUMO call
+            target = sumo.advance_target(policy.next_wakeup(sumo))
             if logger:
                 # check if policy has attribute current_min_num_pass
                 if hasattr(policy, "current_min_num_pass"):
                     value = policy.current_min_num_pass
                 else:
                     value = policy.min_num_pass
-                logger.log({"min_num_pass": value})
-            sumo.step()
+                logger.log({"min_num_pass": value}, repeat=target - sumo.timestep)
+            sumo.step_until(target)
         sumo.close()
 
-def main(args):
-    DEMAND_DEFINITIONS = create_demand_definitions(av_rate_range=args.av_rate)
-    if args.demand:
-        demand_instances = [DEMAND_DEFINITIONS[args.demand]["class"](**params) for params in
-                            DEMAND_DEFINITIONS[args.demand]["params"]]
-    else:
-        demand_instances = [demand["class"](**params) for demand in DEMAND_DEFINITIONS.values() for params in
-                            demand["params"]]
-    num_exps = args.num_experiments
-    np.random.seed(args.seed)
-    seeds = [np.random.randint(0, 10000) for _ in range(num_exps+args.skip_seeds)]
-    seeds = seeds[args.skip_seeds:]
-    POLICY_DEFINITIONS = create_policy_definitions(av_rate_range=args.av_rate, min_num_pass_range=args.min_num_pass,
-                                                   train = args.train)
-    if args.policy:
-        policy_instances = [POLICY_DEFINITIONS[args.policy]["class"](**params) for params in
-                            POLICY_DEFINITIONS[args.policy]["params"]]
+def simulate_task(task):
+    simulate(task.build())
+
+
+def try_simulate_task(task):
+    try:
+        simulate_task(task)
+    except Exception as e:
+        return error_info(e)
+    return None
+
+
+def simulate_many(tasks):
+    # one worker interleaves its simulations: each runs in a thread on its own TraCI connection, and while a thread
+    # waits for its SUMO to answer a step the other threads issue theirs.
+    # Every task builds its own adapter and policy, the threads share no simulation state
+    # :return: the error of every task, None for the completed ones
+    if len(tasks) == 1:
+        return [try_simulate_task(tasks[0])]
+    with ThreadPool(len(tasks)) as pool:
+        return pool.map(try_simulate_task, tasks)
+
+
+def run_worker(queue):
+    # claim and run the tasks of the queue until it is empty, also requeue the tasks of dead workers meanwhile
+    worker_id = new_worker_id()
+    with queue.heartbeat(worker_id):
+        while True:
+            claimed = queue.claim(worker_id)
+            if claimed is None:
+                if queue.requeue_dead() == 0 and queue.is_empty():
+                    return
+                time.sleep(POLL_INTERVAL)
+                continue
+            name, task = claimed
+            try:
+                simulate_task(task)
+            except Exception:
+                queue.fail(name, worker_id, traceback.format_exc())
+                continue
+            queue.complete(name, worker_id)
+
+
+def wait_for_queue(queue, sweep_id, num_tasks):
+    # the coordinator follows the progress of the workers and requeues the tasks of dead ones
+    with tqdm(total=num_tasks) as progress:
+        while True:
+            queue.requeue_dead()
+            counts = queue.counts(sweep_id)
+            progress.update(counts["done"] + counts["failed"] - progress.n)
+            if counts["pending"] == counts["running"] == 0:
+                break
+            time.sleep(POLL_INTERVAL)
+    if counts["failed"]:
+        print(f"{counts['failed']} simulations failed, see {os.path.join(queue.path, 'failed')}")
+
+
+def run_pool(runner, groups, pipeline=None, aggregator=None):
+    with runner, tqdm() as progress:
+        for num_done, completed in runner.imap_unordered(groups):
+            progress.update(num_done)
+            if pipeline:
+                pipeline.simulated(num_done)
+                progress.set_postfix(pipeline.postfix())
+            if aggregator:
+                # the results tables follow the sweep, see results/result_aggregator.py
+                aggregator.update(task.exp_file for task in completed)
+    if runner.failed:
+        print(f"{len(runner.failed)} simulations failed, see {runner.failure_log}:")
+        print("\n".join(runner.failed))
+
+
+def skip_completed(tasks, completed):
+    # the simulations an earlier sweep completed are only counted, the ones it never ran or that were killed run again
+    for task in tasks:
+        if task.is_complete():
+            completed[0] += 1
+        else:
+            yield task
+
+
+def run_sweep(args, runner, ordered, num_processes, sims_per_worker, aggregator=None):
+    if args.queue:
+        # distributed: the workers (main.py --worker --queue DIR, on any host sharing DIR and the outputs) run them
+        queue = WorkQueue(args.queue, heartbeat_timeout=args.heartbeat_timeout)
+        sweep_id, num_tasks = queue.put(task for task, _, _ in ordered)
+        wait_for_queue(queue, sweep_id, num_tasks)
+    elif args.generator_processes:
+        # the generators build the scenarios ahead, the simulation workers only run the ready ones
+        queue_size = args.scenario_queue or 2 * (num_processes or os.cpu_count()) * sims_per_worker
+        with ScenarioPipeline(args.generator_processes, queue_size, on_failure=runner.log_failure) as pipeline:
+            groups = chunks(pipeline.ready(task for task, _, _ in ordered), sims_per_worker)
+            run_pool(runner, groups, pipeline, aggregator)
+            print(pipeline.report())
     else:
-        policy_instances = [policy["class"](**params) for policy in POLICY_DEFINITIONS.values()
-                            for params in policy["params"]]
-    simulation_args = []
-    net_file = args.net_file + ".net.xml"
-    for demand in demand_instances:
-        for seed in seeds:
-            for policy in policy_instances:
-                if policy.av_rate != demand.av_rate:
-                    continue
-                sumo = SUMOAdapter(demand, seed, net_file=net_file,
-                                   gui=args.gui)
-                simulation_args.append((sumo, policy, args.train))
+        groups = chunks((task for task, _, _ in ordered), sims_per_worker)
+        run_pool(runner, groups, aggregator=aggregator)
+
+
+def main(args):
+    if args.worker:
+        run_worker(WorkQueue(args.queue, heartbeat_timeout=args.heartbeat_timeout))
+        return
+    spec = load_sweep_spec(args.sweep_spec) if args.sweep_spec else spec_from_args(args)
+    net_name = spec.get("net_file", args.net_file)
+    net_file = net_name + ".net.xml"
+    SUMOAdapter.copy_network(net_file)
+
+    # the combinations are enumerated lazily and handed to the pool as small task specs, every worker builds its
+    # adapters and policies
+    combinations = itertools.islice(iter_sweep(spec), *parse_shard(args.shard))
+    tasks = (TaskSpec(demand_class, demand_params, seed, policy_class, policy_params, net_file,
+                      train=args.train, gui=args.gui, engine=args.engine, permission_mode=args.permission_mode,
+                      batch=args.batch_static, reuse_session=args.reuse_session,
+                      session_max_runs=args.session_max_runs)
+             for demand_class, demand_params, seed, policy_class, policy_params in combinations)
+    completed = [0]
+    if args.resume and not args.train:
+        # the fingerprints hold the SUMO version, read here once: a sumo --version started by the pool feeder
+        # thread while the pool forks its workers never returns (the workers inherit the pipe it waits on)
+        get_sumo_version(get_sumo_entrypoint(args.gui))
+        tasks = skip_completed(tasks, completed)
     num_processes = args.num_processes if not args.gui else 1
-    with Pool(num_processes) as pool:
-        list(tqdm(pool.imap(simulate, simulation_args), total=len(simulation_args)))
+    sims_per_worker = args.sims_per_worker if not args.gui else 1
+
+    # longest predicted simulations first, the idle workers pick the next one so the short ones fill the gaps
+    model = RuntimeModel(load_run_history())
+    ordered = longest_first(tasks, model, args.schedule_window)
+    if args.dry_run:
+        costs, disk = [], []
+        for _, features, cost in ordered:
+            costs.append(cost)
+            disk.append(model.predict_disk(features))
+        group_costs = [sum(group) for group in chunks(costs, sims_per_worker)]
+        print(schedule_report(group_costs, disk, num_processes or os.cpu_count(), model))
+        return
+    # a failing, crashing or hanging simulation is logged and retried, the sweep goes on with the others
+    runner = TaskRunner(simulate_many, num_processes, timeout=args.task_timeout, retries=args.retries,
+                        max_tasks_per_child=args.max_tasks_per_child, memory_limit=args.worker_memory,
+                        failure_log=os.path.join("SUMO", "outputs", net_name, "failures.jsonl"))
+    # the completed experiments are summarized while the sweep runs, the tables are rewritten every
+    # --aggregate_interval seconds and the final parse only takes the experiments left
+    aggregator = None
+    if args.parse_results and args.aggregate_processes and not args.queue:
+        aggregator = live_aggregator(f"SUMO/outputs/{net_name}", list(iter_demands(spec)), args.aggregate_processes,
+                                     args.aggregate_interval)
+    with aggregator or contextlib.nullcontext():
+        run_sweep(args, runner, ordered, num_processes, sims_per_worker, aggregator)
+        if aggregator:
+            aggregator.collect(wait=True)
+            aggregator.save()
+    if completed[0]:
+        print(f"{completed[0]} simulations were already completed")
     if args.parse_results:
-        parse_all_results(output_folder=f"SUMO/outputs/{args.net_file}", demands=demand_instances)
+        parse_all_results(output_folder=f"SUMO/outputs/{net_name}", demands=list(iter_demands(spec)))
 
 
 if __name__ == '__main__':
@@ -1,30 +1,45 @@
+import collections
+import functools
 import os
-import pickle
 
 import plotly.graph_objects as go
 
 from results.parse_exp_results import ResultsParser
+from results.result_aggregator import ResultAggregator, STATE_FILE
 import pandas as pd
 import numpy as np
 from multiprocessing import Pool
 from tqdm import tqdm
-from SUMO.netfile_utils import get_PTL_lanes
+from SUMO.netfile_utils import get_network_index
 from Demands.demand_parameters import create_demand_definitions
 
+VTYPES = [f"{t}_{num}" for num in range(1, 6) for t in ["AV", "HD"]]
+METRICS = ["passDelay", "totalDelay", "duration", "passDuration", "departDelay", "timeLoss", "threshold"]
+
 
 def parse_experiment(args):
-    exp_path, PTL_lanes = args
+    exp_path, PTL_lanes, sections = args
     """Helper function to parse a single experiment path."""
-    return ResultsParser(exp_path, PTL_lanes=PTL_lanes)
+    return ResultsParser(exp_path, PTL_lanes=PTL_lanes).load(*sections)
+
+
+def is_output_folder(folder, name):
+    # the hidden folders (the network index sidecars of older runs) hold no experiments
+    return not name.startswith(".") and os.path.isdir(os.path.join(folder, name))
 
 
-def get_all_results_parsers(outputs_folder, demands=None, one_av_rate=None, policy=None):
+def get_all_results_parsers(outputs_folder, demands=None, one_av_rate=None, policy=None,
+                            sections=("trips", "decisions")):
+    """
+    :param sections: the results sections converted up front in parallel, the others are converted by the parsers
+                     when a metric first needs them (the tables use the trips and decisions, the plots the lanes)
+    """
     demands = os.listdir(outputs_folder) if not demands else demands
 
     net_file = [f for f in os.listdir(outputs_folder) if f.endswith(".net.xml")][0]
     net_file = os.path.join(outputs_folder, net_file)
-    PTL_lanes = get_PTL_lanes(net_file)
-    demands = [demand for demand in demands if os.path.isdir(os.path.join(outputs_folder, demand))]
+    PTL_lanes = get_network_index(net_file).ptl_lane_ids
+    demands = [demand for demand in demands if is_output_folder(outputs_folder, demand)]
 
     tasks = []  # List to hold all tasks to be processed in parallel
     results_parsers = []
@@ -42,11 +57,11 @@ def get_all_results_parsers(outputs_folder, demands=None, one_av_rate=None, poli
                     if policy and experiment != policy:
                         continue
                     exp_path = os.path.join(seed_folder, experiment)
-                    if os.path.exists(exp_path + "_ResultsParser.pkl"):
-                        results_parsers.append(pickle.load(open(exp_path + "_ResultsParser.pkl", "rb")))
+                    if ResultsParser.is_converted(exp_path, sections):
+                        results_parsers.append(ResultsParser(exp_path, PTL_lanes=PTL_lanes))
                     else:
-                        tasks.append((exp_path, PTL_lanes))  # Collecting paths to process
-    if len(tasks) > 1:
+                        tasks.append((exp_path, PTL_lanes, sections))  # Collecting paths to process
+    if tasks:
         # Use multiprocessing to parse experiments in parallel with tqdm
         with Pool() as pool:
             pool_output = list(tqdm(pool.imap(parse_experiment, tasks), total=len(tasks)))
@@ -54,6 +69,59 @@ def get_all_results_parsers(outputs_folder, demands=None, one_av_rate=None, poli
     return results_parsers
 
 
+def experiment_summary(args):
+    results_parser, metrics = args
+    return results_parser.summary(metrics, VTYPES)
+
+
+def create_summary_table(results_parsers, metrics):
+    """
+    The long table all the metrics tables are aggregated from: one row per experiment, vType ("" for all the
+    vehicles) and metric, with the sum of the metric and the count its mean divides by
+    """
+    with Pool() as pool:
+        summaries = list(tqdm(pool.imap(experiment_summary, [(rp, metrics) for rp in results_parsers]),
+                              total=len(results_parsers)))
+    rows = [(rp.demand_name, rp.av_rate, rp.policy_name, rp.seed, *row)
+            for rp, summary in zip(results_parsers, summaries) for row in summary]
+    return pd.DataFrame(rows, columns=["demand", "av_rate", "policy", "seed", "vType", "metric", "sum", "count"])
+
+
+def summary_tables(summary, metrics, demands, av_rates, policies, vType=False):
+    """
+    The mean and std over the seeds of every metric, for all the combinations at once
+    :return: dict of metric -> table laid out as create_metrics_results_tables writes it
+    """
+    values = summary.assign(value=summary["sum"] / summary["count"])
+    if vType:
+        # the threshold is the same for every vType
+        threshold = values[values["metric"] == "threshold"]
+        values = pd.concat([values[values["vType"] != ""]] +
+                           [threshold.assign(vType=v) for v in VTYPES], ignore_index=True)
+    else:
+        values = values[values["vType"] == ""]
+    return stats_tables(values, metrics, demands, av_rates, policies, vType)
+
+
+def stats_tables(values, metrics, demands, av_rates, policies, vType=False):
+    """
+    :param values: long table of the value of every experiment (or experiment and baseline pair) and metric
+    """
+    keys = ["metric", "policy", "demand", "av_rate"] + (["vType"] if vType else [])
+    # numpy's mean and std of every group, over its rows in the order of the parsers
+    stats = values.groupby(keys, sort=False)["value"].agg([lambda v: np.mean(v.values), lambda v: np.std(v.values)])
+    stats.columns = ["mean", "std"]
+    stats = stats.stack()
+    stats.index.names = keys + ["stat"]
+    wide = stats.unstack(["demand", "av_rate"] + (["vType"] if vType else []) + ["stat"])
+    columns = pd.MultiIndex.from_product([demands, av_rates] + ([VTYPES] if vType else []) + [["mean", "std"]])
+    tables = {}
+    for metric in metrics:
+        table = wide.xs(metric, level="metric") if metric in wide.index.get_level_values("metric") else pd.DataFrame()
+        tables[metric] = table.reindex(index=policies, columns=columns).rename_axis(index=None).astype(object)
+    return tables
+
+
 def calc_mean_std(df):
     # Calculate mean and standard deviation of each column
     means = df.mean()
@@ -65,38 +133,6 @@ def calc_mean_std(df):
         'std': stds}).T
 
 
-def calc_metric_over_simulations(results_parsers, metric, vType=None, baselines=None):
-    """
-    Calculate the mean and std of a metric for all the results parsers
-    :param results_parsers: a list of ResultsParser objects
-    :param metric: the metric to calculate the mean and std for
-    :param vType: weather to calculate the metric for each vehicle type
-    :param PTL: weather to calculate the metric for PTL and not PTL separately
-    :param baseline: the baselines to compare the metric to (list of ResultsParser objects)
-    :return: a dataframe with the mean and std of the metric for all the results parsers
-    """
-    if baselines:
-        means = [rp.mean_metric(metric, vType, baseline) for rp in results_parsers for baseline in baselines
-                 if rp.seed == baseline.seed]
-    else:
-        means = [rp.mean_metric(metric, vType) for rp in results_parsers]
-    return {"mean": np.mean(means), "std": np.std(means)}
-
-
-def process_combination(args):
-    results_parsers, metric, vType, baselines, key = args
-    if vType:
-        vTypes = [f"{t}_{num}" for num in range(1,6) for t in ["AV", "HD"]]
-        result = {}
-        for v in vTypes:
-            vtype_results = calc_metric_over_simulations(results_parsers, metric, v)
-            result[v] = {"mean": vtype_results["mean"], "std": vtype_results["std"]}
-        return result, key
-    else:
-        av_rate_results = calc_metric_over_simulations(results_parsers, metric, baselines=baselines)
-        return {"mean": av_rate_results["mean"], "std": av_rate_results["std"]}, key
-
-
 def highlight_min(s):
     # return style of background color for the minimum value in the column if the column is "mean"
     is_min = s == s.min()
@@ -119,60 +155,97 @@ def highlight_min(s):
     return ['' for _ in is_min]
 
 
+def baseline_comparisons(args):
+    baseline, experiments, metrics = args
+    comparisons = []
+    for rp in experiments:
+        try:
+            comparisons.append(rp.baseline_comparison(baseline, metrics))
+        except ValueError as e:
+            comparisons.append(str(e))  # reported with the other mismatched runs
+    return comparisons
+
+
+def plain_means(args):
+    rp, metrics = args
+    return {metric: rp.mean_metric(metric) for metric in metrics}
+
+
+def create_baseline_table(results_parsers, baselines, metrics):
+    """
+    The long table of the metrics of every experiment against every baseline of its demand and seed (see
+    ResultsParser.baseline_comparison), one task per baseline so its trips are indexed once.
+    The experiments of a demand without any baseline run get the plain means of their metrics instead
+    :raise ValueError: listing the experiments whose baseline misses some of their vehicles
+    """
+    baseline_index = collections.defaultdict(list)  # (demand, seed) -> baselines
+    for baseline in baselines:
+        baseline_index[baseline.demand_name, baseline.seed].append(baseline)
+    experiments = collections.defaultdict(list)
+    for rp in results_parsers:
+        experiments[rp.demand_name, rp.seed].append(rp)
+    tasks = [(baseline, experiments[key], metrics) for key, key_baselines in baseline_index.items()
+             for baseline in key_baselines]
+    baseline_demands = {baseline.demand_name for baseline in baselines}
+    unmatched = [rp for rp in results_parsers if rp.demand_name not in baseline_demands]
+    if unmatched:
+        missing = sorted({rp.demand_name for rp in unmatched})
+        print(f"No Nothing runs for {', '.join(missing)}, their baseline tables hold the plain means")
+    with Pool() as pool:
+        results = list(tqdm(pool.imap(baseline_comparisons, tasks), total=len(tasks)))
+        means = pool.map(plain_means, [(rp, metrics) for rp in unmatched])
+    comparisons = {(id(baseline), id(rp)): comparison
+                   for (baseline, task_experiments, _), task_comparisons in zip(tasks, results)
+                   for rp, comparison in zip(task_experiments, task_comparisons)}
+    means = {id(rp): rp_means for rp, rp_means in zip(unmatched, means)}
+
+    # the pairs in the order of the parsers, then of their baselines
+    rows, mismatches = [], []
+    for rp in results_parsers:
+        if id(rp) in means:
+            rows.extend((rp.demand_name, rp.av_rate, rp.policy_name, rp.seed, metric, means[id(rp)][metric])
+                        for metric in metrics)
+            continue
+        for baseline in baseline_index[rp.demand_name, rp.seed]:
+            comparison = comparisons[id(baseline), id(rp)]
+            if not isinstance(comparison, dict):
+                mismatches.append(comparison)
+                continue
+            rows.extend((rp.demand_name, rp.av_rate, rp.policy_name, rp.seed, metric, comparison[metric])
+                        for metric in metrics)
+    if mismatches:
+        raise ValueError("Baseline runs miss vehicles of the experiments:\n" + "\n".join(mismatches))
+    return pd.DataFrame(rows, columns=["demand", "av_rate", "policy", "seed", "metric", "value"])
+
+
 def create_metrics_results_tables(results_parsers, metrics, result_folder,
                                   demands=None, av_rates=None, policies=None,
-                                  vType=False, baseline=False):
+                                  vType=False, baseline=False, summary=None, baseline_table=None):
     """
     Create a table with the mean and std of a metric for all the results parsers
     :param results_parsers: a list of ResultsParser objects
     :param metric: the metric to calculate the mean and std for
     :param vType: weather to calculate the metric for each vehicle type
+    :param summary: the summary table of the results parsers (see create_summary_table), built when not given
+    :param baseline_table: the baseline comparisons of the results parsers (see create_baseline_table), built when
+                           not given
     :return: a dataframe of columns demand, subcolumns of av_rates, (optional) subcolumns of vTypes,
                 subcolumns mean and std, and rows of policies
     """
     demands = sorted(list(set(map(lambda x: x.demand_name, results_parsers))) if not demands else demands)
     av_rates = sorted(list(set(map(lambda x: x.av_rate, results_parsers)))) if not av_rates else av_rates
     policies = sorted(list(set(map(lambda x: x.policy_name, results_parsers)))) if not policies else policies
-    baselines = list(filter(lambda x: x.policy_name == "Nothing", results_parsers)) if baseline else None
     if baseline:
-        results_parsers = list(filter(lambda x: x.policy_name[:3] not in ["A2C","DQN","PPO"],results_parsers))
-    if vType:
-        vTypes = [f"{t}_{num}" for num in range(1,6) for t in ["AV", "HD"]]
-        df = pd.DataFrame(index=policies,
-                          columns=pd.MultiIndex.from_product([demands, av_rates, vTypes, ["mean", "std"]]))
+        if baseline_table is None:
+            baselines = list(filter(lambda x: x.policy_name == "Nothing", results_parsers))
+            results_parsers = list(filter(lambda x: x.policy_name[:3] not in ["A2C","DQN","PPO"],results_parsers))
+            baseline_table = create_baseline_table(results_parsers, baselines, metrics)
+        tables = stats_tables(baseline_table, metrics, demands, av_rates, policies)
     else:
-        df = pd.DataFrame(index=policies, columns=pd.MultiIndex.from_product([demands, av_rates, ["mean", "std"]]))
+        summary = create_summary_table(results_parsers, metrics) if summary is None else summary
+        tables = summary_tables(summary, metrics, demands, av_rates, policies, vType)
     for metric in metrics:
-        tasks = []
-        df_metric = df.copy()
-        for demand in demands:
-            for policy in policies:
-                for av_rate in av_rates:
-                    task_parsers = list(filter(lambda x: x.av_rate == av_rate and
-                                                         x.demand_name == demand and
-                                                         x.policy_name == policy,
-                                               results_parsers))
-                    if baseline:
-                        task_baselines = list(filter(lambda x: x.demand_name == demand,baselines))
-                    else:
-                        task_baselines = None
-                    tasks.append((task_parsers, metric, vType, task_baselines, (policy, demand, av_rate)))
-
-        # tasks = list(set(filter(lambda x: len(x[0]) > 0, tasks)))
-
-        with Pool() as pool:
-            # Use imap instead of starmap for progress tracking
-            results = list(tqdm(pool.imap(process_combination, tasks), total=len(tasks)))
-        for result, key in results:
-            policy, demand, av_rate = key
-            if vType:  # If vType was used
-                for v in vTypes:
-                    df_metric.loc[policy, (demand, av_rate, v, "mean")] = result[v]["mean"]
-                    df_metric.loc[policy, (demand, av_rate, v, "std")] = result[v]["std"]
-            else:
-                df_metric.loc[policy, (demand, av_rate, "mean")] = result["mean"]
-                df_metric.loc[policy, (demand, av_rate, "std")] = result["std"]
-
+        df_metric = tables[metric]
         df_name = f"{metric}_vType" if vType else f"{metric}_baseline" if baseline else f"{metric}"
         df_metric.to_csv(os.path.join(result_folder, f"{df_name}.csv"))
         df_metric.to_pickle(os.path.join(result_folder, f"{df_name}.pkl"))
@@ -250,22 +323,35 @@ def create_plots(results_parsers, result_folder, metric,
         res = list(tqdm(pool.imap(create_plot, tasks), total=len(tasks)))
 
 
-def parse_all_results(output_folder="SUMO/outputs/network_new", demands=None, one_av_rate=None, policy=None):
-    if not demands:
-        demands = os.listdir(output_folder)
-        demands = [demand for demand in demands if os.path.isdir(os.path.join(output_folder, demand))]
-        demands = sorted(demands)
-    else:
-        demands = sorted(list(set([demand.__str__() for demand in demands])))
+def results_folder(output_folder, demands, policy=None):
+    """
+    :param demands: the demands (or their names) of the tables, the folder is named after the first one
+    """
+    demands = sorted(list(set([demand.__str__() for demand in demands])))
     folder_name = "_".join(demands[0].split("_")[:-1])
     result_folder = os.path.join("results", "output_results", output_folder.split("/")[-1], folder_name)
     if policy:
         result_folder = os.path.join(result_folder, policy)
+    return result_folder
+
+
+def write_results_tables(aggregator, result_folder, demands=None, baseline=True):
+    """
+    Write the metrics tables (plain, per vType and against the baselines) of the experiments the aggregator
+    summarized so far, the baseline tables are left as they were while some baselines miss vehicles of their
+    experiments (see mismatch_report)
+    :param demands: the demand columns of the plain and vType tables, the summarized demands when not given
+    """
+    summary = aggregator.summary()
+    if summary.empty:
+        return
     os.makedirs(result_folder, exist_ok=True)
-    results_parsers = get_all_results_parsers(output_folder, demands=demands, one_av_rate=one_av_rate, policy=policy)
-    metrics = ["passDelay", "totalDelay", "duration", "passDuration", "departDelay","timeLoss", "threshold"]
-    create_metrics_results_tables(results_parsers, metrics, result_folder=result_folder, vType=False, demands=demands)
-    create_metrics_results_tables(results_parsers, metrics, result_folder=result_folder, vType=True, demands=demands)
+    av_rates = sorted(summary["av_rate"].unique())
+    policies = sorted(summary["policy"].unique())
+    for vType in [False, True]:
+        create_metrics_results_tables([], aggregator.metrics, result_folder=result_folder, vType=vType,
+                                      demands=demands or sorted(summary["demand"].unique()), av_rates=av_rates,
+                                      policies=policies, summary=summary)
     # create_plots(results_parsers, metric="speed", PTL=True, result_folder=result_folder, demands=demands,
     #              errorbars=True)
     # create_plots(results_parsers, metric="speed", PTL=False, result_folder=result_folder, demands=demands,
@@ -280,8 +366,61 @@ def parse_all_results(output_folder="SUMO/outputs/network_new", demands=None, on
     #              errorbars=True)
     # create_plots(results_parsers, metric="occupancy", PTL=False, result_folder=result_folder, demands=demands,
     #                 errorbars=True)
-    if "toy" not in output_folder:
-        create_metrics_results_tables(results_parsers, metrics, result_folder=result_folder, baseline=True, )
+    if baseline and aggregator.mismatches:
+        print(f"Skipped the baseline tables of {result_folder}: {mismatch_report(aggregator)}")
+    elif baseline:
+        create_metrics_results_tables([], aggregator.metrics, result_folder=result_folder, baseline=True,
+                                      demands=sorted(summary["demand"].unique()), av_rates=av_rates,
+                                      policies=policies, baseline_table=aggregator.baseline_table())
+
+
+def mismatch_report(aggregator):
+    return "Baseline runs miss vehicles of the experiments:\n" + "\n".join(aggregator.mismatches.values())
+
+
+def live_aggregator(output_folder, demands, num_processes=1, interval=300):
+    """
+    The aggregator of a running sweep (see main.run_pool), it rewrites the tables of parse_all_results from the
+    experiments completed so far every interval seconds
+    """
+    demands = sorted(list(set([demand.__str__() for demand in demands])))
+    result_folder = results_folder(output_folder, demands)
+    return ResultAggregator(os.path.join(result_folder, STATE_FILE), METRICS, VTYPES, num_processes,
+                            on_update=functools.partial(write_results_tables, result_folder=result_folder,
+                                                        demands=demands, baseline="toy" not in output_folder),
+                            interval=interval)
+
+
+def parse_all_results(output_folder="SUMO/outputs/network_new", demands=None, one_av_rate=None, policy=None):
+    """
+    Bring the aggregated results of the output tree up to date (only the new or rerun experiments are parsed, see
+    results/result_aggregator.py) and write the tables
+    :raise ValueError: listing the experiments whose baseline misses some of their vehicles, once the other tables
+                       are written. The mismatched pairs are compared again by the next parse, rerunning either run
+                       clears them
+    """
+    if not demands:
+        demands = os.listdir(output_folder)
+        demands = [demand for demand in demands if is_output_folder(output_folder, demand)]
+        demands = sorted(demands)
+    else:
+        demands = sorted(list(set([demand.__str__() for demand in demands])))
+    result_folder = results_folder(output_folder, demands, policy)
+    os.makedirs(result_folder, exist_ok=True)
+    # the stores are converted by the aggregator, for the experiments it did not summarize yet
+    results_parsers = get_all_results_parsers(output_folder, demands=demands, one_av_rate=one_av_rate, policy=policy,
+                                              sections=())
+    with ResultAggregator(os.path.join(result_folder, STATE_FILE), METRICS, VTYPES, num_processes=None) as aggregator:
+        aggregator.sync(rp.exp_file for rp in results_parsers)
+        aggregator.collect(wait=True)
+        aggregator.save()
+    baseline = "toy" not in output_folder
+    if baseline and aggregator.unmatched_demands():
+        print(f"No Nothing runs for {', '.join(aggregator.unmatched_demands())}, "
+              f"their baseline tables hold the plain means")
+    write_results_tables(aggregator, result_folder, demands=demands, baseline=baseline)
+    if baseline and aggregator.mismatches:
+        raise ValueError(mismatch_report(aggregator))
 
 
 if __name__ == '__main__':
@@ -1,19 +1,37 @@
 import os.path
 
+import numpy as np
 import pandas as pd
 import xml.etree.ElementTree as ET
 from results.results_utils import split_all_parts
+from results.tripinfo_reader import read_tripinfo
+from results.result_store import store_folder, source_fingerprint, is_current, read_meta, write_store, load_column, \
+    encode_strings, decode_strings
+from SUMO.vtype_registry import VTypeRegistry
 import warnings
 
 warnings.filterwarnings("ignore")
-import pickle
+
+TRIP_COLUMNS = ["id", "vType", "numPass", "duration", "totalDelay", "passDelay", "passDuration", "timeLoss",
+                "departDelay"]
+LANE_METRICS = ["speed", "occupancy", "density", "num_vehs"]
+# the outputs each section of the results is converted from
+SECTION_SOURCES = {"trips": ["_tripinfo.xml", "_vtypes.json"], "lanes": ["_lanes.xml"], "decisions": [".csv"]}
 
 
 class ResultsParser:
+    """
+    The results of one experiment. Each section of the outputs (trips, lanes, decisions) is parsed into the columnar
+    store next to them (see results/result_store.py) the first time a metric needs it, and the metrics read the
+    columns they use from there, so the tables never parse the laneData output
+    """
+
     def __init__(self, exp_file, PTL_lanes, period=60):
+        self.exp_file = exp_file
         self.tripinfo_file = exp_file + "_tripinfo.xml"
         self.lanes_file = exp_file + "_lanes.xml"
         self.decisions_file = exp_file + ".csv" if os.path.isfile(exp_file + ".csv") else None
+        self.vtypes_file = exp_file + "_vtypes.json" if os.path.isfile(exp_file + "_vtypes.json") else None
         parts = split_all_parts(exp_file)
         self.policy_name = parts[-1]
         self.seed = int(parts[-2])
@@ -21,91 +39,144 @@ class ResultsParser:
         self.demand_name = str(parts[-4])
 
         self.PTL_lanes = PTL_lanes
-        self.tripinfo_df = self._parse_tripinfo_output()
-
-        self.occupancy_df, self.speed_df, self.density_df, self.num_vehs = {}, {}, {}, {}
         self.period = period
-        self._parse_lanes_output()
-
-        self.lanes_metrics_map = {"speed": self.speed_df, "occupancy": self.occupancy_df,
-                                  "num_vehs": self.num_vehs, "density": self.density_df}
-
-        if self.decisions_file:
-            self.decisions_df = pd.read_csv(self.decisions_file)
-
-        pickle.dump(self, open(exp_file + "_ResultsParser.pkl", "wb"))
-
-
-    def _parse_tripinfo_output(self):
-        """
-        Parse the XML file into pd dataframe`
-        :param output_file: path to the output file (XML)
-        :return: pd dataframe of the output file, with the following columns:
-                    ['id', 'vType', 'numPass', 'duration, 'totalDelay', 'passDelay', 'passDuration']
-        """
-        tree = ET.parse(self.tripinfo_file)
-        root = tree.getroot()
-
-        dict = {"duration": [], "departDelay": [], "routeLength": [], "vType": [], "timeLoss": [], "id": []}
-        for tripinfo in root.findall('tripinfo'):
-            for key in dict.keys():
-                dict[key].append(tripinfo.get(key))
-        df = pd.DataFrame(dict)
-        df["departDelay"] = df.departDelay.astype(float)
-        df["totalDelay"] = df.departDelay.astype(float) + df.timeLoss.astype(float)
-        df["vType"] = df["vType"].apply(lambda x: x.split("@")[0])
-        df["numPass"] = df["vType"].apply(lambda x: x.split("_")[1]).astype(int)
-        df["vType"] = df["vType"].apply(lambda x: "_".join(x.split("_")[:2]))
-        df["duration"] = df["duration"].astype(float)
-        df["passDelay"] = df["totalDelay"] * df["numPass"]
-        df["passDuration"] = df["duration"] * df["numPass"]
-        df["timeLoss"] = df["timeLoss"].astype(float)
-        return df[["id", "vType", "numPass", "duration", "totalDelay", "passDelay", "passDuration", "timeLoss",
-                   "departDelay"]]
-
-    def _append_all_dataframes(self, key, value):
-        if key not in self.speed_df:
-            self.speed_df[key] = []
-            self.occupancy_df[key] = []
-            self.density_df[key] = []
-            self.num_vehs[key] = []
-            if value is None:
-                return
-        self.speed_df[key].append(value)
-        self.occupancy_df[key].append(value)
-        self.density_df[key].append(value)
-        self.num_vehs[key].append(value)
-
-    def _switch_all_dataframes(self):
-        self.speed_df = pd.DataFrame(self.speed_df).set_index("time").fillna(0)
-        self.occupancy_df = pd.DataFrame(self.occupancy_df).set_index("time").fillna(0)
-        self.density_df = pd.DataFrame(self.density_df).set_index("time").fillna(0)
-        self.num_vehs = pd.DataFrame(self.num_vehs).set_index("time").fillna(0)
-
-    def _parse_lanes_output(self):
-        """
-        Parse the XML file into pd dataframe`
-        :param output_file: path to the output file (XML)
-        :return: pd dataframe of the output file, with the following columns:
-        """
-        tree = ET.parse(self.lanes_file)
-        root = tree.getroot()
-        for interval in root.findall('interval'):
-            time = interval.get('end')
-            self._append_all_dataframes("time", time)
-            for edge in interval.findall('edge'):
-                for lane in edge.findall('lane'):
-                    lane_id = lane.get('id')
-                    if lane_id not in self.speed_df:
-                        self._append_all_dataframes(lane_id, None)
-                    self.speed_df[lane_id].append(lane.get('speed'))
-                    self.occupancy_df[lane_id].append(lane.get('occupancy'))
-                    self.density_df[lane_id].append(lane.get('density'))
-                    self.num_vehs[lane_id].append(float(lane.get('sampledSeconds')) / self.period)
-        self._switch_all_dataframes()
+        self.store_folder = store_folder(exp_file)
+        self._meta = {}  # the metadata of the loaded sections
+        self._columns = {}
+
+    def __getstate__(self):
+        # the memory-mapped columns are opened again by the process receiving the parser
+        state = self.__dict__.copy()
+        state["_columns"] = {}
+        return state
+
+    @staticmethod
+    def fingerprint(exp_file, section, period=60):
+        # the missing outputs (no decisions or vTypes) are left out, only the lanes depend on the laneData period
+        source_files = [exp_file + suffix for suffix in SECTION_SOURCES[section]]
+        return source_fingerprint(source_files, **({"period": period} if section == "lanes" else {}))
+
+    @classmethod
+    def is_converted(cls, exp_file, sections=tuple(SECTION_SOURCES), period=60):
+        return all(is_current(os.path.join(store_folder(exp_file), section), cls.fingerprint(exp_file, section, period))
+                   for section in sections)
+
+    def load(self, *sections):
+        """
+        Convert the sections whose store is missing or stale, the loaded ones are cached
+        """
+        for section in sections:
+            if section in self._meta:
+                continue
+            folder = os.path.join(self.store_folder, section)
+            fingerprint = self.fingerprint(self.exp_file, section, self.period)
+            if not is_current(folder, fingerprint):
+                columns, meta = getattr(self, f"_parse_{section}")()
+                write_store(folder, columns, {"fingerprint": fingerprint, **meta})
+            self._meta[section] = read_meta(folder)
+        return self
+
+    def _parse_trips(self):
+        # the vType metadata comes from the registry written by the simulation (rebuilt from the ids for older runs)
+        vtype_registry = VTypeRegistry.load(self.vtypes_file) if self.vtypes_file else VTypeRegistry()
+        trips = read_tripinfo(self.tripinfo_file, vtype_registry)
+        trips["id"] = encode_strings(trips["id"])
+        return trips, {"vtype_labels": vtype_registry.labels, "vtype_num_pass": vtype_registry.num_pass}
+
+    def _parse_lanes(self):
+        """
+        Parse the laneData output into a (LANE_METRICS, intervals, lanes) tensor, 0 where a lane has no value
+        """
+        lane_index, times, intervals = {}, [], []
+        for _, interval in ET.iterparse(self.lanes_file, events=("end",)):
+            if interval.tag != "interval":
+                continue
+            times.append(float(interval.get("end")))
+            values = {}
+            for lane in interval.iter("lane"):
+                lane_id = lane.get("id")
+                lane_index.setdefault(lane_id, len(lane_index))
+                values[lane_id] = [float(lane.get("speed", 0)), float(lane.get("occupancy", 0)),
+                                   float(lane.get("density", 0)), float(lane.get("sampledSeconds")) / self.period]
+            intervals.append(values)
+            interval.clear()
+        lanes = np.zeros((len(LANE_METRICS), len(times), len(lane_index)))
+        for t, values in enumerate(intervals):
+            for lane_id, lane_values in values.items():
+                lanes[:, t, lane_index[lane_id]] = lane_values
+        return {"time": np.array(times), "lanes": lanes}, {"lane_ids": list(lane_index)}
+
+    def _parse_decisions(self):
+        decisions = pd.read_csv(self.decisions_file) if self.decisions_file else pd.DataFrame()
+        return {name: decisions[name].values for name in decisions.columns}, {"columns": list(decisions.columns)}
+
+    def _section_meta(self, section):
+        return self.load(section)._meta[section]
+
+    def _column(self, section, name):
+        if (section, name) not in self._columns:
+            self.load(section)
+            self._columns[section, name] = load_column(os.path.join(self.store_folder, section), name)
+        return self._columns[section, name]
+
+    def trip_column(self, name):
+        """
+        :return: a column of the trips table (see TRIP_COLUMNS)
+        """
+        if name == "id":
+            return decode_strings(self._column("trips", "id"))
+        if name == "vType":
+            return np.asarray(self._section_meta("trips")["vtype_labels"], dtype=object)[self._column("trips", "vType")]
+        if name == "numPass":
+            return np.asarray(self._section_meta("trips")["vtype_num_pass"], dtype=int)[self._column("trips", "vType")]
+        if name == "totalDelay":
+            return self._column("trips", "departDelay") + self._column("trips", "timeLoss")
+        if name == "passDelay":
+            return self.trip_column("totalDelay") * self.trip_column("numPass")
+        if name == "passDuration":
+            return self._column("trips", "duration") * self.trip_column("numPass")
+        return np.asarray(self._column("trips", name))
+
+    def vtype_mask(self, vType):
+        codes = [code for code, label in enumerate(self._section_meta("trips")["vtype_labels"]) if label == vType]
+        return np.isin(self._column("trips", "vType"), codes)
+
+    @property
+    def tripinfo_df(self):
+        return pd.DataFrame({name: self.trip_column(name) for name in TRIP_COLUMNS})
+
+    def _lanes_df(self, metric):
+        return pd.DataFrame(self._column("lanes", "lanes")[LANE_METRICS.index(metric)],
+                            columns=self._section_meta("lanes")["lane_ids"],
+                            index=pd.Index(self._column("lanes", "time"), name="time"))
+
+    @property
+    def speed_df(self):
+        return self._lanes_df("speed")
+
+    @property
+    def occupancy_df(self):
+        return self._lanes_df("occupancy")
+
+    @property
+    def density_df(self):
+        return self._lanes_df("density")
+
+    @property
+    def num_vehs(self):
+        return self._lanes_df("num_vehs")
+
+    @property
+    def lanes_metrics_map(self):
+        return {metric: self._lanes_df(metric) for metric in LANE_METRICS}
+
+    @property
+    def decisions_df(self):
+        columns = self._section_meta("decisions")["columns"]
+        return pd.DataFrame({name: self._column("decisions", name) for name in columns})
 
     def _validate_tripinfo_metric(self, metric):
-        assert metric in self.tripinfo_df.columns, f"Metric {metric} is not in the sumo output file"
+        assert metric in TRIP_COLUMNS, f"Metric {metric} is not in the sumo output file"
 
     def mean_metric(self, metric, vType=None, baseline=None):
         """
@@ -119,25 +190,89 @@ class ResultsParser:
             return self.decisions_df["min_num_pass"].mean()
         self._validate_tripinfo_metric(metric)
         assert not (vType and baseline), "Cannot compare vehicle type and baseline"
-        tripinfo = self.tripinfo_df
-        norm_factor = 1
+        num_pass = self.trip_column("numPass")
         if vType:
-            tripinfo = self.tripinfo_df[self.tripinfo_df["vType"] == vType]
-            metric_data = tripinfo[metric]
+            mask = self.vtype_mask(vType)
+            metric_data = self.trip_column(metric)[mask]
+            num_pass = num_pass[mask]
         elif baseline:
-            baseline_tripinfo = baseline.tripinfo_df
-            # make sure ids are the same"
-            joined_baseline = pd.merge(tripinfo, baseline_tripinfo, on="id", suffixes=("_new", "_baseline"))
-            assert len(joined_baseline) == len(tripinfo), "Baseline and new tripinfo files have different ids"
-            metric_data = (joined_baseline[metric + "_new"] - joined_baseline[metric + "_baseline"])
-            norm_factor = joined_baseline[metric + "_baseline"].mean() / 100
-            if "pass" in metric:
-                norm_factor = joined_baseline[metric + "_baseline"].sum() / joined_baseline["numPass_baseline"].sum() / 100
+            return self.baseline_comparison(baseline, [metric])[metric]
         else:
-            metric_data = tripinfo[metric]
+            metric_data = self.trip_column(metric)
         if "pass" in metric:
-            return metric_data.sum() / tripinfo["numPass"].sum() / norm_factor
-        return metric_data.mean() / norm_factor
+            return metric_data.sum() / num_pass.sum()
+        return metric_data.mean()
+
+    def baseline_rows(self, baseline):
+        """
+        Align the trips of a baseline run to the trips of this experiment by vehicle id
+        :return: the row of every trip in the baseline trips, -1 for the vehicles the baseline does not have
+        """
+        ids = self._column("trips", "id")
+        baseline_ids = baseline._column("trips", "id")
+        if len(baseline_ids) == 0:
+            return np.full(len(ids), -1)
+        # the baseline ids are sorted once and searched by every experiment of its seed
+        if ("trips", "id_order") not in baseline._columns:
+            baseline._columns["trips", "id_order"] = np.argsort(baseline_ids, kind="stable")
+        order = baseline._columns["trips", "id_order"]
+        rows = order[np.minimum(np.searchsorted(baseline_ids, ids, sorter=order), len(order) - 1)]
+        return np.where(baseline_ids[rows] == ids, rows, -1)
+
+    def baseline_comparison(self, baseline, metrics):
+        """
+        The change of the metrics of every vehicle from the baseline run, in percent of the baseline mean (per
+        passenger for the pass metrics). The trips are aligned once for all the metrics
+        :param baseline: a ResultsParser of the same demand and seed
+        :return: dict of metric -> the mean change
+        """
+        rows = self.baseline_rows(baseline)
+        if (rows < 0).any():
+            raise ValueError(f"Baseline {baseline.exp_file} misses {(rows < 0).sum()} vehicles of {self.exp_file}")
+        num_pass = self.trip_column("numPass")
+        baseline_num_pass = baseline.trip_column("numPass")[rows]
+        comparison = {}
+        for metric in metrics:
+            if metric == "threshold":
+                comparison[metric] = self.mean_metric(metric)
+                continue
+            self._validate_tripinfo_metric(metric)
+            baseline_data = baseline.trip_column(metric)[rows]
+            metric_data = self.trip_column(metric) - baseline_data
+            if "pass" in metric:
+                norm_factor = baseline_data.sum() / baseline_num_pass.sum() / 100
+                comparison[metric] = metric_data.sum() / num_pass.sum() / norm_factor
+            else:
+                comparison[metric] = metric_data.mean() / (baseline_data.mean() / 100)
+        return comparison
+
+    def summary(self, metrics, vTypes=()):
+        """
+        The sums of the metrics and the counts their means divide by (vehicles, or passengers for the pass metrics),
+        for all the vehicles ("" vType) and per vType
+        :return: list of (vType, metric, sum, count) rows
+        """
+        num_pass = self.trip_column("numPass")
+        masks = {vType: self.vtype_mask(vType) for vType in vTypes}
+        rows = []
+        for metric in metrics:
+            if metric == "threshold":
+                rows.append(("", metric, *self._threshold_sum()))
+                continue
+            self._validate_tripinfo_metric(metric)
+            values = self.trip_column(metric)
+            for vType in [""] + list(vTypes):
+                metric_data, weights = (values[masks[vType]], num_pass[masks[vType]]) if vType else (values, num_pass)
+                rows.append((vType, metric, metric_data.sum(), weights.sum() if "pass" in metric else len(metric_data)))
+        return rows
+
+    def _threshold_sum(self):
+        # the sum and count of pandas' mean, the missing decisions are skipped
+        values = np.asarray(self._column("decisions", "min_num_pass"))
+        if values.dtype.kind != "f":
+            return values.sum(dtype=np.float64), len(values)
+        missing = np.isnan(values)
+        return np.where(missing, 0, values).sum(), np.float64(len(values) - missing.sum())
 
     def num_vehs_lanes(self, PTL=False):
         """
@@ -0,0 +1,289 @@
+"""
+Incremental aggregation of the results tables. The aggregator keeps the summary of every experiment (see
+ResultsParser.summary) and its comparisons with the baselines of its demand and seed in a state file next to the
+tables, and an experiment is only summarized again once its outputs change, so adding seeds or a policy to a sweep
+costs the new runs only. main.py feeds it the experiments as the simulation pool completes them and rewrites the
+tables every --aggregate_interval seconds, parse_all_results brings it up to date with the output tree.
+The experiments are summarized in a small pool of their own, the caller only collects the results.
+"""
+import os
+import pickle
+import time
+from multiprocessing import Pool
+
+import pandas as pd
+
+from results.parse_exp_results import ResultsParser
+
+STATE_VERSION = 2
+STATE_FILE = "aggregate_state.pkl"
+BASELINE_POLICY = "Nothing"
+RL_POLICIES = ["A2C", "DQN", "PPO"]  # not compared to the baselines
+
+
+def summarize_experiment(args):
+    exp_file, metrics, vTypes = args
+    return ResultsParser(exp_file, PTL_lanes=[]).load("trips", "decisions").summary(metrics, vTypes)
+
+
+def compare_experiment(args):
+    exp_file, baseline_file, metrics = args
+    try:
+        return ResultsParser(exp_file, PTL_lanes=[]).baseline_comparison(ResultsParser(baseline_file, PTL_lanes=[]),
+                                                                         metrics)
+    except ValueError as e:
+        return str(e)  # the baseline misses vehicles of the experiment
+
+
+def _split_ready(items, wait):
+    # the items whose AsyncResult (the last field) is ready, and the others
+    ready, rest = [], []
+    for item in items:
+        (ready if wait or item[-1].ready() else rest).append(item)
+    return ready, rest
+
+
+class Experiment:
+    """
+    An experiment of the state: where its outputs are, the fingerprint of the outputs it was summarized from and
+    the summary rows
+    """
+
+    def __init__(self, exp_file, fingerprint, rows):
+        parser = ResultsParser(exp_file, PTL_lanes=[])
+        self.exp_file = exp_file
+        self.fingerprint = fingerprint
+        self.rows = rows
+        self.demand_name = parser.demand_name
+        self.av_rate = parser.av_rate
+        self.seed = parser.seed
+        self.policy_name = parser.policy_name
+
+    @property
+    def is_baseline(self):
+        return self.policy_name == BASELINE_POLICY
+
+    @property
+    def is_compared(self):
+        return self.policy_name[:3] not in RL_POLICIES
+
+
+def experiment_key(exp_file):
+    # <demand>/<av rate>/<seed>/<policy>, the outputs folder may be given relative or absolute
+    return os.path.join(*os.path.normpath(exp_file).split(os.sep)[-4:])
+
+
+def fingerprint(exp_file):
+    return [ResultsParser.fingerprint(exp_file, section) for section in ["trips", "decisions"]]
+
+
+class ResultAggregator:
+    """
+    :param state_file: where the summaries are persisted, the state is started over when it was made with other
+        metrics or vTypes
+    :param num_processes: processes summarizing the experiments, None=All available cores
+    :param on_update: called with the aggregator when the summaries changed, at most every interval seconds (and
+        by flush)
+    """
+
+    def __init__(self, state_file, metrics, vTypes=(), num_processes=1, on_update=None, interval=300):
+        self.state_file = state_file
+        self.metrics = list(metrics)
+        self.vTypes = list(vTypes)
+        self.num_processes = num_processes
+        self.on_update = on_update
+        self.interval = interval
+        self.experiments = {}  # key -> Experiment
+        self.order = []  # the keys in the order of the output tree (see sync), the rows of the tables follow it
+        self.comparisons = {}  # (experiment key, baseline key) -> dict of metric -> value
+        self.mismatches = {}  # (experiment key, baseline key) -> why the pair can not be compared
+        self._summaries = []  # (key, exp file, fingerprint, AsyncResult) of the experiments being summarized
+        self._pairs = []  # ((experiment key, baseline key), AsyncResult) of the pairs being compared
+        self._changed = False
+        self._last_update = time.time()
+        self._pool = None
+        self._load()
+
+    def __enter__(self):
+        self._pool = Pool(self.num_processes)
+        return self
+
+    def __exit__(self, *exc):
+        self._pool.terminate()
+        self._pool.join()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "rb") as f:
+                state = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return
+        if (state["version"], state["metrics"], state["vTypes"]) != (STATE_VERSION, self.metrics, self.vTypes):
+            return
+        self.experiments = state["experiments"]
+        self.order = state["order"]
+        self.comparisons = state["comparisons"]
+        self.mismatches = state["mismatches"]
+
+    def save(self):
+        # written aside and renamed, a sweep killed meanwhile leaves the previous state
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump({"version": STATE_VERSION, "metrics": self.metrics, "vTypes": self.vTypes,
+                         "experiments": self.experiments, "order": self.order, "comparisons": self.comparisons,
+                         "mismatches": self.mismatches}, f)
+        os.replace(tmp_file, self.state_file)
+
+    def add(self, exp_file):
+        """
+        Summarize the experiment, unless it is summarized from its current outputs (or about to be)
+        """
+        key = experiment_key(exp_file)
+        if key not in self.order:
+            self.order.append(key)
+        current = fingerprint(exp_file)
+        experiment = self.experiments.get(key)
+        if experiment is not None and experiment.fingerprint == current:
+            return
+        if any((pending_key, pending_fingerprint) == (key, current)
+               for pending_key, _, pending_fingerprint, _ in self._summaries):
+            return
+        result = self._pool.apply_async(summarize_experiment, ((exp_file, self.metrics, self.vTypes),))
+        self._summaries.append((key, exp_file, current, result))
+
+    def remove(self, key):
+        self.experiments.pop(key, None)
+        for pairs in [self.comparisons, self.mismatches]:
+            for pair in [pair for pair in pairs if key in pair]:
+                del pairs[pair]
+        # the pairs being compared with its previous outputs are left out
+        self._pairs = [(pair, result) for pair, result in self._pairs if key not in pair]
+        self._changed = True
+
+    def sync(self, exp_files):
+        """
+        Bring the state up to date with the experiments of the output tree, the ones no longer there are dropped.
+        The mismatched pairs are compared again, a rerun that left the fingerprint of its outputs as it was
+        can not leave a stale mismatch
+        """
+        exp_files = list(exp_files)
+        self.order = list(dict.fromkeys(map(experiment_key, exp_files)))
+        keys = set(self.order)
+        for key in [key for key in self.experiments if key not in keys]:
+            self.remove(key)
+        for pair in list(self.mismatches):
+            del self.mismatches[pair]
+            self._compare(pair)
+        for exp_file in exp_files:
+            self.add(exp_file)
+
+    def update(self, exp_files=()):
+        """
+        Add the completed experiments and collect the finished summaries, calls on_update once the interval passed
+        """
+        for exp_file in exp_files:
+            self.add(exp_file)
+        self.collect()
+        if self._changed and self.on_update and time.time() - self._last_update > self.interval:
+            self.flush()
+
+    def flush(self):
+        self.save()
+        if self.on_update:
+            self.on_update(self)
+        self._changed = False
+        self._last_update = time.time()
+
+    def collect(self, wait=False):
+        """
+        Take in the finished summaries and comparisons, the new experiments are compared to the baselines of their
+        demand and seed, new baselines to the experiments
+        :param wait: until nothing is pending, the comparisons scheduled meanwhile included
+        """
+        while self._summaries or self._pairs:
+            summaries, self._summaries = _split_ready(self._summaries, wait)
+            pairs, self._pairs = _split_ready(self._pairs, wait)
+            if not summaries and not pairs:
+                return
+            for pair, result in pairs:
+                try:
+                    comparison = result.get()
+                except Exception as e:
+                    comparison = f"Could not compare {pair[0]} to {pair[1]}: {type(e).__name__}: {e}"
+                if isinstance(comparison, dict):
+                    self.comparisons[pair] = comparison
+                else:
+                    self.mismatches[pair] = comparison
+                self._changed = True
+            for key, exp_file, current, result in summaries:
+                try:
+                    rows = result.get()
+                except Exception as e:
+                    # unreadable outputs (a killed run) are left out of the tables until the experiment is rerun
+                    print(f"Could not summarize {exp_file}: {type(e).__name__}: {e}")
+                    self.remove(key)
+                    continue
+                self._summarized(key, exp_file, current, rows)
+
+    def _summarized(self, key, exp_file, current, rows):
+        self.remove(key)
+        experiment = self.experiments[key] = Experiment(exp_file, current, rows)
+        # the experiment is compared to the baselines, a baseline to the experiments
+        pairs = []
+        for other_key, other in self.experiments.items():
+            if (other.demand_name, other.seed) != (experiment.demand_name, experiment.seed):
+                continue
+            if other.is_baseline and experiment.is_compared:
+                pairs.append((key, other_key))
+            if experiment.is_baseline and other.is_compared and other_key != key:
+                pairs.append((other_key, key))
+        for pair in pairs:
+            self._compare(pair)
+
+    def _compare(self, pair):
+        exp_files = [self.experiments[pair_key].exp_file for pair_key in pair]
+        self._pairs.append((pair, self._pool.apply_async(compare_experiment, ((*exp_files, self.metrics),))))
+        self._changed = True
+
+    def _ordered_keys(self):
+        # the experiments missing from the order (none after a sync) come last
+        keys = [key for key in self.order if key in self.experiments]
+        return keys + sorted(set(self.experiments) - set(keys))
+
+    def summary(self):
+        """
+        The summary table of the experiments (see parse_all_results.create_summary_table), in the order of the output
+        tree so the means add up the values as a pass over the parsers does
+        """
+        rows = [(experiment.demand_name, experiment.av_rate, experiment.policy_name, experiment.seed, *row)
+                for experiment in map(self.experiments.get, self._ordered_keys()) for row in experiment.rows]
+        return pd.DataFrame(rows, columns=["demand", "av_rate", "policy", "seed", "vType", "metric", "sum", "count"])
+
+    def unmatched_demands(self):
+        # the demands without any baseline run, their experiments have nothing to be compared to
+        experiments = self.experiments.values()
+        baseline_demands = {experiment.demand_name for experiment in experiments if experiment.is_baseline}
+        return sorted({experiment.demand_name for experiment in experiments
+                       if experiment.is_compared and experiment.demand_name not in baseline_demands})
+
+    def baseline_table(self):
+        """
+        The metrics of the experiments against their baselines (see parse_all_results.create_baseline_table), in the
+        order of the experiments, then of their baselines. The experiments of a demand without any baseline run get
+        the plain means of their metrics instead (see unmatched_demands)
+        """
+        position = {key: i for i, key in enumerate(self._ordered_keys())}
+        pairs = dict(self.comparisons)
+        unmatched = set(self.unmatched_demands())
+        for key, experiment in self.experiments.items():
+            if experiment.is_compared and experiment.demand_name in unmatched:
+                pairs[key, key] = {metric: total / count for vType, metric, total, count in experiment.rows
+                                   if vType == ""}
+        rows = []
+        for (key, baseline_key), comparison in sorted(pairs.items(),
+                                                      key=lambda item: (position[item[0][0]], position[item[0][1]])):
+            experiment = self.experiments[key]
+            rows.extend((experiment.demand_name, experiment.av_rate, experiment.policy_name, experiment.seed, metric,
+                         comparison[metric]) for metric in self.metrics)
+        return pd.DataFrame(rows, columns=["demand", "av_rate", "policy", "seed", "metric", "value"])
@@ -0,0 +1,84 @@
+"""
+Columnar store of the parsed outputs of an experiment, the <exp>_results/ folder next to its outputs. Every section
+(the trips table, the lanes tensor, the decisions series) has its own folder: one .npy file per column and meta.json
+with the schema version, the fingerprint of the source files of the section and the labels of its coded columns.
+Numeric columns are read memory-mapped, so a table reads only the columns it uses. A section is converted again once
+its outputs change.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+STORE_VERSION = 2
+META_FILE = "meta.json"
+
+
+def store_folder(exp_file):
+    return exp_file + "_results"
+
+
+def source_fingerprint(source_files, **params):
+    """
+    :param source_files: the output files the store is converted from, the missing ones are left out
+    :param params: the parsing parameters the store depends on
+    """
+    files = {}
+    for path in source_files:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            files[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    return {"version": STORE_VERSION, "files": files, **params}
+
+
+def read_meta(folder):
+    try:
+        with open(os.path.join(folder, META_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_current(folder, fingerprint):
+    meta = read_meta(folder)
+    return meta is not None and meta["fingerprint"] == fingerprint
+
+
+def write_store(folder, columns, meta):
+    """
+    :param columns: name -> numpy array, strings as fixed width bytes so they can be memory-mapped
+    :param meta: json-serializable metadata, the fingerprint included
+    """
+    # written aside and renamed, a reader never sees half a store
+    tmp_folder = f"{folder}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_folder, name + ".npy"), column, allow_pickle=False)
+    with open(os.path.join(tmp_folder, META_FILE), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(folder, ignore_errors=True)
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        shutil.rmtree(tmp_folder)  # another process converted it meanwhile
+
+
+def load_column(folder, name):
+    return np.load(os.path.join(folder, name + ".npy"), mmap_mode="r", allow_pickle=False)
+
+
+def encode_strings(values):
+    # fixed width bytes, ascii is the common case and converts without a per-item encode
+    try:
+        return np.asarray(values).astype("S")
+    except UnicodeEncodeError:
+        return np.char.encode(np.asarray(values).astype(str), "utf-8")
+
+
+def decode_strings(column):
+    try:
+        return column.astype("U").astype(object)
+    except UnicodeDecodeError:
+        return np.char.decode(column, "utf-8").astype(object)
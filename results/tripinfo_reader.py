@@ -0,0 +1,52 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+FLOAT_ATTRIBUTES = ["duration", "departDelay", "timeLoss"]
+BYTES_PER_TRIP = 400  # a tripinfo line of SUMO is 400-500 bytes, used to size the columns up front
+
+
+def _grow(column):
+    return np.concatenate([column, np.empty_like(column)])
+
+
+def read_tripinfo(tripinfo_file, vtype_registry):
+    """
+    Stream a tripinfo output into typed columns, the elements are dropped as soon as they are read so the memory
+    stays at the size of the columns
+    :param vtype_registry: VTypeRegistry coding the vType ids (unknown ids are added to it)
+    :return: dict of numpy columns: id (object), vType (registry code), duration, departDelay and timeLoss (float)
+    """
+    capacity = max(1024, os.path.getsize(tripinfo_file) // BYTES_PER_TRIP)
+    ids = np.empty(capacity, dtype=object)
+    codes = np.empty(capacity, dtype=np.int64)
+    floats = np.empty((capacity, len(FLOAT_ATTRIBUTES)))
+    type_codes = {}
+    size = 0
+
+    context = ET.iterparse(tripinfo_file, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if elem.tag != "tripinfo":
+            continue
+        if event == "end":
+            root.clear()
+            continue
+        if size == len(ids):
+            ids, codes, floats = _grow(ids), _grow(codes), _grow(floats)
+        # the attributes are complete at the start of the element
+        attrib = elem.attrib
+        type_id = attrib["vType"]
+        code = type_codes.get(type_id)
+        if code is None:
+            code = type_codes[type_id] = vtype_registry.code(type_id)
+        ids[size] = attrib["id"]
+        codes[size] = code
+        floats[size] = [float(attrib[name]) for name in FLOAT_ATTRIBUTES]
+        size += 1
+
+    columns = {"id": ids[:size].copy(), "vType": codes[:size].copy()}
+    for i, name in enumerate(FLOAT_ATTRIBUTES):
+        columns[name] = floats[:size, i].copy()
+    return columns
@@ -30,7 +30,53 @@ def get_args():
     parser.add_argument("--net_file", type=str, default="Ayalon_Casestudy5",
                         help='Network file name (has to be in the SUMOconfig folder)')
     parser.add_argument("--parse_results", type=str2bool, default=True, help='Parse results')
+    parser.add_argument("--aggregate_processes", type=int, default=1,
+                        help='Processes summarizing the completed simulations while the sweep runs, 0=parse the '
+                             'results after the sweep')
+    parser.add_argument("--aggregate_interval", type=float, default=300,
+                        help='Seconds between the rewrites of the results tables while the sweep runs')
     parser.add_argument("--gui", type=str2bool, default=False, help='Run with GUI')
+    parser.add_argument("--engine", type=str, default="traci", choices=["traci", "libsumo"],
+                        help='Simulation engine, libsumo runs SUMO in-process (falls back to traci with GUI)')
+    parser.add_argument("--permission_mode", type=str, default="vehicle", choices=["vehicle", "vtype"],
+                        help='How dynamic policies open the PTL: per vehicle class or per vType class')
+    parser.add_argument("--batch_static", type=str2bool, default=False,
+                        help='Run static policies as a plain sumo subprocess, without TraCI')
+    parser.add_argument("--task_timeout", type=float, default=None,
+                        help='Seconds a simulation (or the group of --sims_per_worker) may run before it is killed')
+    parser.add_argument("--retries", type=int, default=1,
+                        help='Times a failed simulation is retried in a fresh worker')
+    parser.add_argument("--max_tasks_per_child", type=int, default=None,
+                        help='Simulation groups a worker runs before it is replaced, None=no limit')
+    parser.add_argument("--worker_memory", type=float, default=None,
+                        help='Peak memory (MB) after which a worker is replaced, None=no limit')
+    parser.add_argument("--generator_processes", type=int, default=0,
+                        help='Processes generating the scenarios ahead of the simulation pool, 0=each simulation '
+                             'generates its own')
+    parser.add_argument("--scenario_queue", type=int, default=None,
+                        help='Scenarios generated ahead of the simulations, None=twice the simulation slots')
+    parser.add_argument("--reuse_session", type=str2bool, default=False,
+                        help='Keep SUMO running between the simulations of a worker and load the next one into it')
+    parser.add_argument("--session_max_runs", type=int, default=50,
+                        help='Simulations a reused SUMO process runs before it is restarted')
+    parser.add_argument("--sims_per_worker", type=int, default=1,
+                        help='Simulations each worker process interleaves over labelled TraCI connections')
+    parser.add_argument("--resume", type=str2bool, default=False,
+                        help='Skip the simulations an earlier sweep completed, rerun the unfinished ones')
+    parser.add_argument("--dry_run", type=str2bool, default=False,
+                        help='Only report the predicted makespan, core utilisation and disk footprint')
+    parser.add_argument("--sweep_spec", type=str, default=None,
+                        help='JSON/YAML sweep spec, replaces the demand, policy, seed and av_rate arguments')
+    parser.add_argument("--shard", type=str, default=":",
+                        help='start:stop index range of the sweep combinations to run')
+    parser.add_argument("--schedule_window", type=int, default=1000,
+                        help='Simulations ordered longest predicted first at a time')
+    parser.add_argument("--queue", type=str, default=None,
+                        help='Shared work queue folder, the sweep is run by main.py --worker processes')
+    parser.add_argument("--worker", type=str2bool, default=False,
+                        help='Run the tasks of --queue until it is empty')
+    parser.add_argument("--heartbeat_timeout", type=float, default=120,
+                        help='Seconds without a heartbeat before the tasks of a worker are requeued')
     parser.add_argument("--av_rate_min", type=float, default=0, help='AV rate to run, None=all av rates')
     parser.add_argument("--av_rate_max", type=float, default=1, help='AV rate to run, None=all av rates')
     parser.add_argument("--av_rate_step", type=float, default=0.1, help='AV rate to run, None=all av rates')
@@ -51,6 +97,11 @@ def get_args():
         args.av_rate = None
     if args.train:
         args.parse_results = False
+    if args.sims_per_worker > 1 and args.engine == "libsumo":
+        # libsumo holds a single simulation per process
+        print("libsumo can not interleave simulations, using traci")
+        args.engine = "traci"
+    assert args.queue or not args.worker, "A worker needs the --queue folder"
     args.min_num_pass = [args.min_num_pass] if args.min_num_pass is not None else None
     return args
 
@@ -0,0 +1,155 @@
+"""
+Two-stage sweeps (main.py --generator_processes N): a small generator pool writes the route files of the upcoming
+simulations into the route cache (SUMOAdapter.prepare_scenario), and the simulation pool is only handed tasks whose
+scenario is ready, so its processes spend their time in SUMO instead of building routes with ElementTree.
+At most queue_size tasks are being generated or wait ready for the simulation pool, the generators pause while the
+queue is full. A task whose scenario could not be generated is reported to on_failure (TaskRunner.log_failure
+writes it to the failure log) and left out, the sweep goes on with the rest.
+"""
+import functools
+import os
+import queue
+import threading
+import time
+from multiprocessing.pool import Pool
+
+from utils.task_runner import error_info
+
+
+def prepare_task(task):
+    """
+    :return: the task, the seconds its scenario took, the error (see error_info) or None and the generator pid
+    """
+    start = time.perf_counter()
+    try:
+        task.sumo.prepare_scenario(task.policy)
+        error = None
+    except Exception as e:
+        error = error_info(e)
+    return task, time.perf_counter() - start, error, os.getpid()
+
+
+class PipelineStats:
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.start = time.perf_counter()
+        self.generated = 0
+        self.generation_time = 0.0
+        self.simulated = 0
+        self.failed = 0
+        self.taken = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.starved_time = 0.0  # the simulation pool waited this long for a ready scenario
+
+    def take(self, depth, waited):
+        self.taken += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.starved_time += waited
+
+    def postfix(self, depth):
+        elapsed = time.perf_counter() - self.start
+        return {"queue": f"{depth}/{self.queue_size}", "gen/s": f"{self.generated / elapsed:.2f}",
+                "sim/s": f"{self.simulated / elapsed:.2f}"}
+
+    def report(self, num_generators):
+        elapsed = time.perf_counter() - self.start
+        per_scenario = self.generation_time / self.generated if self.generated else 0
+        mean_depth = self.depth_sum / self.taken if self.taken else 0
+        return "\n".join([
+            f"generation: {self.generated} scenarios in {elapsed:.1f}s ({self.generated / elapsed:.2f}/s), "
+            f"{per_scenario:.2f}s per scenario on {num_generators} processes, {self.failed} failed",
+            f"simulation: {self.simulated} tasks in {elapsed:.1f}s ({self.simulated / elapsed:.2f}/s), "
+            f"waited {self.starved_time:.1f}s for scenarios",
+            f"queue depth: mean {mean_depth:.1f}, max {self.max_depth} of {self.queue_size}",
+        ])
+
+
+class ScenarioPipeline:
+    """
+    :param on_failure: called with a task whose scenario could not be generated, its error, the seconds it took and
+        the generator pid, the failure is printed when not given
+    """
+
+    def __init__(self, num_generators, queue_size, on_failure=None):
+        self.num_generators = num_generators
+        self.queue_size = queue_size
+        self.on_failure = on_failure
+        self.stats = PipelineStats(queue_size)
+        self._slots = threading.Semaphore(queue_size)
+        self._ready = queue.Queue()
+        self._pool = None
+
+    def __enter__(self):
+        self._pool = Pool(self.num_generators)
+        return self
+
+    def __exit__(self, *exc):
+        self._pool.terminate()
+        self._pool.join()
+
+    def _feed(self, tasks):
+        # the tasks are built lazily in this thread, an error building them ends the sweep (see ready)
+        end = None
+        try:
+            for task in tasks:
+                self._slots.acquire()
+                self._pool.apply_async(prepare_task, (task,), callback=self._ready.put,
+                                       error_callback=functools.partial(self._lost, task))
+            # every slot is back once the last ready task was taken
+            for _ in range(self.queue_size):
+                self._slots.acquire()
+        except BaseException as e:
+            end = e
+        finally:
+            self._ready.put(end)
+
+    def _lost(self, task, exc):
+        # prepare_task reports the errors of the generation, this is one of the pool itself (its result not sent back)
+        error = {"error": type(exc).__name__, "message": str(exc), "traceback": ""}
+        self._ready.put((task, 0.0, error, None))
+
+    def _failed(self, task, error, seconds, pid):
+        self.stats.failed += 1
+        if self.on_failure:
+            self.on_failure(task, error, seconds, pid)
+        else:
+            print(f"Could not generate the scenario of {task.key}: {error['error']}: {error['message']}")
+
+    def ready(self, tasks):
+        """
+        :return: generator of the tasks with a prepared scenario, in the order they got ready
+        :raise: the error that stopped the tasks iterator
+        """
+        threading.Thread(target=self._feed, args=(tasks,), daemon=True).start()
+        while True:
+            start = time.perf_counter()
+            item = self._ready.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            task, seconds, error, pid = item
+            if error is not None:
+                self._slots.release()
+                self._failed(task, error, seconds, pid)
+                continue
+            self.stats.generated += 1
+            self.stats.generation_time += seconds
+            self.stats.take(self.depth(), time.perf_counter() - start)
+            self._slots.release()
+            yield task
+
+    def depth(self):
+        # the ready tasks waiting for the simulation pool
+        return self._ready.qsize()
+
+    def simulated(self, num_done):
+        self.stats.simulated += num_done
+
+    def postfix(self):
+        return self.stats.postfix(self.depth())
+
+    def report(self):
+        return self.stats.report(self.num_generators)
@@ -0,0 +1,160 @@
+"""
+Runtime model of the simulations, used by main to hand the pool the longest simulations first.
+Every completed evaluation run appends its features, run time and output size to SUMO/outputs/run_history.jsonl,
+the model is fitted on them per policy type. Without recorded runs it falls back to rough defaults measured on
+Ayalon_Casestudy5, which are only good for ordering.
+"""
+import heapq
+import itertools
+import json
+import os
+
+import numpy as np
+
+RUN_HISTORY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "SUMO", "outputs", "run_history.jsonl")
+MIN_RUNS = 3  # recorded runs of a policy type before it gets its own fit
+
+# seconds per vehicle x network lane, static policies run without decisions
+DEFAULT_SECONDS_PER_VEHICLE_LANE = {"static": 6e-5, "dynamic": 2.5e-4}
+# output bytes per vehicle (tripinfo) and per lane x laneData interval (lanes)
+DEFAULT_BYTES = np.array([520.0, 420.0])
+LANE_DATA_PERIOD = 60
+
+
+def task_features(demand, policy, mode, network):
+    """
+    :param demand: the demand as simulated, its vehicle amounts set (see SUMOAdapter.simulated_demand)
+    :param mode: "batch" or the engine the simulation runs on
+    """
+    amounts = demand.veh_amount if isinstance(demand.veh_amount, list) else [demand.veh_amount]
+    # veh_amount holds vehicles per hour, each hour lasts hour_len simulation seconds
+    vehicles = sum(sum(amount.values()) for amount in amounts) * demand.hour_len / 3600
+    return {"policy_type": f"{type(policy).__name__}_{mode}",
+            "static": policy.static,
+            "vehicles": float(vehicles),
+            "horizon": len(amounts[0]) * demand.hour_len,
+            "lanes": len(network.lane_max_vehicles)}
+
+
+def record_run(sumo, policy, runtime, history_file=RUN_HISTORY_FILE):
+    mode = "batch" if sumo.runs_batch(policy) else sumo.engine
+    record = task_features(sumo.simulated_demand(), policy, mode, sumo.network)
+    record["runtime"] = runtime
+    record["output_bytes"] = sum(os.path.getsize(f) for f in sumo.output_files(policy) if os.path.exists(f))
+    os.makedirs(os.path.dirname(history_file), exist_ok=True)
+    # a single short append per run, the workers never interleave within a line
+    with open(history_file, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def load_run_history(history_file=RUN_HISTORY_FILE):
+    if not os.path.exists(history_file):
+        return []
+    history = []
+    with open(history_file) as f:
+        for line in f:
+            try:
+                history.append(json.loads(line))
+            except ValueError:
+                continue  # cut by a killed worker
+    return history
+
+
+def _runtime_columns(features):
+    return [features["vehicles"] * features["lanes"], features["horizon"]]
+
+
+def _disk_columns(features):
+    return [features["vehicles"], features["lanes"] * features["horizon"] / LANE_DATA_PERIOD]
+
+
+class RuntimeModel:
+    """
+    Predicted run time (seconds) and output size (bytes) of a simulation from its task_features.
+    Policy types with MIN_RUNS recorded runs are fitted on [vehicles x lanes, horizon], the others use the
+    default rate scaled by the median ratio of the recorded to the default predictions.
+    """
+
+    def __init__(self, history=()):
+        self.num_runs = len(history)
+        self.coefficients = {}
+        self.scale = 1.0
+        self.disk_coefficients = DEFAULT_BYTES
+        if not history:
+            return
+        self.scale = float(np.median([run["runtime"] / self._default_runtime(run) for run in history]))
+        policy_types = {run["policy_type"] for run in history}
+        for policy_type in policy_types:
+            runs = [run for run in history if run["policy_type"] == policy_type]
+            if len(runs) >= MIN_RUNS:
+                coefficients = np.linalg.lstsq(np.array([_runtime_columns(run) for run in runs]),
+                                               np.array([run["runtime"] for run in runs]), rcond=None)[0]
+                self.coefficients[policy_type] = np.clip(coefficients, 0, None)
+        if len(history) >= MIN_RUNS:
+            coefficients = np.linalg.lstsq(np.array([_disk_columns(run) for run in history]),
+                                           np.array([run["output_bytes"] for run in history]), rcond=None)[0]
+            self.disk_coefficients = np.clip(coefficients, 0, None)
+
+    @staticmethod
+    def _default_runtime(features):
+        rate = DEFAULT_SECONDS_PER_VEHICLE_LANE["static" if features["static"] else "dynamic"]
+        return rate * features["vehicles"] * features["lanes"]
+
+    def predict(self, features):
+        coefficients = self.coefficients.get(features["policy_type"])
+        if coefficients is None:
+            return self.scale * self._default_runtime(features)
+        return float(np.dot(coefficients, _runtime_columns(features)))
+
+    def predict_disk(self, features):
+        return float(np.dot(self.disk_coefficients, _disk_columns(features)))
+
+
+def longest_first(tasks, model, window):
+    """
+    Order a stream of tasks longest predicted first, window tasks at a time, so a huge sweep starts right away.
+    The pool hands the next task to the first idle worker, the short ones fill the gaps at the end of a window
+    :param tasks: TaskSpecs, their features are read from the parameters
+    :return: generator of (task, features, predicted runtime)
+    """
+    tasks = iter(tasks)
+    while True:
+        batch = list(itertools.islice(tasks, window))
+        if not batch:
+            return
+        features = [task.features for task in batch]
+        costs = [model.predict(f) for f in features]
+        for i in sorted(range(len(batch)), key=lambda i: costs[i], reverse=True):
+            yield batch[i], features[i], costs[i]
+
+
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def predicted_makespan(costs, num_workers):
+    """
+    Makespan of the costs (in the order they are dispatched) when every idle worker takes the next one
+    """
+    workers = [0.0] * min(num_workers, len(costs))
+    for cost in costs:
+        heapq.heapreplace(workers, workers[0] + cost)
+    return max(workers, default=0.0)
+
+
+def schedule_report(costs, disk, num_workers, model):
+    makespan = predicted_makespan(costs, num_workers)
+    utilisation = sum(costs) / (makespan * num_workers) if makespan else 0
+    fitted = f"fitted on {model.num_runs} recorded runs" if model.num_runs else "no recorded runs, rough defaults"
+    return "\n".join([
+        f"{len(costs)} simulations on {num_workers} workers, runtime model {fitted}",
+        f"predicted total run time: {sum(costs):.0f}s",
+        f"predicted makespan:       {makespan:.0f}s",
+        f"core utilisation:         {utilisation:.0%}",
+        f"disk footprint:           {sum(disk) / 2 ** 30:.2f} GiB"])
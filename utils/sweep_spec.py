@@ -0,0 +1,122 @@
+"""
+Sweeps described by a spec file (JSON, or YAML when PyYAML is installed) and enumerated lazily:
+
+    {
+        "net_file": "Ayalon_Casestudy5",
+        "seeds": {"seed": 42, "num_experiments": 5, "skip_seeds": 0},   (or a list of seeds)
+        "demands": [{"class": "PassDemand", "grid": {"amount": {"range": [1000, 9000, 1000]},
+                                                     "av_pass_factor": [0, 0.5, 1], "av_rate": [0.3, 0.6]}}],
+        "policies": [{"class": "Nothing", "list": [{}]},
+                     {"class": "StaticNumPass", "grid": {"min_num_pass": [2, 3], "av_rate": [0.3, 0.6]}}],
+        "filter": ["policy.av_rate == demand.av_rate"]
+    }
+
+A grid clause is the cross product of its parameter values (a list, a single value or a range [start, stop, step]
+with the stop included), a list clause names the parameter dicts. The filter expressions see the demand and policy
+instances and the seed, all have to hold; the default is the av_rate match main always applied.
+iter_sweep yields the valid (demand, seed, policy) combinations one by one, in a fixed order, so a sweep can be
+sharded by index range of that order.
+"""
+import itertools
+import json
+
+import numpy as np
+
+from Demands.demand_profiles import Demand
+from Demands.demand_parameters import create_demand_definitions
+from Policies.static_step_handle_functions import StepHandleFunction
+from Policies.policy_parameters import create_policy_definitions
+from utils.class_utils import get_all_subclasses
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_FILTER = ["policy.av_rate == demand.av_rate"]
+
+
+def load_sweep_spec(path):
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            assert yaml is not None, "PyYAML is not installed, use a JSON sweep spec"
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def spec_from_args(args):
+    # the sweep main runs from its command line arguments
+    demand_definitions = create_demand_definitions(av_rate_range=args.av_rate)
+    policy_definitions = create_policy_definitions(av_rate_range=args.av_rate, min_num_pass_range=args.min_num_pass,
+                                                   train=args.train)
+    demands = [demand_definitions[args.demand]] if args.demand else demand_definitions.values()
+    policies = [policy_definitions[args.policy]] if args.policy else policy_definitions.values()
+    return {"net_file": args.net_file,
+            "seeds": {"seed": args.seed, "num_experiments": args.num_experiments, "skip_seeds": args.skip_seeds},
+            "demands": [{"class": d["class"].__name__, "list": d["params"]} for d in demands],
+            "policies": [{"class": p["class"].__name__, "list": p["params"]} for p in policies],
+            "filter": DEFAULT_FILTER}
+
+
+def get_seeds(seeds):
+    if isinstance(seeds, dict):
+        # the seeds main draws, the output folders of earlier sweeps are named by them
+        np.random.seed(seeds.get("seed", 42))
+        skip_seeds = seeds.get("skip_seeds", 0)
+        seeds = [np.random.randint(0, 10000) for _ in range(seeds.get("num_experiments", 5) + skip_seeds)]
+        return seeds[skip_seeds:]
+    return list(seeds)
+
+
+def _values(values):
+    if isinstance(values, dict):
+        start, stop, step = values["range"]
+        decimals = len(str(step).split(".")[1]) if "." in str(step) else 0
+        return [float(round(v, decimals)) if decimals else int(v) for v in np.arange(start, stop + step / 2, step)]
+    return values if isinstance(values, list) else [values]
+
+
+def iter_params(clause):
+    if "grid" in clause:
+        names = list(clause["grid"])
+        for values in itertools.product(*[_values(clause["grid"][name]) for name in names]):
+            yield dict(zip(names, values))
+    for params in clause.get("list", []):
+        yield params
+
+
+def iter_definitions(clauses, base_class):
+    classes = {cls.__name__: cls for cls in get_all_subclasses(base_class)}
+    for clause in clauses:
+        assert clause["class"] in classes, f"Unknown class {clause['class']}"
+        for params in iter_params(clause):
+            yield classes[clause["class"]], params
+
+
+def iter_sweep(spec):
+    """
+    :return: generator of the valid (demand_class, demand_params, seed, policy_class, policy_params) combinations
+    """
+    seeds = get_seeds(spec.get("seeds", [42]))
+    filters = [compile(expression, "<sweep filter>", "eval") for expression in spec.get("filter", DEFAULT_FILTER)]
+    for demand_class, demand_params in iter_definitions(spec["demands"], Demand):
+        demand = demand_class(**demand_params)
+        for seed in seeds:
+            for policy_class, policy_params in iter_definitions(spec["policies"], StepHandleFunction):
+                namespace = {"demand": demand, "policy": policy_class(**policy_params), "seed": seed}
+                if all(eval(f, {"__builtins__": {}}, namespace) for f in filters):
+                    yield demand_class, demand_params, seed, policy_class, policy_params
+
+
+def iter_demands(spec):
+    # the demand instances of the sweep, for the results parser
+    for demand_class, demand_params in iter_definitions(spec["demands"], Demand):
+        yield demand_class(**demand_params)
+
+
+def parse_shard(shard):
+    """
+    :param shard: "start:stop" index range of the sweep combinations, either end can be left out
+    """
+    start, stop = shard.split(":")
+    return int(start) if start else 0, int(stop) if stop else None
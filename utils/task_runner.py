@@ -0,0 +1,225 @@
+"""
+The process pool of the local sweeps. Unlike multiprocessing.Pool it survives its tasks: a task that raises, crashes
+its worker or runs past the timeout is logged to a JSONL failure log and retried in a fresh worker (with a new SUMO
+process) up to retries times, and the sweep goes on with the rest. Every worker runs in its own process group, a
+timed out worker is killed together with its SUMO processes. Workers are also recycled after max_tasks_per_child task
+groups, or once their peak memory passed memory_limit MB, the stable-baselines3 runs grow over long sweeps.
+"""
+import collections
+import json
+import os
+import queue
+import resource
+import signal
+import threading
+import time
+import traceback
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+
+POLL_INTERVAL = 0.5
+
+
+def error_info(exc):
+    return {"error": type(exc).__name__, "message": str(exc), "traceback": traceback.format_exc()}
+
+
+def _peak_memory_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _work(func, conn, max_tasks_per_child, memory_limit):
+    os.setpgrp()
+    num_groups = 0
+    while True:
+        try:
+            tasks = conn.recv()
+        except EOFError:
+            return
+        if tasks is None:
+            return
+        errors = func(tasks)
+        num_groups += 1
+        # a failed task may leave SUMO or the policy in a bad state, its worker is replaced
+        recycle = any(errors) or (max_tasks_per_child and num_groups >= max_tasks_per_child) or \
+            (memory_limit and _peak_memory_mb() > memory_limit)
+        conn.send((errors, bool(recycle)))
+        if recycle:
+            return
+
+
+class _Worker:
+    def __init__(self, func, max_tasks_per_child, memory_limit):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_work, args=(func, child_conn, max_tasks_per_child, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.items = None  # the (task, attempt) pairs it runs
+        self.start = None
+
+    def send(self, items):
+        self.items = items
+        self.start = time.time()
+        self.conn.send([task for task, _ in items])
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # already gone
+        self.process.kill()
+        self.process.join()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join()
+
+
+class TaskRunner:
+    """
+    :param func: called in the workers with a list of tasks, returns the error of each (see error_info), None for
+        the completed ones. The tasks need a key naming them in the failure log
+    :param timeout: seconds a task group may run, the tasks of a group run side by side and share it
+    """
+
+    def __init__(self, func, num_processes=None, timeout=None, retries=1, max_tasks_per_child=None,
+                 memory_limit=None, failure_log=None):
+        self.func = func
+        self.num_processes = num_processes or os.cpu_count()
+        self.timeout = timeout
+        self.retries = retries
+        self.max_tasks_per_child = max_tasks_per_child
+        self.memory_limit = memory_limit
+        self.failure_log = failure_log
+        self.failed = []  # the keys of the tasks that failed every attempt
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for worker in self._workers:
+            if worker.items is None:
+                worker.stop()
+            else:
+                worker.kill()
+        self._workers = []
+
+    def _new_worker(self):
+        return _Worker(self.func, self.max_tasks_per_child, self.memory_limit)
+
+    def _feed(self, groups, ready):
+        # the groups are built lazily in this thread, an error building them ends the sweep (see imap_unordered)
+        end = None
+        try:
+            for group in groups:
+                ready.put([(task, 1) for task in group])
+        except BaseException as e:
+            end = e
+        finally:
+            ready.put(end)
+
+    def log_failure(self, task, error, elapsed, pid):
+        """
+        Log a task that failed before it was handed to the pool (see ScenarioPipeline), it is not retried
+        """
+        self._log_failure(task, 1, error, elapsed, pid, final=True)
+
+    def _log_failure(self, task, attempt, error, elapsed, pid, final=None):
+        final = attempt > self.retries if final is None else final
+        if final:
+            self.failed.append(task.key)
+        if self.failure_log is None:
+            return
+        os.makedirs(os.path.dirname(self.failure_log) or ".", exist_ok=True)
+        with open(self.failure_log, "a") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "key": task.key, "attempt": attempt,
+                                "final": final, "elapsed": round(elapsed, 1), "pid": pid, **error}) + "\n")
+
+    def _finish(self, worker, errors, retry):
+        """
+        :return: the number of tasks that are done (completed or failed for good) and the completed tasks
+        """
+        elapsed = time.time() - worker.start
+        num_done = 0
+        completed = []
+        for (task, attempt), error in zip(worker.items, errors):
+            if error is None:
+                num_done += 1
+                completed.append(task)
+                continue
+            self._log_failure(task, attempt, error, elapsed, worker.process.pid)
+            if attempt > self.retries:
+                num_done += 1
+            else:
+                retry.append((task, attempt + 1))
+        worker.items = None
+        return num_done, completed
+
+    def imap_unordered(self, groups):
+        """
+        Run the task groups, the groups are pulled as workers become idle
+        :return: generator of the number of tasks done by every finished group and the tasks it completed
+        :raise: the error that stopped the groups generator, the running tasks are killed on exit
+        """
+        # the feeder stays at most num_processes groups ahead of the workers, a long sweep is never pulled whole
+        ready = queue.Queue(maxsize=self.num_processes)
+        threading.Thread(target=self._feed, args=(groups, ready), daemon=True).start()
+        self._workers = [self._new_worker() for _ in range(self.num_processes)]
+        retry = collections.deque()  # the failed tasks run alone, ahead of the new groups
+        exhausted = False
+        while True:
+            for worker in self._workers:
+                if worker.items is not None:
+                    continue
+                if retry:
+                    worker.send([retry.popleft()])
+                    continue
+                if exhausted:
+                    break
+                try:
+                    items = ready.get(timeout=POLL_INTERVAL if not self._busy() else 0)
+                except queue.Empty:
+                    break
+                if items is None:
+                    exhausted = True
+                    break
+                if isinstance(items, BaseException):
+                    raise items
+                worker.send(items)
+            busy = self._busy()
+            if not busy:
+                if exhausted and not retry:
+                    return
+                continue
+            for conn in wait([worker.conn for worker in busy], timeout=POLL_INTERVAL):
+                worker = next(worker for worker in busy if worker.conn is conn)
+                try:
+                    errors, recycle = conn.recv()
+                except EOFError:
+                    worker.process.join()
+                    error = {"error": "WorkerDied", "message": f"worker exited with code {worker.process.exitcode}",
+                             "traceback": ""}
+                    errors, recycle = [error] * len(worker.items), True
+                yield self._finish(worker, errors, retry)
+                if recycle:
+                    self._replace(worker)
+            if self.timeout is None:
+                continue
+            for worker in self._busy():
+                if time.time() - worker.start > self.timeout:
+                    worker.kill()
+                    error = {"error": "Timeout", "message": f"no result after {self.timeout}s", "traceback": ""}
+                    yield self._finish(worker, [error] * len(worker.items), retry)
+                    self._replace(worker)
+
+    def _busy(self):
+        return [worker for worker in self._workers if worker.items is not None]
+
+    def _replace(self, worker):
+        worker.process.join()
+        self._workers[self._workers.index(worker)] = self._new_worker()
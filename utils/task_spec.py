@@ -0,0 +1,112 @@
+import os
+
+from SUMO.SUMOAdpater import SUMOAdapter, SUMO_FOLDER, completion_marker, experiment_folder, select_engine, \
+    simulation_fingerprint
+from SUMO.completion_utils import read_completion_marker
+from SUMO.netfile_utils import get_network_index
+from utils.scheduling_utils import task_features
+
+
+class TaskSpec:
+    """
+    One simulation of a sweep as plain data: the demand and policy classes with their parameters, the seed,
+    the net file and the SUMOAdapter options. The adapter and the policy are built on first use, and are left out
+    when the spec is pickled, so a pool worker receives the few parameters and builds its own objects
+    (the network metadata comes from the per-process NetworkIndex).
+    The sweep itself only reads the key, features, completion and output paths of the spec, they are derived from
+    the parameters and never build the adapter.
+    """
+
+    def __init__(self, demand_class, demand_params, seed, policy_class, policy_params, net_file, train=False,
+                 **adapter_kwargs):
+        self.demand_class = demand_class
+        self.demand_params = demand_params
+        self.seed = seed
+        self.policy_class = policy_class
+        self.policy_params = policy_params
+        self.net_file = net_file
+        self.train = train
+        self.adapter_kwargs = adapter_kwargs
+        self._sumo = None
+        self._policy = None
+        self._demand = None
+
+    @property
+    def sumo(self):
+        if self._sumo is None:
+            # the sweep copies the net file to the outputs once, not every adapter
+            self._sumo = SUMOAdapter(self.demand_class(**self.demand_params), self.seed, net_file=self.net_file,
+                                     copy_net=False, **self.adapter_kwargs)
+        return self._sumo
+
+    @property
+    def policy(self):
+        if self._policy is None:
+            self._policy = self.policy_class(**self.policy_params)
+        return self._policy
+
+    @property
+    def demand(self):
+        # the demand as the simulation sees it (see SUMOAdapter.simulated_demand), the adapter builds its own
+        if self._demand is None:
+            self._demand = self.demand_class(**self.demand_params)
+            self._demand.set_veh_amount(self._demand.av_rate)
+        return self._demand
+
+    def _option(self, name, default):
+        return self.adapter_kwargs.get(name, default)
+
+    @property
+    def gui(self):
+        return self._option("gui", False)
+
+    @property
+    def engine(self):
+        return select_engine(self._option("engine", "traci"), self.gui)
+
+    @property
+    def batch(self):
+        return self._option("batch", False) and not self.gui
+
+    @property
+    def network(self):
+        return get_network_index(os.path.join(SUMO_FOLDER, "SUMOconfig", self.net_file))
+
+    @property
+    def output_folder(self):
+        return experiment_folder(self.net_file, self.demand, self.seed)
+
+    @property
+    def key(self):
+        # names the simulation like its output files
+        return os.path.join(str(self.demand), str(self.seed), str(self.policy))
+
+    @property
+    def exp_file(self):
+        # the outputs of the simulation, without their suffixes (see results.parse_exp_results.ResultsParser)
+        return os.path.join(self.output_folder, str(self.policy))
+
+    @property
+    def features(self):
+        # see utils.scheduling_utils.task_features
+        mode = "batch" if self.batch and self.policy.static else self.engine
+        return task_features(self.demand, self.policy, mode, self.network)
+
+    def fingerprint(self):
+        return simulation_fingerprint(self.network.net_hash, self.demand, self.seed, self.policy, self.engine,
+                                      self._option("permission_mode", "vehicle"), self.batch, self.gui)
+
+    def is_complete(self):
+        # see SUMOAdapter.is_complete
+        return read_completion_marker(completion_marker(self.output_folder, self.policy), self.fingerprint())
+
+    def build(self):
+        # the (sumo, policy, train) arguments of main.simulate
+        return self.sumo, self.policy, self.train
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_sumo"] = None
+        state["_policy"] = None
+        state["_demand"] = None
+        return state
@@ -0,0 +1,151 @@
+"""
+A work queue on a shared filesystem, for sweeps spread over several hosts (main.py --queue DIR, main.py --worker).
+The coordinator writes the pickled task specs to DIR/pending, in dispatch order. A worker claims a task by renaming it
+to DIR/running/<task>@<worker id>, the rename is atomic so exactly one worker wins it, and moves it to DIR/done or
+DIR/failed when the simulation ends. Every worker touches DIR/workers/<worker id> while it runs, the running tasks of
+a worker whose heartbeat is older than heartbeat_timeout are renamed back to pending by the coordinator or any worker.
+"""
+import multiprocessing
+import os
+import pickle
+import socket
+import time
+import uuid
+
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 120
+POLL_INTERVAL = 5
+FOLDERS = ["pending", "running", "done", "failed", "workers"]
+
+
+def new_worker_id():
+    return f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:6]}"
+
+
+def _beat(heartbeat_file, interval, worker_pid, stop):
+    # stops with the worker, also when it is killed
+    while os.getppid() == worker_pid:
+        with open(heartbeat_file, "a"):
+            os.utime(heartbeat_file)
+        if stop.wait(interval):
+            return
+
+
+class Heartbeat:
+    """
+    Touches the heartbeat file of a worker from a child process, a libsumo step holds the GIL of the worker for as
+    long as it runs. The file is removed when the worker leaves cleanly
+    """
+
+    def __init__(self, heartbeat_file, interval=HEARTBEAT_INTERVAL):
+        self.heartbeat_file = heartbeat_file
+        self._stop = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_beat, args=(heartbeat_file, interval, os.getpid(), self._stop),
+                                                daemon=True)
+
+    def __enter__(self):
+        with open(self.heartbeat_file, "a"):
+            pass
+        self._process.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._process.join()
+        os.remove(self.heartbeat_file)
+
+
+class WorkQueue:
+    def __init__(self, path, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        self.path = path
+        self.heartbeat_timeout = heartbeat_timeout
+        for folder in FOLDERS:
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def _folder(self, folder, name=""):
+        return os.path.join(self.path, folder, name)
+
+    def put(self, tasks):
+        """
+        Queue the tasks in the order given, the workers claim them in that order
+        :return: the sweep id prefixing the task names, and the number of tasks queued
+        """
+        sweep_id = f"{time.strftime('%Y%m%d%H%M%S')}_{os.getpid()}"
+        num_tasks = 0
+        for index, task in enumerate(tasks):
+            name = f"{sweep_id}_{index:08d}.task"
+            # written next to the folders and renamed, a worker never sees half a task
+            tmp_file = os.path.join(self.path, f".{name}.tmp")
+            with open(tmp_file, "wb") as f:
+                pickle.dump(task, f)
+            os.replace(tmp_file, self._folder("pending", name))
+            num_tasks += 1
+        return sweep_id, num_tasks
+
+    def claim(self, worker_id):
+        """
+        :return: (name, task) of the first pending task this worker won, None if there is none
+        """
+        for name in sorted(os.listdir(self._folder("pending"))):
+            running = self._folder("running", f"{name}@{worker_id}")
+            try:
+                os.rename(self._folder("pending", name), running)
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            with open(running, "rb") as f:
+                return name, pickle.load(f)
+        return None
+
+    def complete(self, name, worker_id):
+        try:
+            os.replace(self._folder("running", f"{name}@{worker_id}"), self._folder("done", name))
+        except FileNotFoundError:
+            # requeued while this worker looked dead, take it back unless another worker claimed it already
+            try:
+                os.rename(self._folder("pending", name), self._folder("done", name))
+            except FileNotFoundError:
+                pass
+
+    def fail(self, name, worker_id, error):
+        try:
+            os.replace(self._folder("running", f"{name}@{worker_id}"), self._folder("failed", name))
+        except FileNotFoundError:
+            return  # requeued while this worker looked dead, it runs again
+        with open(self._folder("failed", name + ".err"), "w") as f:
+            f.write(error)
+
+    def heartbeat(self, worker_id):
+        # a few beats per timeout
+        return Heartbeat(self._folder("workers", worker_id), min(HEARTBEAT_INTERVAL, self.heartbeat_timeout / 4))
+
+    def _is_alive(self, worker_id):
+        try:
+            return time.time() - os.path.getmtime(self._folder("workers", worker_id)) < self.heartbeat_timeout
+        except FileNotFoundError:
+            return False  # left without completing its task
+
+    def requeue_dead(self):
+        """
+        Move the tasks of the workers without a recent heartbeat back to pending
+        :return: the number of tasks requeued
+        """
+        requeued = 0
+        for running in os.listdir(self._folder("running")):
+            name, worker_id = running.split("@", 1)
+            if self._is_alive(worker_id):
+                continue
+            try:
+                os.rename(self._folder("running", running), self._folder("pending", name))
+                requeued += 1
+            except FileNotFoundError:
+                pass  # completed or requeued meanwhile
+        return requeued
+
+    def counts(self, sweep_id=""):
+        # the failed folder also holds the tracebacks
+        return {folder: len([name for name in os.listdir(self._folder(folder))
+                             if name.startswith(sweep_id) and not name.endswith(".err")])
+                for folder in ["pending", "running", "done", "failed"]}
+
+    def is_empty(self):
+        return not os.listdir(self._folder("pending")) and not os.listdir(self._folder("running"))